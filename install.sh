@@ -30,6 +30,7 @@ installer()
 
   # Install systemd service
   install -m 644 -D conf/systemd/ipwaiter.service "${DESTDIR}/usr/lib/systemd/system" || return 1
+  install -m 644 -D conf/systemd/ipwaiter-watchdog.service "${DESTDIR}/usr/lib/systemd/system" || return 1
 
   # Install documentation
   install -m 644 -D README.md "${DESTDIR}/${PREFIX}/share/doc/ipwaiter" || return 1
@@ -70,6 +71,7 @@ uninstaller()
 
   # Remove the service
   rm -f "${DESTDIR}/usr/lib/systemd/system/ipwaiter.service" || return 1
+  rm -f "${DESTDIR}/usr/lib/systemd/system/ipwaiter-watchdog.service" || return 1
 
   # Remove license and directory
   rm -r -f "${DESTDIR}/${PREFIX}/share/licenses/ipwaiter" || return 1
@@ -24,14 +24,18 @@ import os
 import sys
 
 from .constants import PathConstants
-from .iptables.iptables import Iptables
-from .logger.logger import Logger
-from .orders.lister import ListOrders
-from .orders.waiter import Waiter
-from .orders.systemconf import SystemConfParser
+from .logger.logger import FatalError, Logger
 from ._version import __version__
 
 
+def __getattr__(name):
+    """Session pulls in most of ipwaiter, so it is imported on first use"""
+    if name == "Session":
+        from .session import Session
+        return Session
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def _initialize_parser():
     """Set up the option parser with the options we handle"""
     parser = argparse.ArgumentParser(prog="ipwaiter")
@@ -108,13 +112,122 @@ def _initialize_parser():
         action="store",
         dest="src",
         metavar="SRC",
-        help="Source IP address block for orders")
+        help="Source IP address block for orders, or @IFACE to follow "
+             "the network of an interface")
     parser.add_argument(
         "-d", "--dst",
         action="store",
         dest="dst",
         metavar="DST",
-        help="Destination IP address block for orders")
+        help="Destination IP address block for orders, or @IFACE to "
+             "follow the network of an interface")
+    parser.add_argument(
+        "--simulate",
+        action="store",
+        dest="simulate",
+        metavar="TRACE",
+        help="Simulate the packets of a CSV TRACE against system.conf")
+    parser.add_argument(
+        "--netns",
+        action="append",
+        dest="netns",
+        metavar="NS",
+        help="Hire, fire or rehire inside the network namespaces NS, "
+             "a comma separated list or 'all'")
+    parser.add_argument(
+        "-j", "--jobs",
+        action="store",
+        dest="jobs",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Apply to at most N network namespaces at once")
+    parser.add_argument(
+        "--export-bundle",
+        action="store",
+        dest="export_bundle",
+        metavar="PATH",
+        help="Compile system.conf into a bundle at PATH")
+    parser.add_argument(
+        "--import-bundle",
+        action="store",
+        dest="import_bundle",
+        metavar="PATH",
+        help="Apply the compiled bundle at PATH")
+    parser.add_argument(
+        "--watch",
+        action="store",
+        dest="watch",
+        nargs="?",
+        type=float,
+        const=30.0,
+        metavar="SECONDS",
+        help="Hire and repair drifted chains every SECONDS")
+    parser.add_argument(
+        "--metrics",
+        action="store",
+        dest="metrics",
+        default=PathConstants.WATCHDOG_METRICS,
+        metavar="PATH",
+        help="Write watchdog counters to PATH")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        help="Run against empty in memory tables and print the result")
+    parser.add_argument(
+        "--batch",
+        action="store",
+        dest="batch",
+        metavar="FILE",
+        help="Apply the operations listed in FILE, or - for stdin, at once")
+    parser.add_argument(
+        "--wait",
+        action="store",
+        dest="wait",
+        type=float,
+        metavar="SECONDS",
+        help="Wait up to SECONDS for the xtables lock on every attempt, "
+             "10 by default")
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        dest="validate",
+        help="Check every order in every order directory, without applying")
+    parser.add_argument(
+        "--reload-feeds",
+        action="store_true",
+        dest="reload_feeds",
+        help="Reload the feeds of every hired blocklist order")
+    parser.add_argument(
+        "--bpf-report",
+        action="store_true",
+        dest="bpf_report",
+        help="Compare the rules of every BPF_ORDERS order before and after "
+             "lowering into bpf matches")
+    parser.add_argument(
+        "--cost",
+        action="store_true",
+        dest="cost",
+        help="Report the rules a packet walks in every parent chain and "
+             "order, against the MAX_RULES budgets of system.conf")
+    parser.add_argument(
+        "--complete",
+        action="store",
+        dest="complete",
+        nargs="?",
+        const="filter",
+        choices=["filter", "raw"],
+        metavar="TABLE",
+        help="Print the orders with rules for TABLE, filter by default, "
+             "for shell completion")
+    parser.add_argument(
+        "--profile",
+        action="store",
+        dest="profile",
+        metavar="NAME",
+        help="Point the parent chains at the staged profile NAME, "
+             "default for system.conf")
     return parser
 
 
@@ -130,7 +243,12 @@ def _parse_options():
     if (not parsed.delete_orders and not parsed.add_orders and
             not parsed.hire and not parsed.fire and
             not parsed.rehire and not parsed.teardown and
-            not parsed.list_orders):
+            not parsed.list_orders and not parsed.simulate and
+            not parsed.export_bundle and not parsed.import_bundle and
+            parsed.watch is None and not parsed.batch and
+            not parsed.validate and not parsed.reload_feeds and
+            not parsed.bpf_report and not parsed.cost and
+            not parsed.complete and not parsed.profile):
         parser.print_help()
         sys.exit(0)
 
@@ -170,7 +288,93 @@ def _exit_if_not_super():
         Logger.fatal("You must be root to use ipwaiter")
 
 
+def _lock(parsed):
+    from .iptables.lock import XtablesLock
+
+    if parsed.wait is None:
+        return XtablesLock()
+    return XtablesLock(parsed.wait)
+
+
+def _simulate(order_dirs, system_conf, opts, trace):
+    from .orders.compiler import Compiler
+    from .simulator.simulator import Simulator
+
+    if not os.path.isfile(trace):
+        Logger.fatal(f"Invalid trace given: {trace}")
+
+    ruleset = Compiler(order_dirs, system_conf).compile(opts)
+    try:
+        report = Simulator(ruleset).run(trace)
+    except ValueError as e:
+        Logger.fatal(f"Failed to simulate: {e}")
+    else:
+        report.log()
+
+
+def _bpf_report(order_dirs, system_conf, opts):
+    from .orders.compiler import Compiler
+
+    compiler = Compiler(order_dirs, system_conf)
+    compiler.compile(opts)
+    stats = compiler.bpf_stats()
+    if not stats:
+        Logger.log("No order is lowered, list some in BPF_ORDERS")
+        return
+
+    for ((name, table), order_stats) in sorted(stats.items()):
+        Logger.log(f"{name} ({table}): {order_stats['before']} rules "
+                   f"lowered to {order_stats['after']}")
+        for (rules, programs, mean_rules, max_rules, mean_insns,
+             max_insns) in order_stats["groups"]:
+            Logger.log(f"  {rules} rules -> {programs} bpf: "
+                       f"{mean_rules:.2f} rules (max {max_rules}) or "
+                       f"{mean_insns:.2f} instructions (max {max_insns}) "
+                       f"evaluated per packet")
+
+
+def _cost(order_dirs, system_conf, opts):
+    from .orders.compiler import Compiler
+    from .orders.cost import TraversalCost
+
+    compiler = Compiler(order_dirs, system_conf)
+    budgets = compiler.budgets()
+    costs = compiler.costs(opts)
+    TraversalCost.log(costs, budgets)
+
+    exceeded = TraversalCost.over_budget(costs, budgets)
+    for (label, worst, budget) in exceeded:
+        Logger.log(f"{label} walks up to {worst} rules, "
+                   f"over its budget of {budget}")
+    if exceeded:
+        sys.exit(1)
+
+
+def _resolve_namespaces(requested):
+    from .netns.netns import Netns
+
+    namespaces = []
+    for item in requested:
+        for netns in item.split(","):
+            netns = netns.strip()
+            if netns == "all":
+                namespaces += Netns.list_all()
+            elif netns:
+                namespaces.append(netns)
+
+    # Keep the requested order, without applying twice
+    return list(dict.fromkeys(namespaces))
+
+
 def main():
+    try:
+        _main()
+    except FatalError as e:
+        print(f"FATAL  {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _main():
     # Parse the options before starting setup
     parsed = _parse_options()
 
@@ -188,12 +392,73 @@ def main():
     # Reverse the list so it will search custom locations and then the home and system last
     order_dirs.reverse()
 
+    if parsed.complete:
+        from .orders.completion import CompletionIndex
+
+        for name in CompletionIndex(order_dirs).names(parsed.complete):
+            print(name)
+        return
+
     if parsed.list_orders:
+        from .orders.lister import ListOrders
+
         ListOrders(order_dirs).list_all()
         return
 
-    # We must have superuser privs
-    _exit_if_not_super()
+    # A bundle carries everything it needs, so nothing is read here
+    if parsed.import_bundle:
+        from .ipset.ipset import Ipset
+        from .iptables.iptables import Iptables
+        from .orders.bundle import Bundle
+
+        _exit_if_not_super()
+        iptables = Iptables(lock=_lock(parsed))
+        Bundle.read(parsed.import_bundle).apply(iptables, Ipset())
+        return
+
+    opts = {}
+    if parsed.src:
+        opts["src"] = parsed.src
+    if parsed.dst:
+        opts["dst"] = parsed.dst
+
+    # Address blocks such as @wlan0 follow the address of the interface
+    bindings = None
+    if any(value.startswith("@") for value in opts.values()):
+        from .orders.bindings import Bindings
+
+        bindings = Bindings(opts)
+        opts = bindings.resolve()
+
+    from .orders.systemconf import SystemConfParser
+
+    system_conf = SystemConfParser(PathConstants.SYSTEM_CONF)
+
+    # Simulation never touches the kernel
+    if parsed.simulate:
+        _simulate(order_dirs, system_conf, opts, parsed.simulate)
+        return
+
+    if parsed.cost:
+        _cost(order_dirs, system_conf, opts)
+        return
+
+    if parsed.bpf_report:
+        _bpf_report(order_dirs, system_conf, opts)
+        return
+
+    if parsed.export_bundle:
+        from .orders.bundle import Bundle
+        from .orders.compiler import Compiler
+
+        bundle = Bundle.compile(Compiler(order_dirs, system_conf), opts)
+        path = bundle.write(parsed.export_bundle)
+        Logger.log(f"Exported bundle {bundle.hash} to: {path}")
+        return
+
+    # We must have superuser privs, unless the kernel is left alone
+    if not parsed.dry_run:
+        _exit_if_not_super()
 
     if (parsed.hire and parsed.fire) or (parsed.rehire and parsed.hire) \
             or (parsed.fire and parsed.rehire):
@@ -207,27 +472,155 @@ def main():
                    "an ipwaiter")
         sys.exit(2)
 
-    opts = {}
-    if parsed.src:
-        opts["src"] = parsed.src
-    if parsed.dst:
-        opts["dst"] = parsed.dst
+    if parsed.batch and (parsed.add_orders or parsed.delete_orders or
+                         parsed.hire or parsed.fire or parsed.rehire or
+                         parsed.teardown or parsed.netns or
+                         parsed.watch is not None):
+        Logger.log("A batch carries its own operations, it cannot be "
+                   "combined with other operations")
+        sys.exit(2)
 
-    iptables = Iptables()
-    system_conf = SystemConfParser("/etc/ipwaiter/system.conf")
-    waiter = Waiter(iptables, order_dirs, system_conf)
+    if parsed.dry_run and (parsed.netns or parsed.watch is not None or
+                           parsed.reload_feeds):
+        Logger.log("A dry run does not support --netns, --watch or "
+                   "--reload-feeds")
+        sys.exit(2)
 
-    if parsed.add_orders:
-        for order in parsed.add_orders:
-            waiter.add_order(order, parsed.raw, opts)
+    if parsed.profile and (parsed.fire or parsed.teardown or parsed.batch
+                           or parsed.netns or parsed.watch is not None):
+        Logger.log("A profile can only be switched to alone, or after "
+                   "--hire or --rehire")
+        sys.exit(2)
+
+    # Sets are swapped in place, no chain needs to change
+    if parsed.reload_feeds:
+        from .ipset.blocklist import Blocklist
+        from .ipset.ipset import Ipset
+        from .orders.compiler import Compiler
+
+        ipset = Ipset()
+        compiler = Compiler(order_dirs, system_conf)
+        for blocklist in Blocklist.hired(compiler, opts):
+            blocklist.load(ipset)
+        return
+
+    if parsed.netns:
+        if parsed.add_orders or parsed.delete_orders:
+            Logger.log("Network namespaces only support "
+                       "--hire, --fire, --teardown or --rehire")
+            sys.exit(2)
+
+        if parsed.hire:
+            action = "hire"
+        elif parsed.teardown:
+            action = "teardown"
+        elif parsed.fire:
+            action = "fire"
+        else:
+            action = "rehire"
+
+        from .netns.netns import NamespaceRunner
+
+        runner = NamespaceRunner(order_dirs, system_conf, parsed.jobs,
+                                 _lock(parsed))
+        namespaces = _resolve_namespaces(parsed.netns)
+        if not runner.run(namespaces, action, opts, report=parsed.debug):
+            sys.exit(1)
+        return
 
-    if parsed.delete_orders:
-        for order in parsed.delete_orders:
-            waiter.delete_order(order, parsed.raw)
+    if parsed.dry_run:
+        from .iptables.memory import MemoryIptables
+
+        iptables = MemoryIptables()
+        ipset = None
+        nftables = None
+    else:
+        from .iptables.iptables import Iptables
+        from .ipset.ipset import Ipset
+        from .nftables.nftables import Nftables
+
+        iptables = Iptables(lock=_lock(parsed))
+        ipset = Ipset()
+        nftables = Nftables()
+
+    if parsed.validate:
+        from .orders.validator import Validator
+
+        if not Validator(iptables, order_dirs, ipset).run(opts):
+            sys.exit(1)
+        return
+
+    # The rules no longer come from an imported bundle
+    if not parsed.dry_run:
+        from .orders.bundle import Bundle
+
+        Bundle.forget_active()
+
+    if parsed.batch:
+        from .orders.batch import Batch
+
+        batch = Batch(iptables, order_dirs, system_conf, ipset, nftables)
+        applied = batch.run(parsed.batch, opts, report=parsed.debug)
+        if parsed.dry_run:
+            print(iptables.save(), end="")
+            for (operation, count) in sorted(iptables.operations.items()):
+                Logger.log(f"{operation}: {count}")
+        if not applied:
+            sys.exit(1)
+        return
+
+    if parsed.watch is not None:
+        from .ipset.blocklist import Blocklist
+        from .orders.compiler import Compiler
+        from .orders.watchdog import Watchdog
+
+        compiler = Compiler(order_dirs, system_conf)
+        for blocklist in Blocklist.hired(compiler, opts):
+            blocklist.load(ipset)
+        ruleset = compiler.compile(opts)
+        Watchdog(iptables, ruleset, parsed.metrics, compiler=compiler,
+                 bindings=bindings).run(parsed.watch)
+        return
 
-    if parsed.hire:
-        waiter.hire_waiter(opts=opts, report=parsed.debug)
-    elif parsed.fire or parsed.teardown:
-        waiter.fire_waiter(destroy=parsed.teardown, report=parsed.debug)
-    elif parsed.rehire:
-        waiter.rehire_waiter(opts=opts, report=parsed.debug)
+    from .iptables.rollback import Rollback
+    from .orders.profiles import Profiles
+    from .orders.waiter import Waiter
+
+    profiles = Profiles(order_dirs, switching=bool(parsed.profile))
+    waiter = Waiter(iptables, order_dirs, system_conf, ipset=ipset,
+                    nftables=nftables, profiles=profiles)
+
+    # A failure puts every owned chain back as it was before this run
+    with Rollback(iptables):
+        if parsed.add_orders:
+            for order in parsed.add_orders:
+                waiter.add_order(order, parsed.raw, opts)
+
+        if parsed.delete_orders:
+            for order in parsed.delete_orders:
+                waiter.delete_order(order, parsed.raw)
+
+        if parsed.hire:
+            waiter.hire_waiter(opts=opts, report=parsed.debug)
+        elif parsed.fire or parsed.teardown:
+            waiter.fire_waiter(destroy=parsed.teardown, report=parsed.debug)
+        elif parsed.rehire:
+            waiter.rehire_waiter(opts=opts, report=parsed.debug)
+
+        if parsed.profile:
+            profiles.switch(iptables, parsed.profile)
+
+    if not parsed.dry_run:
+        if parsed.profile:
+            Profiles.remember_active(parsed.profile)
+        elif parsed.hire or parsed.fire or parsed.teardown or parsed.rehire:
+            Profiles.forget_active()
+
+    if parsed.dry_run:
+        print(iptables.save(), end="")
+        for (operation, count) in sorted(iptables.operations.items()):
+            Logger.log(f"{operation}: {count}")
+    elif iptables.lock.contended:
+        Logger.log(iptables.lock.summary())
+    else:
+        Logger.d(iptables.lock.summary())
@@ -23,11 +23,38 @@ class PathConstants:
     """XDG config variable"""
     ENV_XDG_CONFIG = "XDG_CONFIG_HOME"
 
+    """XDG cache variable"""
+    ENV_XDG_CACHE = "XDG_CACHE_HOME"
+
+    """User cache dir default"""
+    HOME_CACHE_DIR = "~/.cache"
+
+    """Order names served to shell completion, under the cache dir"""
+    COMPLETION_INDEX = "ipwaiter/orders.index"
+
     """System config dir default"""
     SYSTEM_CONFIG_DIR = "/etc/ipwaiter/orders"
 
+    """System conf listing the hired orders"""
+    SYSTEM_CONF = "/etc/ipwaiter/system.conf"
+
+    """Profiles, each a system conf of its own staged beside it"""
+    PROFILE_DIR = "/etc/ipwaiter/system.d"
+
     """Admin config dir default"""
     ADMIN_CONFIG_DIR = "/etc/ipwaiter/custom/orders"
 
     """User config dir default"""
     HOME_CONFIG_DIR = "~/.config/ipwaiter/orders"
+
+    """Runtime state, which does not outlive the kernel rules"""
+    RUNTIME_DIR = "/run/ipwaiter"
+
+    """Hash of the bundle currently applied"""
+    ACTIVE_BUNDLE = "/run/ipwaiter/bundle"
+
+    """Name of the profile the parent chains jump into"""
+    ACTIVE_PROFILE = "/run/ipwaiter/profile"
+
+    """Watchdog counters, for a textfile collector to pick up"""
+    WATCHDOG_METRICS = "/run/ipwaiter/watchdog.prom"
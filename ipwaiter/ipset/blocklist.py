@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import ipaddress
+import itertools
+
+from ..logger.logger import Logger
+
+
+class Blocklist:
+    """Every blocklist set starts with this, so teardown can find them"""
+    PREFIX = "ipwb_"
+
+    """A feed is loaded into this set first, and then swapped in"""
+    STAGING_SUFFIX = "_new"
+
+    """ipset names hold at most 31 characters"""
+    MAX_NAME = 31
+
+    """Type of every blocklist set"""
+    TYPE = "hash:net family inet"
+
+    """Sets always hold at least this many networks"""
+    MIN_ELEMENTS = 65536
+
+    """Feeds comment with either of these, as most published feeds do"""
+    COMMENTS = ("#", ";")
+
+    def __init__(self, order, path):
+        """The blocklist of order, read from the feed file at path"""
+        if not order or not path:
+            Logger.fatal(f"Invalid blocklist, order: {order}, path: {path}")
+        self.name = Blocklist.set_name(order)
+        self.path = path
+
+    @staticmethod
+    def set_name(order):
+        """The name of the set of an order, short enough to be staged"""
+        limit = Blocklist.MAX_NAME - len(Blocklist.STAGING_SUFFIX)
+        name = f"{Blocklist.PREFIX}{order}"
+        if len(name) > limit:
+            digest = hashlib.sha1(order.encode("utf-8")).hexdigest()
+            digest = digest[:limit - len(Blocklist.PREFIX)]
+            name = f"{Blocklist.PREFIX}{digest}"
+        return name
+
+    def networks(self):
+        """Stream the IPv4 networks of the feed, one line at a time"""
+        skipped = 0
+        try:
+            with open(self.path, "r") as feed:
+                for line in feed:
+                    for comment in Blocklist.COMMENTS:
+                        line = line.split(comment, 1)[0]
+                    words = line.split()
+                    if not words:
+                        continue
+
+                    try:
+                        network = ipaddress.ip_network(words[0], strict=False)
+                    except ValueError:
+                        skipped += 1
+                        continue
+
+                    if network.version != 4:
+                        skipped += 1
+                        continue
+                    yield network
+        except OSError as e:
+            Logger.fatal(f"Unable to read blocklist feed: {self.path}, {e}")
+
+        if skipped:
+            Logger.log(f"Skipped {skipped} entries of {self.path} which "
+                       f"are not IPv4 networks")
+
+    def collapsed(self):
+        """The networks of the feed, merged into the fewest which cover
+        the same addresses"""
+        return list(ipaddress.collapse_addresses(self.networks()))
+
+    def load(self, ipset):
+        """Load the feed into a fresh set, and swap it with the live one"""
+        Blocklist.fill(ipset, self.name, self.collapsed(), self.path)
+
+    @staticmethod
+    def fill(ipset, name, networks, source):
+        """Load networks, read from source, into a fresh set, and swap it
+        with the live set name
+
+        Rules keep matching the live set the whole time, so reloading
+        never opens a gap and never touches a chain"""
+        staging = f"{name}{Blocklist.STAGING_SUFFIX}"
+
+        maxelem = Blocklist.MIN_ELEMENTS
+        while maxelem < len(networks):
+            maxelem *= 2
+        create = f"{Blocklist.TYPE} maxelem {maxelem}"
+
+        # A staging set left by an interrupted load may be sized wrong
+        if ipset.exists(staging):
+            ipset.destroy(staging)
+
+        header = []
+        if not ipset.exists(name):
+            header.append(f"create {name} {create}")
+        header.append(f"create {staging} {create}")
+
+        lines = itertools.chain(
+            header,
+            (f"add {staging} {network}" for network in networks),
+            [f"swap {staging} {name}", f"destroy {staging}"])
+        if not ipset.restore(lines):
+            Logger.fatal(f"Failed to load blocklist: {source} "
+                         f"into set: {name}")
+
+        Logger.log(f"Loaded {len(networks)} networks from {source} "
+                   f"into set: {name}")
+
+    @staticmethod
+    def hired(compiler, opts):
+        """The blocklist of every order hired in system.conf"""
+        blocklists = []
+        for path in compiler.hired_orders().values():
+            order = compiler.order(path, opts)
+            if order.feed:
+                blocklists.append(Blocklist(order.name, order.feed))
+        return blocklists
+
+    @staticmethod
+    def destroy_all(ipset):
+        """Destroy every blocklist set, once no rule matches them"""
+        for name in ipset.names():
+            if name.startswith(Blocklist.PREFIX):
+                if not ipset.destroy(name):
+                    Logger.log(f"Unable to destroy blocklist set: {name}")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import subprocess
+
+from ..logger.logger import Logger
+
+
+class Ipset:
+
+    def __init__(self, netns=None, binary="ipset"):
+        """Commands run inside the network namespace netns, if given"""
+        self._netns = netns
+        self._binary = binary
+
+    def _command(self, *args):
+        if self._netns:
+            return ["ip", "netns", "exec", self._netns, self._binary, *args]
+        return [self._binary, *args]
+
+    def exists(self, name):
+        if not name:
+            Logger.fatal(f"Failed exists() in ipset, arguments name: {name}")
+        return self._run(self._command("-q", "list", "-n", name))
+
+    def names(self):
+        """Names of every set"""
+        try:
+            output = subprocess.check_output(
+                self._command("list", "-n"),
+                stdin=subprocess.DEVNULL,
+                stderr=Ipset._get_output(),
+                universal_newlines=True
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            Logger.d("ipset list command failed")
+            Logger.d(e)
+            return []
+        return [line.strip() for line in output.splitlines() if line.strip()]
+
+    def destroy(self, name):
+        if not name:
+            Logger.fatal(f"Failed destroy() in ipset, arguments name: {name}")
+        return self._run(self._command("destroy", name))
+
+    def restore(self, lines):
+        """Feed lines to a single ipset restore, returns True on success
+
+        lines may be any iterable, so large sets are never held twice"""
+        command = self._command("restore")
+        Logger.d(f"Run ipset restore: '{' '.join(command)}'")
+        try:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=Ipset._get_output(),
+                stderr=Ipset._get_output(),
+                universal_newlines=True
+            )
+        except OSError as e:
+            Logger.d(f"ipset restore failed to start: {e}")
+            return False
+
+        try:
+            for line in lines:
+                process.stdin.write(f"{line}\n")
+            process.stdin.close()
+        except BrokenPipeError:
+            Logger.d("ipset restore stopped reading")
+        return process.wait() == 0
+
+    @staticmethod
+    def _get_output():
+        """Get output level based on debugging mode"""
+        return None if Logger.enabled else subprocess.DEVNULL
+
+    @staticmethod
+    def _run(args):
+        try:
+            Logger.d(f"Run ipset command: '{' '.join(args)}'")
+            subprocess.run(
+                args,
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stdout=Ipset._get_output(),
+                stderr=Ipset._get_output()
+            )
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            Logger.d("ipset command failed")
+            Logger.d(e)
+            return False
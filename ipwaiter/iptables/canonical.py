@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import ipaddress
+import shlex
+import socket
+
+
+class Canonical:
+    """Long options, as iptables-save prints them"""
+    ALIASES = {
+        "--protocol": "-p", "--source": "-s", "--src": "-s",
+        "--destination": "-d", "--dst": "-d", "--in-interface": "-i",
+        "--out-interface": "-o", "--fragment": "-f", "--match": "-m",
+        "--jump": "-j", "--goto": "-g", "--source-port": "--sport",
+        "--destination-port": "--dport", "--source-ports": "--sports",
+        "--destination-ports": "--dports",
+    }
+
+    """Options of the rule itself, printed first in this order"""
+    BASE_OPTIONS = ["-s", "-d", "-i", "-o", "-p", "-f"]
+
+    """Options without a value"""
+    FLAGS = ["-f", "--syn", "--log-uid", "--log-tcp-sequence",
+             "--log-tcp-options", "--log-ip-options", "--set", "--rcheck",
+             "--update", "--remove", "--rttl", "--reap", "--notrack",
+             "--connlimit-saddr", "--connlimit-daddr"]
+
+    """Options with two values"""
+    PAIRS = ["--tcp-flags", "--match-set"]
+
+    """Protocol numbers iptables-save prints by name"""
+    PROTOCOLS = {"1": "icmp", "6": "tcp", "17": "udp", "132": "sctp",
+                 "33": "dccp", "136": "udplite", "47": "gre", "50": "esp",
+                 "51": "ah"}
+
+    """Match modules loaded implicitly by the options of a protocol"""
+    IMPLICIT = {"tcp": ["--sport", "--dport", "--syn", "--tcp-flags",
+                        "--tcp-option"],
+                "udp": ["--sport", "--dport"],
+                "udplite": ["--sport", "--dport"],
+                "sctp": ["--sport", "--dport", "--chunk-types"],
+                "dccp": ["--sport", "--dport", "--dccp-types",
+                         "--dccp-option"],
+                "icmp": ["--icmp-type"]}
+
+    """Option order of the modules which print theirs in a fixed order"""
+    OPTION_ORDER = {
+        "tcp": ["--sport", "--dport", "--tcp-option", "--tcp-flags"],
+        "udp": ["--sport", "--dport"],
+        "udplite": ["--sport", "--dport"],
+        "limit": ["--limit", "--limit-burst"],
+        "hashlimit": ["--hashlimit-upto", "--hashlimit-above",
+                      "--hashlimit-burst", "--hashlimit-mode",
+                      "--hashlimit-name", "--hashlimit-htable-size",
+                      "--hashlimit-htable-max",
+                      "--hashlimit-htable-gcinterval",
+                      "--hashlimit-htable-expire", "--hashlimit-srcmask",
+                      "--hashlimit-dstmask"],
+        "connlimit": ["--connlimit-upto", "--connlimit-above",
+                      "--connlimit-mask", "--connlimit-saddr",
+                      "--connlimit-daddr"],
+    }
+
+    """Match options left out when they hold their default"""
+    MATCH_DEFAULTS = {
+        "limit": [("--limit-burst", ("5",))],
+        "hashlimit": [("--hashlimit-burst", ("5",)),
+                      ("--hashlimit-srcmask", ("32",)),
+                      ("--hashlimit-dstmask", ("32",))],
+    }
+
+    """Match options printed even when left out, unless one of the others
+    is given"""
+    MATCH_IMPLIED = {
+        "connlimit": [("--connlimit-mask", ("32",), []),
+                      ("--connlimit-saddr", (), ["--connlimit-daddr"])],
+    }
+
+    """Hash modes of the hashlimit match, in the order they are printed"""
+    HASHLIMIT_MODES = ["srcip", "srcport", "dstip", "dstport"]
+
+    """TCP flags, in the order they are printed"""
+    TCP_FLAGS = ["FIN", "SYN", "RST", "PSH", "ACK", "URG", "ECE", "CWR"]
+
+    """Connection states, in the order they are printed"""
+    STATES = ["INVALID", "NEW", "RELATED", "ESTABLISHED", "UNTRACKED",
+              "SNAT", "DNAT"]
+
+    """ICMP type names, as the type and code printed for them"""
+    ICMP_TYPES = {
+        "any": "any", "echo-reply": "0", "pong": "0",
+        "destination-unreachable": "3", "network-unreachable": "3/0",
+        "host-unreachable": "3/1", "protocol-unreachable": "3/2",
+        "port-unreachable": "3/3", "fragmentation-needed": "3/4",
+        "source-route-failed": "3/5", "network-unknown": "3/6",
+        "host-unknown": "3/7", "network-prohibited": "3/9",
+        "host-prohibited": "3/10", "TOS-network-unreachable": "3/11",
+        "TOS-host-unreachable": "3/12", "communication-prohibited": "3/13",
+        "host-precedence-violation": "3/14",
+        "precedence-cutoff": "3/15", "source-quench": "4",
+        "redirect": "5", "network-redirect": "5/0", "host-redirect": "5/1",
+        "TOS-network-redirect": "5/2", "TOS-host-redirect": "5/3",
+        "echo-request": "8", "ping": "8", "router-advertisement": "9",
+        "router-solicitation": "10", "time-exceeded": "11",
+        "ttl-exceeded": "11", "ttl-zero-during-transit": "11/0",
+        "ttl-zero-during-reassembly": "11/1", "parameter-problem": "12",
+        "ip-header-bad": "12/0", "required-option-missing": "12/1",
+        "timestamp-request": "13", "timestamp-reply": "14",
+        "address-mask-request": "17", "address-mask-reply": "18",
+    }
+
+    """Rate units, with their length in seconds, coarsest first"""
+    RATE_UNITS = [("day", 86400), ("hour", 3600), ("min", 60), ("sec", 1)]
+
+    """Fixed point scale the kernel keeps a rate in, as its period"""
+    RATE_SCALE = 10000
+
+    """Rate units of the limit and hashlimit matches"""
+    LIMIT_UNITS = {"s": "sec", "sec": "sec", "second": "sec",
+                   "m": "min", "min": "min", "minute": "min",
+                   "h": "hour", "hour": "hour", "d": "day", "day": "day"}
+
+    """Syslog levels the LOG target prints as numbers"""
+    LOG_LEVELS = {"emerg": "0", "alert": "1", "crit": "2", "error": "3",
+                  "err": "3", "warning": "4", "warn": "4", "notice": "5",
+                  "info": "6", "debug": "7"}
+
+    """Target options printed even when left out"""
+    TARGET_DEFAULTS = {
+        "REJECT": [("--reject-with", "icmp-port-unreachable")],
+    }
+
+    """Option order of the targets which print theirs in a fixed order"""
+    TARGET_ORDER = {
+        "LOG": ["--log-prefix", "--log-level", "--log-tcp-sequence",
+                "--log-tcp-options", "--log-ip-options", "--log-uid"],
+    }
+
+    """Short names of the REJECT target types"""
+    REJECT_TYPES = {
+        "net-unreach": "icmp-net-unreachable",
+        "host-unreach": "icmp-host-unreachable",
+        "port-unreach": "icmp-port-unreachable",
+        "proto-unreach": "icmp-proto-unreachable",
+        "net-prohib": "icmp-net-prohibited",
+        "host-prohib": "icmp-host-prohibited",
+        "admin-prohib": "icmp-admin-prohibited",
+        "tcp-rst": "tcp-reset",
+    }
+
+    def __init__(self):
+        """Canonical is purely a static implementation, no class instances"""
+        raise NotImplementedError("No instances of Canonical allowed")
+
+    @staticmethod
+    def _arity(option):
+        if option in Canonical.FLAGS:
+            return 0
+        if option in Canonical.PAIRS:
+            return 2
+        return 1
+
+    @staticmethod
+    def _options(args):
+        """Split arguments into (negated, option, values), with aliases and
+        the old '--option ! value' negation resolved"""
+        options = []
+        negate = False
+        index = 0
+        while index < len(args):
+            option = Canonical.ALIASES.get(args[index], args[index])
+            index += 1
+            if option == "!":
+                negate = True
+                continue
+
+            if option in ["-j", "-g"]:
+                options.append((False, option, tuple(args[index:])))
+                break
+
+            arity = Canonical._arity(option)
+            if arity and index < len(args) and args[index] == "!":
+                negate = True
+                index += 1
+            options.append((negate, option, tuple(args[index:index + arity])))
+            index += arity
+            negate = False
+        return options
+
+    @staticmethod
+    def _address(value):
+        try:
+            return str(ipaddress.ip_network(value, strict=False))
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _port(value, protocol):
+        if value.isdigit():
+            return str(int(value))
+        try:
+            return str(socket.getservbyname(value, protocol or "tcp"))
+        except OSError:
+            return value
+
+    @staticmethod
+    def _ports(value, protocol):
+        """A port or range, a range of one port printed as the port"""
+        if ":" not in value:
+            return Canonical._port(value, protocol)
+        low, high = value.split(":", 1)
+        low = Canonical._port(low, protocol) if low else "0"
+        high = Canonical._port(high, protocol) if high else "65535"
+        return low if low == high else f"{low}:{high}"
+
+    @staticmethod
+    def _flags(value):
+        flags = value.upper().split(",")
+        if "NONE" in flags:
+            return "NONE"
+        if "ALL" in flags:
+            flags = Canonical.TCP_FLAGS[:6]
+        return ",".join(flag for flag in Canonical.TCP_FLAGS if flag in flags)
+
+    @staticmethod
+    def _states(value):
+        states = value.upper().split(",")
+        return ",".join([state for state in Canonical.STATES
+                         if state in states] +
+                        [state for state in states
+                         if state not in Canonical.STATES])
+
+    @staticmethod
+    def _limit(value):
+        """A rate in the unit iptables-save prints it back in
+
+        The kernel keeps the period between packets, and the rate is
+        printed in the finest unit holding a whole number of them"""
+        rate, _, unit = value.partition("/")
+        unit = Canonical.LIMIT_UNITS.get(unit.lower(), unit) if unit \
+            else "sec"
+        seconds = dict(Canonical.RATE_UNITS).get(unit)
+        if not rate.isdigit() or not int(rate) or seconds is None:
+            return f"{rate}/{unit}"
+
+        period = Canonical.RATE_SCALE * seconds // int(rate)
+        if not period:
+            return f"{rate}/{unit}"
+        printed = Canonical.RATE_UNITS[0]
+        for (name, length) in Canonical.RATE_UNITS[1:]:
+            scaled = length * Canonical.RATE_SCALE
+            if period > scaled or scaled // period < scaled % period:
+                break
+            printed = (name, length)
+        return f"{printed[1] * Canonical.RATE_SCALE // period}/{printed[0]}"
+
+    @staticmethod
+    def _match_option(module, option, values, protocol):
+        """The option as printed, or None if it holds the default"""
+        if option in ["--sport", "--dport"]:
+            return option, (Canonical._ports(values[0], protocol),)
+        if option in ["--sports", "--dports", "--ports"]:
+            return option, (",".join(Canonical._ports(port, protocol)
+                                     for port in values[0].split(",")),)
+        if option == "--syn":
+            return "--tcp-flags", ("FIN,SYN,RST,ACK", "SYN")
+        if option == "--tcp-flags":
+            return option, tuple(Canonical._flags(value) for value in values)
+        if option in ["--ctstate", "--state"]:
+            return option, (Canonical._states(values[0]),)
+        if option == "--icmp-type":
+            value = Canonical.ICMP_TYPES.get(values[0], values[0])
+            return option, (value,)
+        if option in ["--limit", "--hashlimit-above", "--hashlimit-upto"]:
+            return option, (Canonical._limit(values[0]),)
+        if option == "--hashlimit-mode":
+            modes = values[0].split(",")
+            return option, (",".join(mode for mode in
+                                     Canonical.HASHLIMIT_MODES
+                                     if mode in modes),)
+        if (option, values) in Canonical.MATCH_DEFAULTS.get(module, []):
+            return None
+        return option, values
+
+    @staticmethod
+    def _implied(module, options):
+        """The options of a match, with those printed when left out"""
+        given = [option for (_, option, _) in options]
+        implied = Canonical.MATCH_IMPLIED.get(module, [])
+        for (option, values, others) in implied:
+            if option not in given and not set(others) & set(given):
+                options.append((False, option, values))
+        return options
+
+    @staticmethod
+    def _target(values):
+        """Target options as printed, with their defaults"""
+        if not values:
+            return values
+
+        target, options = values[0], list(values[1:])
+        pairs = []
+        index = 0
+        while index < len(options):
+            option = options[index]
+            arity = Canonical._arity(option)
+            value = tuple(options[index + 1:index + 1 + arity])
+            if option == "--log-level" and value:
+                value = (Canonical.LOG_LEVELS.get(value[0].lower(),
+                                                  value[0]),)
+                if value == ("4",):
+                    value = None
+            if option == "--reject-with" and value:
+                value = (Canonical.REJECT_TYPES.get(value[0], value[0]),)
+            if value is not None:
+                pairs.append((option, value))
+            index += 1 + arity
+
+        for (option, value) in Canonical.TARGET_DEFAULTS.get(target, []):
+            if option not in [given for (given, _) in pairs]:
+                pairs.append((option, (value,)))
+
+        order = Canonical.TARGET_ORDER.get(target)
+        if order:
+            pairs.sort(key=lambda pair: order.index(pair[0])
+                       if pair[0] in order else len(order))
+        return (target, *[item for (option, value) in pairs
+                          for item in (option, *value)])
+
+    @staticmethod
+    def rule(args):
+        """The arguments of a rule, as iptables-save prints them back"""
+        base = {}
+        modules = []
+        target = ()
+        protocol = None
+        current = None
+
+        for (negate, option, values) in Canonical._options(list(args)):
+            if option in ["-j", "-g"]:
+                target = (option, *Canonical._target(values))
+                continue
+
+            if option in Canonical.BASE_OPTIONS:
+                value = values[0] if values else None
+                if option in ["-s", "-d"]:
+                    value = Canonical._address(value)
+                elif option == "-p":
+                    value = value.lower()
+                    value = Canonical.PROTOCOLS.get(value, value)
+                    protocol = value
+                    if value == "all" and not negate:
+                        continue
+                base[option] = (negate, value)
+                continue
+
+            if option == "-m":
+                current = [values[0], []]
+                modules.append(current)
+                continue
+
+            # Options of the protocol load its match, if none is loaded
+            if option in Canonical.IMPLICIT.get(protocol, []) and (
+                    current is None or
+                    option not in Canonical.IMPLICIT.get(current[0], [])):
+                loaded = [module for module in modules
+                          if module[0] == protocol]
+                current = loaded[0] if loaded else [protocol, []]
+                if not loaded:
+                    modules.append(current)
+
+            if current is None:
+                # Not any match iptables would accept, keep it as written
+                current = ["", []]
+                modules.append(current)
+            printed = Canonical._match_option(current[0], option, values,
+                                              protocol)
+            if printed:
+                current[1].append((negate, *printed))
+
+        canonical = []
+        for option in Canonical.BASE_OPTIONS:
+            if option in base:
+                negate, value = base[option]
+                canonical += ["!"] if negate else []
+                canonical += [option] if value is None else [option, value]
+
+        for (module, options) in modules:
+            options = Canonical._implied(module, options)
+            order = Canonical.OPTION_ORDER.get(module)
+            if order:
+                options = sorted(options, key=lambda item: order.index(
+                    item[1]) if item[1] in order else len(order))
+            canonical += ["-m", module] if module else []
+            for (negate, option, values) in options:
+                canonical += ["!"] if negate else []
+                canonical += [option, *values]
+
+        return tuple(canonical + list(target))
+
+    @staticmethod
+    def saved(rule):
+        """A rule string as iptables-save prints it, made canonical"""
+        return Canonical.rule(shlex.split(rule))
+
+    @staticmethod
+    def digest(rules):
+        """Digest of canonical rules, the same for a compiled chain and
+        the chain iptables-save prints for it"""
+        text = "\n".join("\0".join(rule) for rule in rules)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
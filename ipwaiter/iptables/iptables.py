@@ -21,10 +21,27 @@
 import subprocess
 
 from ..logger.logger import Logger
+from .lock import XtablesLock
 
 
 class Iptables:
 
+    def __init__(self, netns=None, lock=None):
+        """Commands run inside the network namespace netns, if given
+
+        Every command which takes the xtables lock waits for it as lock
+        describes, and records how long it waited there"""
+        if not lock:
+            lock = XtablesLock()
+
+        self._netns = netns
+        self.lock = lock
+
+    def _binary(self, binary):
+        if self._netns:
+            return ["ip", "netns", "exec", self._netns, binary]
+        return [binary]
+
     def exists(self, table, chain):
         if not table or not chain:
             Logger.fatal(f"Failed exists() in iptables, arguments table: "
@@ -53,6 +70,22 @@ class Iptables:
         else:
             return self._safe_command("-t", table, "-X", chain)
 
+    def chains(self, table):
+        """List the user defined chains of a table"""
+        if not table:
+            Logger.fatal(f"Failed chains() in iptables, arguments "
+                         f"table: {table}")
+        else:
+            output = self._output_command("-t", table, "-S")
+            if output is None:
+                return []
+
+            chains = []
+            for line in output.splitlines():
+                if line.startswith("-N "):
+                    chains.append(line.split()[1])
+            return chains
+
     # Rule operations
 
     def check_add(self, table, chain, args):
@@ -64,7 +97,8 @@ class Iptables:
             command += args
             return self._safe_command(*command)
 
-    def check_link(self, table, parent_chain, target_chain):
+    def check_link(self, table, parent_chain, target_chain, args=None):
+        """Links carry args, such as a tag, in front of the jump"""
         if not table or not parent_chain or not target_chain:
             Logger.fatal(f"Failed check_unlink() from iptables, arguments "
                          f"table: {table}, parent_chain: "
@@ -73,6 +107,7 @@ class Iptables:
             return self._safe_command(
                 "-t", table,
                 "-C", parent_chain,
+                *(args or []),
                 "-j", target_chain
             )
 
@@ -85,7 +120,26 @@ class Iptables:
             command += args
             return self._safe_command(*command)
 
-    def link(self, table, parent_chain, target_chain):
+    def insert(self, table, chain, args, position=1):
+        if not table or not chain or not args or position < 1:
+            Logger.fatal(f"Failed insert() to iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}, "
+                         f"position: {position}")
+        else:
+            command = ["-t", table, "-I", chain, str(position)]
+            command += args
+            return self._safe_command(*command)
+
+    def remove(self, table, chain, args):
+        if not table or not chain or not args:
+            Logger.fatal(f"Failed remove() from iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}")
+        else:
+            command = ["-t", table, "-D", chain]
+            command += args
+            return self._safe_command(*command)
+
+    def link(self, table, parent_chain, target_chain, args=None):
         if not table or not parent_chain or not target_chain:
             Logger.fatal(
                 f"Failed link() to iptables, arguments table: {table}, "
@@ -95,10 +149,11 @@ class Iptables:
             return self._safe_command(
                 "-t", table,
                 "-A", parent_chain,
+                *(args or []),
                 "-j", target_chain
             )
 
-    def unlink(self, table, parent_chain, target_chain):
+    def unlink(self, table, parent_chain, target_chain, args=None):
         if not table or not parent_chain or not target_chain:
             Logger.fatal(f"Failed unlink() from iptables, arguments "
                          f"table: {table}, parent_chain: "
@@ -107,49 +162,91 @@ class Iptables:
             return self._safe_command(
                 "-t", table,
                 "-D", parent_chain,
+                *(args or []),
                 "-j", target_chain
             )
 
+    # Batched operations
+
+    def restore(self, payload, test=False):
+        """Apply an iptables-restore payload in one process
+
+        Chains the payload does not mention are left alone"""
+        if not payload:
+            Logger.fatal(f"Failed restore() to iptables, payload: {payload}")
+        else:
+            command = [*self._binary("iptables-restore"),
+                       *self.lock.arguments(), "--noflush"]
+            if test:
+                command.append("--test")
+
+            Logger.d(f"Run iptables-restore: '{' '.join(command)}'")
+            Logger.d(payload)
+            result = self.lock.run(command, input=payload,
+                                   stdout=Iptables._get_output())
+            if result.returncode != 0:
+                Logger.d("iptables-restore command failed")
+                return False
+            return True
+
+    def validate(self, payload):
+        """Test an iptables-restore payload without applying it
+
+        Returns None if it passed, or the errors iptables-restore printed"""
+        if not payload:
+            Logger.fatal(f"Failed validate() in iptables, payload: {payload}")
+        else:
+            command = [*self._binary("iptables-restore"),
+                       *self.lock.arguments(), "--noflush", "--test"]
+            Logger.d(f"Run iptables-restore: '{' '.join(command)}'")
+            result = self.lock.run(command, input=payload,
+                                   stdout=subprocess.DEVNULL)
+            if result.returncode != 0:
+                return result.stderr or "iptables-restore failed"
+            return None
+
+    def save(self):
+        """Snapshot every table with a single iptables-save
+
+        iptables-save takes no -w, but still goes through the lock, so a
+        snapshot taken while the lock is held is retried and counted"""
+        Logger.d("Run iptables-save")
+        result = self.lock.run(self._binary("iptables-save"),
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            Logger.d("iptables-save command failed")
+            return None
+        return result.stdout
+
     @staticmethod
     def _get_output():
         """Get output level based on debugging mode"""
         return None if Logger.enabled else subprocess.DEVNULL
 
-    @staticmethod
-    def _run(args):
-        """Call subprocess command"""
-        output = Iptables._get_output()
-        if hasattr(subprocess, "run"):
-            Logger.d("subprocess.run exists, using it")
-            subprocess.run(
-                args,
-                check=True,
-                stdin=output,
-                stdout=output,
-                stderr=output
-            )
-        else:
-            Logger.d("subprocess.run does not exist, fallback to call")
-            subprocess.check_call(
-                args,
-                stdin=output,
-                stdout=output,
-                stderr=output
-            )
+    def _command(self, args):
+        return [*self._binary("iptables"), *self.lock.arguments(), *args]
 
-    @staticmethod
-    def _safe_command(*args):
-        try:
-            Logger.d(f"Run iptables command: '{' '.join(args)}'")
-
-            full_args = ["iptables"]
-            for arg in args:
-                full_args.append(arg)
-            Iptables._run(full_args)
-            return True
-        except subprocess.CalledProcessError as e:
+    def _output_command(self, *args):
+        """Run an iptables command and return its output, None on failure"""
+        Logger.d(f"Run iptables command: '{' '.join(args)}'")
+        result = self.lock.run(self._command(args),
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            Logger.d("iptables command failed")
+            return None
+        return result.stdout
+
+    def _safe_command(self, *args):
+        Logger.d(f"Run iptables command: '{' '.join(args)}'")
+        output = Iptables._get_output()
+        result = self.lock.run(self._command(args),
+                               stdin=output, stdout=output)
+        if result.returncode != 0:
             # We ignore the error here since this will fail if the
-            # chain does not exist, and its too noisy
+            # chain does not exist, and its too noisy. The lock never
+            # gets here, it is retried or fatal.
             Logger.d("iptables command failed")
-            Logger.d(e)
             return False
+        return True
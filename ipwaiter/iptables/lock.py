@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import math
+import random
+import subprocess
+import threading
+import time
+
+from ..logger.logger import Logger
+
+
+class XtablesLock:
+    """Seconds iptables itself waits for the lock, with -w"""
+    DEFAULT_TIMEOUT = 10
+
+    """Exit status of iptables when a resource, such as the lock, is busy"""
+    RESOURCE_PROBLEM = 4
+
+    """Printed by iptables while the lock is held, or when it gave up"""
+    LOCK_MESSAGES = ("xtables lock", "Another app is currently holding")
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=5, backoff=0.2,
+                 max_backoff=5.0):
+        """Wait up to timeout seconds for the lock on every attempt, then
+        retry up to retries times, with exponential backoff in between"""
+        if timeout < 0 or retries < 0 or backoff < 0:
+            Logger.fatal(f"Invalid xtables lock settings, timeout: "
+                         f"{timeout}, retries: {retries}, backoff: {backoff}")
+
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._mutex = threading.Lock()
+
+        self.commands = 0
+        self.contended = 0
+        self.retries = 0
+        self.failures = 0
+        self.waited = 0.0
+
+    def arguments(self):
+        """Arguments making iptables wait for the lock instead of failing"""
+        if not self._timeout:
+            return []
+        return ["-w", str(math.ceil(self._timeout))]
+
+    @staticmethod
+    def waited_on_lock(stderr):
+        return any(message in (stderr or "")
+                   for message in XtablesLock.LOCK_MESSAGES)
+
+    @staticmethod
+    def is_lock_error(returncode, stderr):
+        """Other busy resources exit with the same status, so only one
+        which names the lock is contention worth retrying"""
+        return (returncode == XtablesLock.RESOURCE_PROBLEM
+                and XtablesLock.waited_on_lock(stderr))
+
+    def run(self, command, **kwargs):
+        """Run a command, retrying while the lock is held by someone else
+
+        A command which still could not take the lock is fatal, so lock
+        contention is never mistaken for a negative answer"""
+        backoff = self._backoff
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            result = subprocess.run(command, stderr=subprocess.PIPE,
+                                    universal_newlines=True, **kwargs)
+            elapsed = time.monotonic() - start
+            if result.stderr:
+                Logger.d(result.stderr.rstrip())
+
+            with self._mutex:
+                self.commands += 1
+                if XtablesLock.waited_on_lock(result.stderr):
+                    # Whatever the outcome, this attempt waited on the lock
+                    self.contended += 1
+                    self.waited += elapsed
+
+            if not XtablesLock.is_lock_error(result.returncode,
+                                             result.stderr):
+                return result
+
+            if attempt >= self._retries:
+                with self._mutex:
+                    self.failures += 1
+                Logger.fatal(f"Gave up waiting for the xtables lock after "
+                             f"{attempt + 1} attempts: {' '.join(command)}")
+
+            # Jitter keeps several waiting processes from retrying together
+            delay = backoff * random.uniform(0.5, 1.0)
+            Logger.d(f"xtables lock is held, retrying in {delay:.2f}s")
+            time.sleep(delay)
+            backoff = min(backoff * 2, self._max_backoff)
+            attempt += 1
+            with self._mutex:
+                self.retries += 1
+                self.waited += delay
+
+    def summary(self):
+        return (f"xtables lock: {self.commands} commands, "
+                f"{self.contended} contended, {self.retries} retries, "
+                f"{self.waited:.3f}s waited")
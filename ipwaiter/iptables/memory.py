@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import copy
+import functools
+import shlex
+
+from ..logger.logger import Logger
+from .canonical import Canonical
+from .restore import Restore
+
+
+class MemoryIptables:
+    """Built in chains of every table, with their policy"""
+    BUILTIN_CHAINS = {
+        "filter": ["INPUT", "FORWARD", "OUTPUT"],
+        "raw": ["PREROUTING", "OUTPUT"],
+        "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+        "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+        "security": ["INPUT", "FORWARD", "OUTPUT"],
+    }
+
+    """Policies a builtin chain can have"""
+    POLICIES = ["ACCEPT", "DROP"]
+
+    """Longest chain name the kernel accepts"""
+    MAX_CHAIN_LENGTH = 28
+
+    def __init__(self):
+        """An in memory model of iptables, implementing Iptables
+
+        Every operation is counted in operations, by name"""
+        self.operations = collections.Counter()
+        self._tables = {}
+        self._policies = {}
+        for (table, chains) in MemoryIptables.BUILTIN_CHAINS.items():
+            self._tables[table] = {chain: [] for chain in chains}
+            self._policies[table] = {chain: "ACCEPT" for chain in chains}
+
+    def _chains(self, table):
+        chains = self._tables.get(table)
+        if chains is None:
+            Logger.fatal(f"Unknown table: {table}")
+        return chains
+
+    @staticmethod
+    def _is_builtin(table, chain):
+        return chain in MemoryIptables.BUILTIN_CHAINS.get(table, [])
+
+    @staticmethod
+    def _target(args):
+        for (index, arg) in enumerate(args[:-1]):
+            if arg in ["-j", "--jump", "-g", "--goto"]:
+                return args[index + 1]
+        return None
+
+    def _valid_rule(self, chains, args):
+        """A jump must name a chain, or an extension target
+
+        Extension targets are told apart by their upper case names, which
+        is how every target shipped with iptables is spelled"""
+        target = MemoryIptables._target(args)
+        if not target or target in chains:
+            return True
+        return target.isupper()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _canonical(rule):
+        return Canonical.rule(rule)
+
+    @staticmethod
+    def _find(rules, args):
+        """Index of the rule equal to args, or None
+
+        Rules compare as iptables-save prints them, so a rule loaded from
+        iptables-save is found by the arguments it was compiled from"""
+        wanted = MemoryIptables._canonical(tuple(args))
+        for (index, rule) in enumerate(rules):
+            if MemoryIptables._canonical(rule) == wanted:
+                return index
+        return None
+
+    def _references(self, chains, chain):
+        return any(MemoryIptables._target(list(rule)) == chain
+                   for rules in chains.values() for rule in rules)
+
+    # Chain operations
+
+    def exists(self, table, chain):
+        if not table or not chain:
+            Logger.fatal(f"Failed exists() in iptables, arguments table: "
+                         f"{table}, chain: {chain}")
+        self.operations["exists"] += 1
+        return chain in self._chains(table)
+
+    def create(self, table, chain):
+        if not table or not chain:
+            Logger.fatal(f"Failed create() iptables, arguments table: "
+                         f"{table}, chain: {chain}")
+        self.operations["create"] += 1
+        return self._create(self._chains(table), chain)
+
+    @staticmethod
+    def _create(chains, chain):
+        if chain in chains or len(chain) > MemoryIptables.MAX_CHAIN_LENGTH:
+            return False
+        chains[chain] = []
+        return True
+
+    def flush(self, table, chain):
+        if not table or not chain:
+            Logger.fatal("Failed flush() iptables, arguments table: "
+                         f"{table}, chain: {chain}")
+        self.operations["flush"] += 1
+        return self._flush(self._chains(table), chain)
+
+    @staticmethod
+    def _flush(chains, chain):
+        if chain not in chains:
+            return False
+        chains[chain] = []
+        return True
+
+    def delete(self, table, chain):
+        if not table or not chain:
+            Logger.fatal(f"Failed delete() from iptables, arguments "
+                         f"table: {table}, chain: {chain}")
+        self.operations["delete"] += 1
+        return self._delete(table, self._chains(table), chain)
+
+    def _delete(self, table, chains, chain):
+        if (chain not in chains or MemoryIptables._is_builtin(table, chain)
+                or chains[chain] or self._references(chains, chain)):
+            return False
+        del chains[chain]
+        return True
+
+    def chains(self, table):
+        """List the user defined chains of a table"""
+        if not table:
+            Logger.fatal(f"Failed chains() in iptables, arguments "
+                         f"table: {table}")
+        self.operations["chains"] += 1
+        return [chain for chain in self._chains(table)
+                if not MemoryIptables._is_builtin(table, chain)]
+
+    # Rule operations
+
+    def check_add(self, table, chain, args):
+        if not table or not chain or not args:
+            Logger.fatal(f"Failed check_add() on iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}")
+        self.operations["check_add"] += 1
+        rules = self._chains(table).get(chain, [])
+        return MemoryIptables._find(rules, args) is not None
+
+    def check_link(self, table, parent_chain, target_chain, args=None):
+        if not table or not parent_chain or not target_chain:
+            Logger.fatal(f"Failed check_unlink() from iptables, arguments "
+                         f"table: {table}, parent_chain: "
+                         f"{parent_chain}, target_chain: {target_chain}")
+        self.operations["check_link"] += 1
+        rules = self._chains(table).get(parent_chain, [])
+        link = [*(args or []), "-j", target_chain]
+        return MemoryIptables._find(rules, link) is not None
+
+    def add(self, table, chain, args):
+        if not table or not chain or not args:
+            Logger.fatal(f"Failed add() to iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}")
+        self.operations["add"] += 1
+        return self._insert(self._chains(table), chain, args, None)
+
+    def _insert(self, chains, chain, args, position):
+        if chain not in chains or not self._valid_rule(chains, args):
+            return False
+
+        rules = chains[chain]
+        if position is None:
+            rules.append(tuple(args))
+        elif 1 <= position <= len(rules) + 1:
+            rules.insert(position - 1, tuple(args))
+        else:
+            return False
+        return True
+
+    def insert(self, table, chain, args, position=1):
+        if not table or not chain or not args or position < 1:
+            Logger.fatal(f"Failed insert() to iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}, "
+                         f"position: {position}")
+        self.operations["insert"] += 1
+        return self._insert(self._chains(table), chain, args, position)
+
+    def remove(self, table, chain, args):
+        if not table or not chain or not args:
+            Logger.fatal(f"Failed remove() from iptables, arguments "
+                         f"table: {table}, chain: {chain}, args: {args}")
+        self.operations["remove"] += 1
+        return self._remove(self._chains(table), chain, args)
+
+    @staticmethod
+    def _remove(chains, chain, args):
+        rules = chains.get(chain)
+        index = None if rules is None else MemoryIptables._find(rules, args)
+        if index is None:
+            return False
+        del rules[index]
+        return True
+
+    def link(self, table, parent_chain, target_chain, args=None):
+        if not table or not parent_chain or not target_chain:
+            Logger.fatal(
+                f"Failed link() to iptables, arguments table: {table}, "
+                f"parent_chain: {parent_chain}, "
+                f"target_chain: {target_chain}")
+        self.operations["link"] += 1
+        return self._insert(self._chains(table), parent_chain,
+                            [*(args or []), "-j", target_chain], None)
+
+    def unlink(self, table, parent_chain, target_chain, args=None):
+        if not table or not parent_chain or not target_chain:
+            Logger.fatal(f"Failed unlink() from iptables, arguments "
+                         f"table: {table}, parent_chain: "
+                         f"{parent_chain}, target_chain: {target_chain}")
+        self.operations["unlink"] += 1
+        return self._remove(self._chains(table), parent_chain,
+                            [*(args or []), "-j", target_chain])
+
+    # Batched operations
+
+    def _apply_line(self, table, chains, policies, line):
+        """Apply a single restore line to a staged copy of a table, and of
+        its policies"""
+        if line.startswith(":"):
+            words = line[1:].split()
+            chain = words[0]
+            if MemoryIptables._is_builtin(table, chain):
+                # A builtin chain keeps its rules, and "-" its policy
+                policy = words[1] if len(words) > 1 else "-"
+                if policy == "-":
+                    return True
+                if policy not in MemoryIptables.POLICIES:
+                    return False
+                policies[chain] = policy
+                return True
+            # Declaring a chain creates it, or flushes it with --noflush
+            if chain in chains:
+                return MemoryIptables._flush(chains, chain)
+            return MemoryIptables._create(chains, chain)
+
+        args = shlex.split(line)
+        if len(args) < 2:
+            return False
+
+        command, chain, rest = args[0], args[1], args[2:]
+        if command in ["-A", "--append"]:
+            return self._insert(chains, chain, rest, None)
+        if command in ["-I", "--insert"]:
+            position = 1
+            if rest and rest[0].isdigit():
+                position = int(rest[0])
+                rest = rest[1:]
+            return self._insert(chains, chain, rest, position)
+        if command in ["-D", "--delete"]:
+            return MemoryIptables._remove(chains, chain, rest)
+        if command in ["-F", "--flush"]:
+            return MemoryIptables._flush(chains, chain)
+        if command in ["-N", "--new-chain"]:
+            return MemoryIptables._create(chains, chain)
+        if command in ["-X", "--delete-chain"]:
+            return self._delete(table, chains, chain)
+        return False
+
+    def restore(self, payload, test=False):
+        """Apply an iptables-restore --noflush payload
+
+        Like iptables-restore, every table is committed on its own, and
+        a table with a failing line is left as it was"""
+        if not payload:
+            Logger.fatal(f"Failed restore() to iptables, payload: {payload}")
+        self.operations["restore"] += 1
+        return self._restore(payload, test) is None
+
+    def validate(self, payload):
+        """Test a payload without applying it, None if it passed"""
+        if not payload:
+            Logger.fatal(f"Failed validate() in iptables, payload: {payload}")
+        self.operations["validate"] += 1
+        number = self._restore(payload, test=True)
+        return None if number is None else f"Error occurred at line: {number}"
+
+    def _restore(self, payload, test):
+        """Returns the number of the failing line, or None"""
+        table = None
+        staged = None
+        policies = None
+        number = 0
+        for (number, line) in enumerate(payload.splitlines(), start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            if line.startswith("*"):
+                table = line[1:]
+                staged = copy.deepcopy(self._chains(table))
+                policies = dict(self._policies[table])
+            elif staged is None:
+                Logger.d(f"Restore line {number} is outside of a table")
+                return number
+            elif line == "COMMIT":
+                if not test:
+                    self._tables[table] = staged
+                    self._policies[table] = policies
+                table = None
+                staged = None
+                policies = None
+            elif not self._apply_line(table, staged, policies, line):
+                Logger.d(f"Restore failed at line {number}: {line}")
+                return number
+
+        return None if staged is None else number
+
+    def save(self):
+        """Export every table in the iptables-save format"""
+        self.operations["save"] += 1
+        lines = ["# Generated by ipwaiter"]
+        for (table, chains) in self._tables.items():
+            lines.append(f"*{table}")
+            for chain in chains:
+                if MemoryIptables._is_builtin(table, chain):
+                    policy = self._policies[table][chain]
+                    lines.append(f":{chain} {policy} [0:0]")
+                else:
+                    lines.append(f":{chain} - [0:0]")
+            for (chain, rules) in chains.items():
+                for rule in rules:
+                    lines.append(Restore.rule(chain, list(rule)))
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def load(self, text):
+        """Replace every table with the output of iptables-save
+
+        iptables-save declares every chain of a table before its rules, so
+        the text restores as it is over freshly reset tables"""
+        for (table, builtin) in MemoryIptables.BUILTIN_CHAINS.items():
+            self._tables[table] = {chain: [] for chain in builtin}
+            self._policies[table] = {chain: "ACCEPT" for chain in builtin}
+
+        if text.strip() and not self.restore(text):
+            Logger.fatal("Failed to load iptables-save output")
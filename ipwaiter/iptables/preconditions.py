@@ -24,11 +24,26 @@ import os
 import ipwaiter.utils as utils
 
 from ..logger.logger import Logger
+from .tags import Tags
 
 
 class Preconditions:
-
-    def __init__(self, iptables, order_dirs, raw):
+    """Filter parent chains, which can carry the conntrack prelude"""
+    FILTER_CHAINS = ["input", "forward", "output"]
+
+    """Raw parent chains"""
+    RAW_CHAINS = ["output", "prerouting"]
+
+    """Rules pinned to the top of a parent chain, so established flows
+    never walk the order chains"""
+    PRELUDE_RULES = [
+        Tags.tag("prelude", ["-m", "conntrack", "--ctstate",
+                             "ESTABLISHED,RELATED", "-j", "ACCEPT"]),
+        Tags.tag("prelude", ["-m", "conntrack", "--ctstate", "INVALID",
+                             "-j", "DROP"]),
+    ]
+
+    def __init__(self, iptables, order_dirs, raw, prelude=None):
         for order_dir in order_dirs:
             if not os.path.isdir(order_dir):
                 Logger.fatal(f"Invalid order directory: {order_dir}")
@@ -36,14 +51,24 @@ class Preconditions:
         if not iptables:
             Logger.fatal(f"Invalid iptables handler given: {iptables}")
 
+        if not prelude:
+            prelude = []
+
+        for chain in prelude:
+            if chain.lower() not in Preconditions.FILTER_CHAINS:
+                Logger.fatal(f"Invalid conntrack prelude chain: {chain}")
+
         self._iptables = iptables
         self._order_dirs = order_dirs
         self._raw = raw
+        self._prelude = [f"{chain.lower()}_orders" for chain in prelude]
 
     def create_chains_if_needed(self):
         if self._raw:
             if not self._iptables.exists("raw", "output_orders"):
                 self._iptables.create("raw", "output_orders")
+            if not self._iptables.exists("raw", "prerouting_orders"):
+                self._iptables.create("raw", "prerouting_orders")
         else:
             if not self._iptables.exists("filter", "input_orders"):
                 self._iptables.create("filter", "input_orders")
@@ -51,6 +76,33 @@ class Preconditions:
                 self._iptables.create("filter", "forward_orders")
             if not self._iptables.exists("filter", "output_orders"):
                 self._iptables.create("filter", "output_orders")
+            self.pin_prelude()
+
+    def pin_prelude(self):
+        """Install or remove the conntrack prelude in the filter parents"""
+        if self._raw:
+            return
+
+        for chain in Preconditions.FILTER_CHAINS:
+            parent = f"{chain}_orders"
+            wanted = parent in self._prelude
+
+            # Nothing to pin in a chain which was never created
+            if wanted and not self._iptables.exists("filter", parent):
+                continue
+
+            rules = enumerate(Preconditions.PRELUDE_RULES, start=1)
+            for position, rule in rules:
+                present = self._iptables.check_add("filter", parent, rule)
+                if wanted and not present:
+                    # Insert by position so the prelude stays above
+                    # any order already linked into the parent
+                    if not self._iptables.insert("filter", parent,
+                                                 rule, position):
+                        Logger.fatal(f"Failed to pin prelude in chain: "
+                                     f"{parent}, rule: {rule}")
+                elif present and not wanted:
+                    self._iptables.remove("filter", parent, rule)
 
     def valid_chain(self, chain):
         if not chain:
@@ -62,7 +114,7 @@ class Preconditions:
         # Transform the real chain name
         chain = f"{chain.lower()}_orders"
         if self._raw:
-            return chain if uppercase in ["OUTPUT"] else ""
+            return chain if uppercase in ["OUTPUT", "PREROUTING"] else ""
         else:
             return chain if uppercase in ["INPUT", "FORWARD", "OUTPUT"] else ""
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from .snapshot import Snapshot
+
+
+class Restore:
+
+    def __init__(self):
+        """Restore is purely a static implementation, no class instances"""
+        raise NotImplementedError("No instances of Restore allowed")
+
+    @staticmethod
+    def quote(arg):
+        """Quote an argument the way iptables-restore splits lines"""
+        if arg and not any(c.isspace() or c in "\"\\'" for c in arg):
+            return arg
+
+        escaped = arg.replace("\\", "\\\\").replace("\"", "\\\"")
+        return f"\"{escaped}\""
+
+    @staticmethod
+    def rule(chain, args):
+        return " ".join(["-A", chain, *[Restore.quote(arg) for arg in args]])
+
+    @staticmethod
+    def payload(ruleset, only=None):
+        """Build an iptables-restore --noflush payload from a ruleset
+
+        Every chain is declared, which creates it or flushes it, and then
+        filled. If only is given, it maps each table to the chains to
+        include, and the rest of the ruleset is left alone."""
+        lines = []
+        for (table, chains) in ruleset.items():
+            if only is not None:
+                chains = {chain: rules for (chain, rules) in chains.items()
+                          if chain in only.get(table, [])}
+            if not chains:
+                continue
+
+            lines.append(f"*{table}")
+            for chain in chains:
+                lines.append(f":{chain} - [0:0]")
+            for (chain, rules) in chains.items():
+                for args in rules:
+                    lines.append(Restore.rule(chain, args))
+            lines.append("COMMIT")
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+    @staticmethod
+    def diff(before, after):
+        """Build an iptables-restore --noflush payload from two snapshots
+
+        Only the owned chains which differ are declared and filled again,
+        owned chains missing from after are flushed and then deleted."""
+        lines = []
+        for table in sorted(set(before.tables) | set(after.tables)):
+            old = before.tables.get(table, {})
+            new = after.tables.get(table, {})
+
+            changed = [chain for chain in new if Snapshot.is_owned(chain)
+                       and old.get(chain) != new[chain]]
+            removed = [chain for chain in old if Snapshot.is_owned(chain)
+                       and chain not in new]
+            if not changed and not removed:
+                continue
+
+            lines.append(f"*{table}")
+            for chain in changed + removed:
+                lines.append(f":{chain} - [0:0]")
+            for chain in changed:
+                for rule in new[chain]:
+                    lines.append(f"-A {chain} {rule}")
+            for chain in removed:
+                lines.append(f"-X {chain}")
+            lines.append("COMMIT")
+
+        return "\n".join(lines) + "\n" if lines else ""
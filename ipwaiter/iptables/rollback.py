@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import time
+
+from ..logger.logger import Logger
+from .restore import Restore
+from .snapshot import Snapshot
+
+
+class Rollback:
+
+    def __init__(self, iptables):
+        """Put the owned chains back as they were, if a change fails
+
+        Used as a context manager, the owned chains are snapshot on entry
+        and restored on any exception, with one save and one restore."""
+        self._iptables = iptables
+        self._snapshot = None
+
+    def __enter__(self):
+        saved = self._iptables.save()
+        if saved is None:
+            Logger.fatal("Unable to snapshot the owned chains")
+        self._snapshot = Snapshot.parse(saved)
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if kind is not None:
+            self.restore()
+        return False
+
+    def restore(self):
+        """Restore the snapshot, returns True if the tables match it"""
+        started = time.monotonic()
+        saved = self._iptables.save()
+        if saved is None:
+            Logger.log("Rollback failed, unable to read the current tables")
+            return False
+
+        payload = Restore.diff(Snapshot.parse(saved), self._snapshot)
+        if not payload:
+            return True
+
+        Logger.d(f"Rollback payload:\n{payload}")
+        if not self._iptables.restore(payload):
+            Logger.log("Rollback failed, the owned chains may be partial")
+            return False
+
+        Logger.log(f"Rolled back the owned chains in "
+                   f"{time.monotonic() - started:.3f}s")
+        return True
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import re
+
+from .canonical import Canonical
+from .tags import Tags
+
+
+class Snapshot:
+    """Chains ipwaiter owns: order chains, parents, dispatch chains and
+    the staged parents and dispatch chains of every profile"""
+    OWNED = re.compile(r"^(order_.+|[a-z]+_orders(_[a-z0-9]+)?"
+                       r"|p_[a-z0-9]+_[a-z]+(_[a-z0-9]+)?)$")
+
+    def __init__(self, tables):
+        """Tables map each chain to its rules, as iptables-save prints them"""
+        self.tables = tables
+        self._index = None
+
+    @staticmethod
+    def is_owned(chain):
+        return Snapshot.OWNED.match(chain) is not None
+
+    @staticmethod
+    def parse(text):
+        """Parse the output of iptables-save"""
+        tables = {}
+        chains = None
+        for line in text.splitlines():
+            if not line or line.startswith("#") or line == "COMMIT":
+                continue
+
+            if line.startswith("*"):
+                chains = tables.setdefault(line[1:], {})
+            elif chains is None:
+                continue
+            elif line.startswith(":"):
+                chains.setdefault(line[1:].split()[0], [])
+            elif line.startswith("-A "):
+                _, chain, *rest = line.split(" ", 2)
+                chains.setdefault(chain, []).append(rest[0] if rest else "")
+
+        return Snapshot(tables)
+
+    def rules(self, table, chain):
+        """Rules of a chain, or None if the chain does not exist"""
+        return self.tables.get(table, {}).get(chain)
+
+    def owned(self):
+        """Every (table, chain) owned by ipwaiter"""
+        return [(table, chain) for (table, chains) in self.tables.items()
+                for chain in chains if Snapshot.is_owned(chain)]
+
+    def index(self):
+        """Map the hash of every tagged rule to (owner, table, chain, rule)
+
+        Built once, so every later lookup is a single dictionary access"""
+        if self._index is None:
+            self._index = {}
+            for (table, chains) in self.tables.items():
+                for (chain, rules) in chains.items():
+                    for rule in rules:
+                        tag = Tags.parse(rule)
+                        if tag:
+                            owner, rule_hash = tag
+                            self._index[rule_hash] = (owner, table,
+                                                      chain, rule)
+        return self._index
+
+    def digest(self, table, chain):
+        """Digest of the rules of a chain, or None if it does not exist"""
+        rules = self.rules(table, chain)
+        if rules is None:
+            return None
+
+        return hashlib.sha256("\n".join(rules).encode("utf-8")).hexdigest()
+
+    def canonical_digest(self, table, chain):
+        """Digest of the canonical rules of a chain, equal to the digest of
+        the compiled rules it was restored from, or None if it does not exist
+        """
+        rules = self.rules(table, chain)
+        if rules is None:
+            return None
+
+        return Canonical.digest(Canonical.saved(rule) for rule in rules)
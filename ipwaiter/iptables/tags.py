@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import re
+
+
+class Tags:
+
+    """Every tag starts with this, so owned rules are found by comment"""
+    PREFIX = "ipwaiter"
+
+    """Hex digits of a rule hash"""
+    HASH_LENGTH = 12
+
+    """A tag, as iptables-save prints it"""
+    PATTERN = re.compile(r"--comment \"?ipwaiter:([^:\" ]+):([0-9a-f]+)\"?")
+
+    def __init__(self):
+        """Tags is purely a static implementation, no class instances"""
+        raise NotImplementedError("No instances of Tags allowed")
+
+    @staticmethod
+    def rule_hash(owner, args, occurrence=0):
+        """Hash of a rule, occurrence tells identical rules of an owner
+        apart"""
+        text = "\0".join([owner, str(occurrence), *args])
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return digest[:Tags.HASH_LENGTH]
+
+    @staticmethod
+    def matches(owner, rule_hash):
+        """The comment match carrying a tag"""
+        return ["-m", "comment", "--comment",
+                f"{Tags.PREFIX}:{owner}:{rule_hash}"]
+
+    @staticmethod
+    def tag(owner, args, occurrence=0):
+        """A rule with its ownership tag in front"""
+        return [*Tags.matches(owner, Tags.rule_hash(owner, args, occurrence)),
+                *args]
+
+    @staticmethod
+    def owner(chain):
+        """The order owning a chain, or the chain itself"""
+        return chain[len("order_"):] if chain.startswith("order_") else chain
+
+    @staticmethod
+    def link_matches(chain):
+        """The tag of a jump to chain, owned by the order of the chain"""
+        owner = Tags.owner(chain)
+        return Tags.matches(owner, Tags.rule_hash(owner, ["-j", chain]))
+
+    @staticmethod
+    def link(chain):
+        return [*Tags.link_matches(chain), "-j", chain]
+
+    @staticmethod
+    def parse(rule):
+        """The (owner, rule hash) of a rule string, or None if untagged"""
+        match = Tags.PATTERN.search(rule)
+        return (match.group(1), match.group(2)) if match else None
@@ -19,36 +19,70 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import contextlib
 import sys
+import threading
+
+
+class FatalError(Exception):
+    """Raised by Logger.fatal, the command line exits on it"""
 
 
 class Logger:
     """Static flag controlling whether the logger should output or not"""
     enabled = False
 
+    """Per thread state, holding the tag prefixed to its messages"""
+    _local = threading.local()
+
     def __init__(self):
         """Logger is purely a static implementation, no class instances"""
         raise NotImplementedError("No instances of Logger allowed")
 
+    @staticmethod
+    def tag(name):
+        """Prefix messages logged from the current thread with a tag"""
+        Logger._local.tag = name
+
+    @staticmethod
+    def _prefix():
+        tag = getattr(Logger._local, "tag", None)
+        return f"[{tag}] " if tag else ""
+
+    @staticmethod
+    @contextlib.contextmanager
+    def redirected(output):
+        """Log messages of the current thread to output instead of stdout"""
+        previous = getattr(Logger._local, "output", None)
+        Logger._local.output = output
+        try:
+            yield
+        finally:
+            Logger._local.output = previous
+
     @staticmethod
     def log(message, *args, **kwargs):
         """Log a message to stdout without needing debug mode"""
-        print(f"{message}", *args, **kwargs, file=sys.stdout)
+        print(f"{Logger._prefix()}{message}", *args, **kwargs,
+              file=getattr(Logger._local, "output", None) or sys.stdout)
 
     @staticmethod
     def d(message, *args, **kwargs):
         """Log a message to stdout if debug mode is on"""
         if Logger.enabled:
-            print(f"DEBUG  {message}", *args, **kwargs, file=sys.stderr)
+            print(f"DEBUG  {Logger._prefix()}{message}", *args, **kwargs,
+                  file=sys.stderr)
 
     @staticmethod
     def e(message, *args, **kwargs):
         """Log an error message to stderr if debug mode is on"""
         if Logger.enabled:
-            print(f"ERROR  {message}", *args, **kwargs, file=sys.stderr)
+            print(f"ERROR  {Logger._prefix()}{message}", *args, **kwargs,
+                  file=sys.stderr)
 
     @staticmethod
-    def fatal(message, *args, **kwargs):
-        """Log an error message to stderr and exit"""
-        print(f"FATAL  {message}", *args, **kwargs, file=sys.stderr)
-        sys.exit(1)
+    def fatal(message):
+        """Stop with an error, leaving the caller to report it
+
+        Library code never exits, embedding callers catch FatalError"""
+        raise FatalError(f"{Logger._prefix()}{message}")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import ipaddress
+import socket
+import struct
+
+from ..logger.logger import Logger
+
+
+class Addresses:
+    """rtnetlink message types, flags and groups, from linux/rtnetlink.h"""
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    RTM_GETADDR = 22
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+    RTMGRP_IPV4_IFADDR = 0x10
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    IFA_LABEL = 3
+
+    """struct nlmsghdr, struct ifaddrmsg and struct rtattr"""
+    HEADER = struct.Struct("=LHHLL")
+    IFADDR = struct.Struct("=BBBBI")
+    ATTR = struct.Struct("=HH")
+
+    def __init__(self):
+        """IPv4 addresses of the interfaces, read and followed over
+        rtnetlink, without calling out to ip(8)"""
+        self._socket = None
+        self._sequence = 0
+
+    @staticmethod
+    def _align(length):
+        return (length + 3) & ~3
+
+    @staticmethod
+    def _messages(data):
+        """Yield (type, payload) of every message in data"""
+        offset = 0
+        while offset + Addresses.HEADER.size <= len(data):
+            (length, kind, _, _, _) = Addresses.HEADER.unpack_from(data,
+                                                                   offset)
+            if length < Addresses.HEADER.size:
+                break
+            yield kind, data[offset + Addresses.HEADER.size:offset + length]
+            offset += Addresses._align(length)
+
+    @staticmethod
+    def _address(payload):
+        """(interface, IPv4Interface) of an ifaddrmsg, or None"""
+        (family, prefix, _, _, index) = Addresses.IFADDR.unpack_from(payload)
+        if family != socket.AF_INET:
+            return None
+
+        attrs = {}
+        offset = Addresses.IFADDR.size
+        while offset + Addresses.ATTR.size <= len(payload):
+            (length, kind) = Addresses.ATTR.unpack_from(payload, offset)
+            if length < Addresses.ATTR.size:
+                break
+            attrs[kind] = payload[offset + Addresses.ATTR.size:
+                                  offset + length]
+            offset += Addresses._align(length)
+
+        # IFA_LOCAL is our end of a point to point link, when there is one
+        address = attrs.get(Addresses.IFA_LOCAL,
+                            attrs.get(Addresses.IFA_ADDRESS))
+        if not address:
+            return None
+
+        if Addresses.IFA_LABEL in attrs:
+            name = attrs[Addresses.IFA_LABEL].split(b"\0", 1)[0].decode()
+        else:
+            try:
+                name = socket.if_indextoname(index)
+            except OSError:
+                return None
+
+        # Alias labels, such as eth0:1, still belong to the interface
+        name = name.split(":", 1)[0]
+        address = ipaddress.ip_address(address)
+        return name, ipaddress.ip_interface(f"{address}/{prefix}")
+
+    def _open(self, groups):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 socket.NETLINK_ROUTE)
+            sock.bind((0, groups))
+        except (OSError, AttributeError) as e:
+            Logger.fatal(f"Unable to open rtnetlink: {e}")
+        return sock
+
+    def dump(self):
+        """{interface: [IPv4Interface]} of every address the kernel has"""
+        sock = self._open(0)
+        addresses = {}
+        with sock:
+            self._sequence += 1
+            request = Addresses.IFADDR.pack(socket.AF_INET, 0, 0, 0, 0)
+            header = Addresses.HEADER.pack(
+                Addresses.HEADER.size + len(request), Addresses.RTM_GETADDR,
+                Addresses.NLM_F_REQUEST | Addresses.NLM_F_DUMP,
+                self._sequence, 0)
+            sock.sendall(header + request)
+
+            while True:
+                data = sock.recv(65536)
+                for (kind, payload) in Addresses._messages(data):
+                    if kind == Addresses.NLMSG_DONE:
+                        return addresses
+                    if kind == Addresses.NLMSG_ERROR:
+                        Logger.fatal("rtnetlink refused to list addresses")
+                    if kind != Addresses.RTM_NEWADDR:
+                        continue
+
+                    address = Addresses._address(payload)
+                    if address:
+                        addresses.setdefault(address[0], []).append(
+                            address[1])
+
+    def subscribe(self):
+        """Follow IPv4 address events, read them back with changed()"""
+        if self._socket is None:
+            self._socket = self._open(Addresses.RTMGRP_IPV4_IFADDR)
+            self._socket.setblocking(False)
+
+    def fileno(self):
+        """Readable once an address event waits, for select()"""
+        return self._socket.fileno()
+
+    def changed(self):
+        """Interfaces whose addresses changed since the last call"""
+        interfaces = set()
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except BlockingIOError:
+                return interfaces
+            except OSError as e:
+                # Events were dropped, so any interface may have changed
+                Logger.log(f"Lost rtnetlink address events: {e}")
+                interfaces.add(None)
+                return interfaces
+
+            for (kind, payload) in Addresses._messages(data):
+                if kind in [Addresses.RTM_NEWADDR, Addresses.RTM_DELADDR]:
+                    address = Addresses._address(payload)
+                    if address:
+                        interfaces.add(address[0])
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import concurrent.futures
+import subprocess
+import time
+
+from ..iptables.iptables import Iptables
+from ..iptables.lock import XtablesLock
+from ..iptables.rollback import Rollback
+from ..ipset.ipset import Ipset
+from ..logger.logger import Logger
+from ..nftables.nftables import Nftables
+from ..orders.compiler import Compiler
+from ..orders.waiter import Waiter
+
+
+class Netns:
+
+    def __init__(self):
+        """Netns is purely a static implementation, no class instances"""
+        raise NotImplementedError("No instances of Netns allowed")
+
+    @staticmethod
+    def list_all():
+        """Names of every network namespace known to ip netns"""
+        try:
+            output = subprocess.check_output(
+                ["ip", "netns", "list"],
+                stdin=subprocess.DEVNULL,
+                universal_newlines=True
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            Logger.fatal(f"Unable to list network namespaces: {e}")
+
+        # Lines look like 'name (id: 3)' once a namespace has an id
+        return [line.split()[0] for line in output.splitlines()
+                if line.strip()]
+
+
+class NamespaceRunner:
+    """Actions which can be applied across namespaces"""
+    ACTIONS = ["hire", "fire", "teardown", "rehire"]
+
+    def __init__(self, order_dirs, system_conf, jobs, lock=None):
+        if jobs < 1:
+            Logger.fatal(f"Invalid number of jobs: {jobs}")
+
+        # The xtables lock lives in /run, which every namespace shares
+        if not lock:
+            lock = XtablesLock()
+
+        self._order_dirs = order_dirs
+        self._system_conf = system_conf
+        self._jobs = jobs
+        self._lock = lock
+
+        # Shared by every namespace, so orders are only read once
+        self._compiler = Compiler(order_dirs, system_conf)
+
+    def _apply(self, netns, action, opts, report):
+        Logger.tag(netns)
+        try:
+            started = time.monotonic()
+            iptables = Iptables(netns=netns, lock=self._lock)
+            waiter = Waiter(iptables, self._order_dirs, self._system_conf,
+                            self._compiler, Ipset(netns=netns),
+                            Nftables(netns=netns))
+            with Rollback(iptables):
+                if action == "hire":
+                    waiter.hire_waiter(opts=opts, report=report)
+                elif action == "rehire":
+                    waiter.rehire_waiter(opts=opts, report=report)
+                else:
+                    waiter.fire_waiter(destroy=(action == "teardown"),
+                                       report=report)
+            return time.monotonic() - started
+        finally:
+            Logger.tag(None)
+
+    def run(self, namespaces, action, opts, report):
+        """Apply an action to every namespace, returns True if all passed"""
+        if action not in NamespaceRunner.ACTIONS:
+            Logger.fatal(f"Invalid namespace action: {action}")
+
+        if not namespaces:
+            Logger.log("No network namespaces to apply to")
+            return True
+
+        # Compile up front, the workers then only read the cache
+        if action != "fire" and action != "teardown":
+            self._compiler.compile(opts)
+
+        workers = min(self._jobs, len(namespaces))
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {}
+            for netns in namespaces:
+                future = pool.submit(self._apply, netns, action, opts, report)
+                futures[future] = netns
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = (True, future.result())
+                except Exception as e:
+                    results[futures[future]] = (False, e)
+
+        passed = 0
+        for netns in namespaces:
+            ok, result = results[netns]
+            if ok:
+                passed += 1
+                Logger.log(f"netns {netns}: {action} done in {result:.2f}s")
+            else:
+                Logger.log(f"netns {netns}: {action} failed: {result}")
+
+        Logger.log(f"Applied {action} to {passed} of {len(namespaces)} "
+                   f"network namespaces")
+        Logger.log(self._lock.summary())
+        return passed == len(namespaces)
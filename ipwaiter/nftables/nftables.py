@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import re
+import subprocess
+
+from ..logger.logger import Logger
+
+
+class Nftables:
+    """Table holding the flowtable, apart from every other nftables table"""
+    TABLE = "ipwaiter"
+
+    """Family of the table, inet offloads both IPv4 and IPv6 flows"""
+    FAMILY = "inet"
+
+    """Interface names the kernel accepts"""
+    INTERFACE = re.compile(r"^[A-Za-z0-9_.@-]{1,15}$")
+
+    def __init__(self, netns=None, binary="nft"):
+        """Commands run inside the network namespace netns, if given"""
+        self._netns = netns
+        self._binary = binary
+
+    def _command(self, *args):
+        if self._netns:
+            return ["ip", "netns", "exec", self._netns, self._binary, *args]
+        return [self._binary, *args]
+
+    @staticmethod
+    def offload_script(interfaces):
+        """An nft script replacing the ipwaiter table in one transaction
+
+        The forward chain runs after the iptables filter table, so only
+        packets the whole filter FORWARD chain lets through reach it,
+        whether forward_orders or any other rule accepted them. Only
+        established flows are added, after their first packets.
+        Replacing the table drops every offloaded flow."""
+        for interface in interfaces:
+            if not Nftables.INTERFACE.match(interface):
+                Logger.fatal(f"Invalid FORWARD_OFFLOAD interface: "
+                             f"{interface}")
+
+        table = f"{Nftables.FAMILY} {Nftables.TABLE}"
+        devices = ", ".join(interfaces)
+        return "\n".join([
+            # Declaring first makes the delete work on a fresh host
+            f"table {table}",
+            f"delete table {table}",
+            f"table {table} {{",
+            "    flowtable offload {",
+            "        hook ingress priority filter",
+            f"        devices = {{ {devices} }}",
+            "    }",
+            "    chain forward {",
+            "        type filter hook forward priority filter + 10; "
+            "policy accept;",
+            "        meta l4proto { tcp, udp } ct state established "
+            "flow add @offload",
+            "    }",
+            "}",
+        ]) + "\n"
+
+    def offload(self, interfaces):
+        """Install the flowtable over interfaces, returns True on success"""
+        if not interfaces:
+            Logger.fatal(f"Failed offload() in nftables, arguments "
+                         f"interfaces: {interfaces}")
+
+        script = Nftables.offload_script(interfaces)
+        Logger.d(script)
+        return self._run(self._command("-f", "-"), script)
+
+    def exists(self):
+        return self._run(self._command("list", "table", Nftables.FAMILY,
+                                       Nftables.TABLE))
+
+    def remove_offload(self):
+        """Remove the flowtable, flows fall back to the forward chain"""
+        if not self.exists():
+            return True
+        return self._run(self._command("delete", "table", Nftables.FAMILY,
+                                       Nftables.TABLE))
+
+    @staticmethod
+    def _get_output():
+        """Get output level based on debugging mode"""
+        return None if Logger.enabled else subprocess.DEVNULL
+
+    @staticmethod
+    def _run(args, payload=None):
+        try:
+            Logger.d(f"Run nft command: '{' '.join(args)}'")
+            subprocess.run(
+                args,
+                check=True,
+                input=payload,
+                stdin=None if payload is not None else subprocess.DEVNULL,
+                stdout=Nftables._get_output(),
+                stderr=Nftables._get_output(),
+                universal_newlines=True
+            )
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            Logger.d("nft command failed")
+            Logger.d(e)
+            return False
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import shlex
+import sys
+
+import ipwaiter.utils as utils
+
+from ..iptables.memory import MemoryIptables
+from ..iptables.preconditions import Preconditions
+from ..iptables.restore import Restore
+from ..iptables.rollback import Rollback
+from ..iptables.snapshot import Snapshot
+from ..logger.logger import FatalError, Logger
+from .compiler import Compiler
+from .waiter import Waiter
+
+
+class Batch:
+    """Operations a batch accepts, and whether they name orders"""
+    ACTIONS = {
+        "add": True,
+        "delete": True,
+        "hire": False,
+        "fire": False,
+        "rehire": False,
+        "teardown": False,
+    }
+
+    def __init__(self, iptables, order_dirs, system_conf, ipset=None,
+                 nftables=None):
+        """Blocklists and the forward offload change as operations run,
+        they are not part of the restore"""
+        if not iptables:
+            Logger.fatal(f"Invalid iptables handler given: {iptables}")
+
+        self._iptables = iptables
+        self._ipset = ipset
+        self._nftables = nftables
+        self._order_dirs = order_dirs
+        self._system_conf = system_conf
+        self._index = utils.index_orders(order_dirs)
+        self._conf = system_conf.parse()
+
+    @staticmethod
+    def _lines(path):
+        if path == "-":
+            yield from enumerate(sys.stdin, start=1)
+            return
+
+        try:
+            with open(path, "r") as batch:
+                yield from enumerate(batch, start=1)
+        except OSError as e:
+            Logger.fatal(f"Unable to read batch: {path}, {e}")
+
+    def _parse(self, number, line):
+        """Parse one operation, returning it with any validation error
+
+        An operation reads like the command line: an action, then --raw,
+        the chain and the orders for add and delete"""
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            return {"line": number, "op": line.strip()}, str(e)
+
+        action = words[0]
+        op = {"line": number, "op": action}
+        if action not in Batch.ACTIONS:
+            return op, f"Unknown operation: {action}"
+
+        if not Batch.ACTIONS[action]:
+            if len(words) > 1:
+                return op, f"Unexpected arguments: {' '.join(words[1:])}"
+            if action != "fire" and action != "teardown":
+                missing = self._unknown_hired()
+                if missing:
+                    return op, f"Unknown orders: {' '.join(missing)}"
+            return op, None
+
+        raw = len(words) > 1 and words[1] == "--raw"
+        words = words[2:] if raw else words[1:]
+        op["raw"] = raw
+        if len(words) < 2:
+            return op, "Expected a chain and at least one order"
+
+        chain = words[0].lower()
+        op["chain"] = chain
+        op["orders"] = words[1:]
+
+        chains = Preconditions.RAW_CHAINS if raw \
+            else Preconditions.FILTER_CHAINS
+        if chain not in chains:
+            return op, f"Invalid chain: {words[0]}"
+
+        missing = [name for name in op["orders"] if name not in self._index]
+        if missing:
+            return op, f"Unknown orders: {' '.join(missing)}"
+
+        return op, None
+
+    def _unknown_hired(self):
+        return [name for (key, _, _) in Compiler.PARENTS
+                for name in self._conf[key] if name not in self._index]
+
+    def _execute(self, waiter, op, opts, report):
+        action = op["op"]
+        if action == "add":
+            waiter.add_order([op["chain"], *op["orders"]], op["raw"], opts)
+        elif action == "delete":
+            waiter.delete_order([op["chain"], *op["orders"]], op["raw"])
+        elif action == "hire":
+            waiter.hire_waiter(opts=opts, report=report)
+        elif action == "fire" or action == "teardown":
+            waiter.fire_waiter(destroy=action == "teardown", report=report)
+        else:
+            waiter.rehire_waiter(opts=opts, report=report)
+
+    def _restore(self, payload):
+        """Commit the payload, a table which fails to commit undoes the
+        tables committed before it"""
+        with Rollback(self._iptables) as rollback:
+            if self._iptables.restore(payload):
+                return True
+            rollback.restore()
+            return False
+
+    @staticmethod
+    def _report(op, status, error=None):
+        result = dict(op, status=status)
+        if error:
+            result["error"] = error
+        print(json.dumps(result), flush=True)
+
+    def run(self, path, opts, report):
+        """Validate every operation, then commit them as one restore
+
+        The operations run against an in memory copy of the current
+        tables, and only the owned chains which changed are restored.
+        Every operation is reported as a line of JSON on stdout."""
+        ops = []
+        invalid = False
+        for (number, line) in Batch._lines(path):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            op, error = self._parse(number, line)
+            if error:
+                invalid = True
+                Batch._report(op, "invalid", error)
+            ops.append((op, error))
+
+        if invalid:
+            for (op, error) in ops:
+                if not error:
+                    Batch._report(op, "skipped")
+            return False
+
+        current = self._iptables.save()
+        if current is None:
+            Logger.fatal("Unable to snapshot the current tables")
+
+        memory = MemoryIptables()
+        memory.load(current)
+        before = Snapshot.parse(memory.save())
+
+        # Progress goes to stderr, stdout only carries the results
+        waiter = Waiter(memory, self._order_dirs, self._system_conf,
+                        ipset=self._ipset, nftables=self._nftables)
+        with Logger.redirected(sys.stderr):
+            for (op, _) in ops:
+                try:
+                    self._execute(waiter, op, opts, report)
+                except FatalError as e:
+                    # Nothing was committed, so no operation took effect
+                    for (other, _) in ops:
+                        if other is op:
+                            Batch._report(op, "failed", str(e))
+                        else:
+                            Batch._report(other, "skipped")
+                    return False
+
+        payload = Restore.diff(before, Snapshot.parse(memory.save()))
+        Logger.d(f"Batch payload:\n{payload}")
+        applied = not payload or self._restore(payload)
+
+        for (op, _) in ops:
+            Batch._report(op, "ok" if applied else "failed")
+        return applied
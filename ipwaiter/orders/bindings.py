@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from ..logger.logger import Logger
+
+
+class Bindings:
+    """Values of --src and --dst naming an interface, such as @wlan0"""
+    PREFIX = "@"
+
+    """Options an interface may be bound to"""
+    KEYS = ["src", "dst"]
+
+    def __init__(self, opts, addresses=None):
+        """Address blocks of the orders, some following an interface"""
+        self._opts = dict(opts) if opts else {}
+        self._addresses = addresses
+        self._resolved = {}
+
+    @staticmethod
+    def is_bound(value):
+        return bool(value) and value.startswith(Bindings.PREFIX)
+
+    @staticmethod
+    def any_bound(opts):
+        return bool(opts) and any(Bindings.is_bound(opts.get(key))
+                                  for key in Bindings.KEYS)
+
+    def interfaces(self):
+        """{option: interface} of every bound option"""
+        return {key: self._opts[key][len(Bindings.PREFIX):]
+                for key in Bindings.KEYS
+                if Bindings.is_bound(self._opts.get(key))}
+
+    def addresses(self):
+        if self._addresses is None:
+            from ..netlink.netlink import Addresses
+
+            self._addresses = Addresses()
+        return self._addresses
+
+    def resolve(self):
+        """The options with every interface replaced by its network
+
+        An interface without an address stays bound, and the rules using it
+        are left out until it has one"""
+        opts = dict(self._opts)
+        interfaces = self.interfaces()
+        if not interfaces:
+            return opts
+
+        networks = self.addresses().dump()
+        for (key, interface) in interfaces.items():
+            addresses = networks.get(interface)
+            network = str(addresses[0].network) if addresses else None
+            if key not in self._resolved or network != self._resolved[key]:
+                if network:
+                    Logger.log(f"Bound {key} to {network} of {interface}")
+                else:
+                    Logger.log(f"Interface {interface} has no address, rules "
+                               f"using {key} are left out until it does")
+            self._resolved[key] = network
+            if network:
+                opts[key] = network
+        return opts
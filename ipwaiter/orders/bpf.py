@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import functools
+import ipaddress
+import itertools
+import operator
+import random
+import struct
+
+from ..iptables.tags import Tags
+from ..logger.logger import Logger
+from ..simulator.packets import PacketBatch
+from ..simulator.rules import RuleCompiler
+from .model import Rule
+
+
+class BpfAssembler:
+    """Classic BPF opcodes the lowering emits"""
+    LD_W_ABS = 0x20
+    LD_H_ABS = 0x28
+    LD_B_ABS = 0x30
+    LD_H_IND = 0x48
+    LDX_B_MSH = 0xb1
+    ALU_AND_K = 0x54
+    JMP_JEQ_K = 0x15
+    JMP_JGT_K = 0x25
+    JMP_JGE_K = 0x35
+    JMP_JSET_K = 0x45
+    RET_K = 0x06
+
+    """Jump target of the instruction right after a jump"""
+    NEXT = None
+
+    def __init__(self):
+        """Instructions are (code, jt, jf, k), jumps name labels"""
+        self._instructions = []
+        self._labels = {}
+
+    def __len__(self):
+        return len(self._instructions)
+
+    def label(self, name):
+        self._labels[name] = len(self._instructions)
+
+    def emit(self, code, k=0):
+        self._instructions.append((code, BpfAssembler.NEXT,
+                                   BpfAssembler.NEXT, k))
+
+    def jump(self, code, k, true, false):
+        self._instructions.append((code, true, false, k))
+
+    def assemble(self):
+        """Resolve labels into the relative offsets BPF jumps use"""
+        program = []
+        for (position, (code, jt, jf, k)) in enumerate(self._instructions):
+            offsets = []
+            for target in [jt, jf]:
+                offset = 0 if target is BpfAssembler.NEXT \
+                    else self._labels[target] - position - 1
+                if not 0 <= offset <= 255:
+                    raise ValueError(f"BPF jump out of range: {target}")
+                offsets.append(offset)
+            program.append((code, offsets[0], offsets[1], k))
+        return program
+
+    @staticmethod
+    def bytecode(program):
+        """The program as the --bytecode option of -m bpf spells it"""
+        return ",".join([str(len(program)),
+                         *[f"{code} {jt} {jf} {k}"
+                           for (code, jt, jf, k) in program]])
+
+
+class BpfInterpreter:
+
+    def __init__(self):
+        """BpfInterpreter is purely a static implementation"""
+        raise NotImplementedError("No instances of BpfInterpreter allowed")
+
+    @staticmethod
+    def _load(packet, offset, size):
+        if offset < 0 or offset + size > len(packet):
+            return None
+        return int.from_bytes(packet[offset:offset + size], "big")
+
+    @staticmethod
+    def run(program, packet):
+        """Run a program over a packet starting at its IP header
+
+        Returns the return value, and the instructions executed. A load
+        outside of the packet ends the program with 0, as the kernel does"""
+        a = x = 0
+        pc = 0
+        executed = 0
+        sizes = {0x00: 4, 0x08: 2, 0x10: 1}
+        while pc < len(program):
+            code, jt, jf, k = program[pc]
+            executed += 1
+            pc += 1
+
+            kind = code & 0x07
+            if kind == 0x00:
+                offset = k if code & 0xe0 == 0x20 else x + k
+                a = BpfInterpreter._load(packet, offset, sizes[code & 0x18])
+                if a is None:
+                    return 0, executed
+            elif code == BpfAssembler.LDX_B_MSH:
+                value = BpfInterpreter._load(packet, k, 1)
+                if value is None:
+                    return 0, executed
+                x = 4 * (value & 0x0f)
+            elif code == BpfAssembler.ALU_AND_K:
+                a &= k
+            elif kind == 0x05:
+                operation = code & 0xf0
+                if operation == 0x10:
+                    taken = a == k
+                elif operation == 0x20:
+                    taken = a > k
+                elif operation == 0x30:
+                    taken = a >= k
+                elif operation == 0x40:
+                    taken = bool(a & k)
+                else:
+                    raise ValueError(f"Unsupported BPF jump: {code:#x}")
+                pc += jt if taken else jf
+            elif code == BpfAssembler.RET_K:
+                return k, executed
+            else:
+                raise ValueError(f"Unsupported BPF instruction: {code:#x}")
+        return 0, executed
+
+
+class BpfClause:
+
+    def __init__(self, protocol, src, dst, sports, dports):
+        """One rule of an order, as the packet fields it matches
+
+        Ports are lists of inclusive (low, high) ranges, or None"""
+        self.protocol = protocol
+        self.src = src
+        self.dst = dst
+        self.sports = sports
+        self.dports = dports
+
+
+class BpfLowering:
+    """Most instructions xt_bpf accepts in a program"""
+    MAX_INSTRUCTIONS = 64
+
+    """Verdicts a group of rules may share, without changing which
+    packets see the rules after it"""
+    VERDICTS = ["ACCEPT", "DROP", "REJECT", "RETURN"]
+
+    """Protocols whose ports sit at the start of their header"""
+    PORT_PROTOCOLS = {"tcp": 6, "udp": 17, "udplite": 136, "sctp": 132,
+                      "dccp": 33}
+
+    """Other protocols a clause may match"""
+    PROTOCOLS = {"icmp": 1, "igmp": 2, "gre": 47, "esp": 50, "ah": 51}
+
+    """Modules which only carry the options a clause understands"""
+    MODULES = ["tcp", "udp", "udplite", "sctp", "dccp", "multiport"]
+
+    """Packets generated for every equivalence check"""
+    SAMPLES = 4096
+
+    def __init__(self, name):
+        """Lower the rules of the order name"""
+        self._name = name
+        self.stats = None
+
+    @staticmethod
+    def _untagged(args):
+        if args[:3] == ("-m", "comment", "--comment"):
+            return args[4:]
+        return args
+
+    @staticmethod
+    def _ports(value):
+        ranges = []
+        for item in value.split(","):
+            low, colon, high = item.partition(":")
+            low = low or ("0" if colon else "")
+            high = high or ("65535" if colon else low)
+            if not low.isdigit() or not high.isdigit():
+                return None
+            ranges.append((int(low), int(high)))
+        return ranges
+
+    @staticmethod
+    def _network(value):
+        try:
+            network = ipaddress.ip_network(value, strict=False)
+        except ValueError:
+            return None
+        return network if network.version == 4 else None
+
+    @staticmethod
+    def clause(args):
+        """The clause and verdict of a rule, or None if it cannot be
+        lowered"""
+        fields = {"protocol": None, "src": None, "dst": None,
+                  "sports": None, "dports": None}
+        index = 0
+        while index < len(args):
+            option = args[index]
+            value = args[index + 1] if index + 1 < len(args) else None
+            if value is None or value == "!":
+                return None
+            index += 2
+
+            if option in ["-p", "--protocol"]:
+                fields["protocol"] = value.lower()
+            elif option in ["-m", "--match"]:
+                if value not in BpfLowering.MODULES:
+                    return None
+            elif option in ["-s", "--source", "-d", "--destination"]:
+                network = BpfLowering._network(value)
+                if network is None:
+                    return None
+                fields["src" if option.startswith("-s") or
+                       option == "--source" else "dst"] = network
+            elif option in ["--sport", "--source-port", "--sports",
+                            "--source-ports"]:
+                fields["sports"] = BpfLowering._ports(value)
+                if fields["sports"] is None:
+                    return None
+            elif option in ["--dport", "--destination-port", "--dports",
+                            "--destination-ports"]:
+                fields["dports"] = BpfLowering._ports(value)
+                if fields["dports"] is None:
+                    return None
+            elif option in ["-j", "--jump"]:
+                if value not in BpfLowering.VERDICTS:
+                    return None
+                verdict = tuple(args[index - 2:])
+                break
+            else:
+                return None
+        else:
+            return None
+
+        protocol = fields["protocol"]
+        if protocol not in BpfLowering.PORT_PROTOCOLS:
+            if protocol not in BpfLowering.PROTOCOLS:
+                return None
+            if fields["sports"] or fields["dports"]:
+                return None
+
+        return BpfClause(**fields), verdict
+
+    @staticmethod
+    def _number(protocol):
+        return BpfLowering.PORT_PROTOCOLS.get(protocol) \
+            or BpfLowering.PROTOCOLS[protocol]
+
+    @staticmethod
+    def _emit_network(asm, offset, network, fail):
+        if network is None or network.prefixlen == 0:
+            return
+        asm.emit(BpfAssembler.LD_W_ABS, offset)
+        if network.prefixlen < 32:
+            asm.emit(BpfAssembler.ALU_AND_K, int(network.netmask))
+        asm.jump(BpfAssembler.JMP_JEQ_K, int(network.network_address),
+                 BpfAssembler.NEXT, fail)
+
+    @staticmethod
+    def _emit_ports(asm, offset, ranges, fail, label):
+        asm.emit(BpfAssembler.LD_H_IND, offset)
+        matched = f"{label}_ok"
+        for (position, (low, high)) in enumerate(ranges):
+            following = f"{label}_{position + 1}" \
+                if position + 1 < len(ranges) else fail
+            if low == high:
+                asm.jump(BpfAssembler.JMP_JEQ_K, low, matched, following)
+            else:
+                asm.jump(BpfAssembler.JMP_JGE_K, low,
+                         BpfAssembler.NEXT, following)
+                asm.jump(BpfAssembler.JMP_JGT_K, high, following, matched)
+            if position + 1 < len(ranges):
+                asm.label(following)
+        asm.label(matched)
+
+    @staticmethod
+    def _emit_clause(asm, clause, check_protocol, fail, label):
+        if check_protocol:
+            asm.emit(BpfAssembler.LD_B_ABS, 9)
+            asm.jump(BpfAssembler.JMP_JEQ_K,
+                     BpfLowering._number(clause.protocol),
+                     BpfAssembler.NEXT, fail)
+        BpfLowering._emit_network(asm, 12, clause.src, fail)
+        BpfLowering._emit_network(asm, 16, clause.dst, fail)
+
+        if clause.sports or clause.dports:
+            # Ports only exist in the first fragment
+            asm.emit(BpfAssembler.LD_H_ABS, 6)
+            asm.jump(BpfAssembler.JMP_JSET_K, 0x1fff,
+                     fail, BpfAssembler.NEXT)
+            asm.emit(BpfAssembler.LDX_B_MSH, 0)
+            if clause.sports:
+                BpfLowering._emit_ports(asm, 0, clause.sports, fail,
+                                        f"{label}_s")
+            if clause.dports:
+                BpfLowering._emit_ports(asm, 2, clause.dports, fail,
+                                        f"{label}_d")
+        asm.emit(BpfAssembler.RET_K, 1)
+
+    @staticmethod
+    def assemble(clauses, check_protocol):
+        """Assemble clauses into as few programs as the limit allows"""
+        programs = []
+        pending = list(clauses)
+        while pending:
+            count = len(pending)
+            while True:
+                asm = BpfAssembler()
+                for (index, clause) in enumerate(pending[:count]):
+                    BpfLowering._emit_clause(asm, clause, check_protocol,
+                                             f"c{index + 1}", f"c{index}")
+                    asm.label(f"c{index + 1}")
+                asm.emit(BpfAssembler.RET_K, 0)
+                if len(asm) <= BpfLowering.MAX_INSTRUCTIONS or count == 1:
+                    break
+                count -= 1
+
+            if len(asm) > BpfLowering.MAX_INSTRUCTIONS:
+                return None
+            programs.append(asm.assemble())
+            pending = pending[count:]
+        return programs
+
+    @staticmethod
+    def packet(proto, src, dst, sport, dport, ihl=5, fragment=0):
+        """An IPv4 packet carrying the fields, with ihl words of header"""
+        header = struct.pack("!BBHHHBBHII", 0x40 | ihl, 0, 20 + 4 * ihl, 0,
+                             fragment, 64, proto, 0, src, dst)
+        header += b"\0" * (4 * ihl - 20)
+        return header + struct.pack("!HHI", sport, dport, 0)
+
+    def _samples(self, clauses):
+        """Packets on both sides of every boundary the clauses draw"""
+        protocols = {0, 255}
+        addresses = {0, 0xffffffff}
+        ports = {0, 65535}
+        for clause in clauses:
+            protocols.add(BpfLowering._number(clause.protocol))
+            for network in [clause.src, clause.dst]:
+                if network is not None:
+                    low = int(network.network_address)
+                    high = int(network.broadcast_address)
+                    addresses |= {low, high, max(low - 1, 0),
+                                  min(high + 1, 0xffffffff)}
+            for ranges in [clause.sports, clause.dports]:
+                for (low, high) in ranges or []:
+                    ports |= {low, high, max(low - 1, 0),
+                              min(high + 1, 65535)}
+
+        axes = [sorted(protocols), sorted(addresses), sorted(addresses),
+                sorted(ports), sorted(ports)]
+        combinations = functools.reduce(
+            operator.mul, (len(axis) for axis in axes), 1)
+        if combinations <= BpfLowering.SAMPLES:
+            rows = list(itertools.product(*axes))
+        else:
+            rng = random.Random(self._name)
+            rows = [tuple(rng.choice(axis) for axis in axes)
+                    for _ in range(BpfLowering.SAMPLES)]
+        return [(*row, 0) for row in rows]
+
+    def _equivalent(self, rules, programs, rows):
+        """Check the programs match exactly the packets the rules match,
+        as the simulator matches them, and measure both"""
+        batch = PacketBatch(rows)
+        compiler = RuleCompiler([])
+        expected = set()
+        fragments = set()
+        evaluated = [len(rules)] * len(rows)
+        for (position, args) in enumerate(rules):
+            matched = batch.everything
+            predicates = compiler.compile(list(args)).predicates
+            for (column, ranges, negate) in predicates:
+                matched = matched & batch.select(column, ranges, negate)
+            for index in matched - expected:
+                evaluated[index] = position + 1
+            expected |= matched
+            # A later fragment carries no ports for a rule to match
+            if all(column not in ["sport", "dport"]
+                   for (column, _, _) in predicates):
+                fragments |= matched
+
+        executed = []
+        for (index, row) in enumerate(rows):
+            packets = [(BpfLowering.packet(*row[:5]), index in expected),
+                       (BpfLowering.packet(*row[:5], ihl=6),
+                        index in expected),
+                       (BpfLowering.packet(*row[:5], fragment=0x10),
+                        index in fragments)]
+            for (position, (packet, wanted)) in enumerate(packets):
+                verdict = False
+                cost = 0
+                for program in programs:
+                    value, steps = BpfInterpreter.run(program, packet)
+                    cost += steps
+                    if value:
+                        verdict = True
+                        break
+                if verdict != wanted:
+                    Logger.d(f"BPF lowering of {self._name} disagrees "
+                             f"on {row[:5]}")
+                    return None
+                if position == 0:
+                    executed.append(cost)
+
+        return (sum(evaluated) / len(rows), max(evaluated),
+                sum(executed) / len(rows), max(executed))
+
+    def _lower_group(self, group, verdict):
+        """One or more bpf rules replacing a group of rules"""
+        clauses = [clause for (clause, _) in group]
+        protocols = {clause.protocol for clause in clauses}
+        shared = protocols.pop() if len(protocols) == 1 else None
+
+        programs = BpfLowering.assemble(clauses, check_protocol=not shared)
+        if not programs:
+            return None, None
+
+        rules = [args for (_, args) in group]
+        if shared:
+            # The interpreter only sees packets of the shared protocol
+            checked = [BpfLowering.assemble(clauses, check_protocol=True)]
+            checked = checked[0]
+        else:
+            checked = programs
+        measured = self._equivalent(rules, checked,
+                                    self._samples(clauses))
+        if not measured:
+            return None, None
+
+        lowered = []
+        for program in programs:
+            args = ["-m", "bpf", "--bytecode",
+                    BpfAssembler.bytecode(program), *verdict]
+            if shared:
+                args = ["-p", shared, *args]
+            lowered.append(args)
+        return lowered, measured
+
+    def lower(self, rules):
+        """Lower runs of rules sharing a verdict, keep every other rule
+
+        Runs are only made of adjacent rules, so every packet still meets
+        the verdicts in the order the rules were written"""
+        lowered = []
+        stats = {"before": len(rules), "after": 0, "groups": []}
+        run = []
+        run_verdict = None
+
+        def flush():
+            if len(run) < 2:
+                lowered.extend(rule for (_, _, rule) in run)
+                return
+
+            group = [(clause, args) for (clause, args, _) in run]
+            replaced, measured = self._lower_group(group, run_verdict)
+            if not replaced:
+                lowered.extend(rule for (_, _, rule) in run)
+                return
+
+            line = run[0][2].line
+            for args in replaced:
+                lowered.append(Rule(run[0][2].table,
+                                    Tags.tag(self._name, args), line))
+            stats["groups"].append((len(run), len(replaced), *measured))
+
+        for rule in rules:
+            args = BpfLowering._untagged(rule.args)
+            parsed = BpfLowering.clause(args)
+            if parsed and (not run or parsed[1] == run_verdict):
+                run.append((parsed[0], args, rule))
+                run_verdict = parsed[1]
+                continue
+
+            flush()
+            run = []
+            run_verdict = None
+            if parsed:
+                run.append((parsed[0], args, rule))
+                run_verdict = parsed[1]
+            else:
+                lowered.append(rule)
+        flush()
+
+        stats["after"] = len(lowered)
+        self.stats = stats
+        return lowered
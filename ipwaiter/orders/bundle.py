@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import json
+import os
+
+from ..constants import PathConstants
+from ..ipset.blocklist import Blocklist
+from ..iptables.restore import Restore
+from ..logger.logger import Logger
+from .reader import OrderReader
+
+
+class Bundle:
+    """Format of the bundle content, bumped on incompatible changes"""
+    FORMAT = 2
+
+    def __init__(self, content):
+        self.content = content
+        self.hash = Bundle.digest(content)
+
+    @staticmethod
+    def digest(content):
+        """Content address of a bundle, stable across hosts"""
+        canonical = json.dumps(content, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _file_digest(path):
+        with open(path, "rb") as source:
+            return hashlib.sha256(source.read()).hexdigest()
+
+    @staticmethod
+    def compile(compiler, opts):
+        """Compile the orders of system.conf into a bundle"""
+        orders = {}
+        for (name, path) in sorted(compiler.hired_orders().items()):
+            orders[name] = Bundle._file_digest(path)
+
+        # The rules match blocklist sets, which the host may not have
+        blocklists = {}
+        for blocklist in Blocklist.hired(compiler, opts):
+            blocklists[blocklist.name] = [
+                str(network) for network in blocklist.collapsed()]
+
+        src = opts.get("src") if opts else None
+        dst = opts.get("dst") if opts else None
+        content = {
+            "format": Bundle.FORMAT,
+            "bindings": {
+                "src": src or OrderReader.DEFAULT_SRC,
+                "dst": dst or OrderReader.DEFAULT_DST,
+            },
+            "system_conf": compiler.conf(),
+            "orders": orders,
+            "blocklists": blocklists,
+            "payload": Restore.payload(compiler.compile(opts)),
+        }
+        return Bundle(content)
+
+    def write(self, path):
+        """Write the bundle, named by its hash when path is a directory"""
+        if os.path.isdir(path):
+            path = os.path.join(path, f"{self.hash}.bundle")
+
+        # Write aside and move into place, so a reader never sees half
+        staging = f"{path}.tmp"
+        try:
+            with open(staging, "w") as bundle:
+                json.dump({"hash": self.hash, "content": self.content},
+                          bundle, sort_keys=True, indent=1)
+            os.replace(staging, path)
+        except OSError as e:
+            Logger.fatal(f"Unable to write bundle: {path}: {e}")
+
+        return path
+
+    @staticmethod
+    def read(path):
+        """Read a bundle, refusing one whose content does not match its hash"""
+        try:
+            with open(path, "r") as bundle:
+                data = json.load(bundle)
+        except (OSError, ValueError) as e:
+            Logger.fatal(f"Unable to read bundle: {path}: {e}")
+
+        if not isinstance(data, dict) or "content" not in data:
+            Logger.fatal(f"Invalid bundle: {path}")
+
+        bundle = Bundle(data["content"])
+        if bundle.hash != data.get("hash"):
+            Logger.fatal(f"Bundle content does not match its hash: {path}")
+
+        if bundle.content.get("format") != Bundle.FORMAT:
+            Logger.fatal(f"Unsupported bundle format: "
+                         f"{bundle.content.get('format')}")
+
+        return bundle
+
+    @staticmethod
+    def active():
+        """Hash of the bundle currently applied, if any"""
+        try:
+            with open(PathConstants.ACTIVE_BUNDLE, "r") as active:
+                return active.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def forget_active():
+        """Rules are changing outside of a bundle, forget the active one"""
+        try:
+            os.remove(PathConstants.ACTIVE_BUNDLE)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            Logger.e(f"Unable to forget active bundle: {e}")
+
+    def apply(self, iptables, ipset):
+        """Apply the bundle in one iptables-restore, unless already active
+
+        Blocklist sets are loaded first, so every set the rules match
+        exists by the time they are restored"""
+        if Bundle.active() == self.hash:
+            Logger.log(f"Bundle {self.hash} is already active")
+            return
+
+        for (name, networks) in sorted(self.content["blocklists"].items()):
+            Blocklist.fill(ipset, name, networks, f"bundle {self.hash}")
+
+        if not iptables.restore(self.content["payload"]):
+            Logger.fatal(f"Failed to apply bundle: {self.hash}")
+
+        try:
+            os.makedirs(PathConstants.RUNTIME_DIR, exist_ok=True)
+            with open(PathConstants.ACTIVE_BUNDLE, "w") as active:
+                active.write(f"{self.hash}\n")
+        except OSError as e:
+            Logger.e(f"Unable to remember active bundle: {e}")
+
+        Logger.log(f"Applied bundle {self.hash}")
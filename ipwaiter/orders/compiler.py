@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import os
+
+import ipwaiter.utils as utils
+
+from ..iptables.preconditions import Preconditions
+from ..iptables.tags import Tags
+from ..logger.logger import Logger
+from .bpf import BpfLowering
+from .cost import TraversalCost
+from .dispatch import Dispatcher
+from .model import ChainPlan, Order
+from .reader import OrderReader
+from .systemconf import SystemConfParser
+
+
+class Compiler:
+    """system.conf keys, with the table and chain they are hired into"""
+    PARENTS = [
+        ("FILTER_INPUT", "filter", "input"),
+        ("FILTER_FORWARD", "filter", "forward"),
+        ("FILTER_OUTPUT", "filter", "output"),
+        ("RAW_OUTPUT", "raw", "output"),
+        ("RAW_PREROUTING", "raw", "prerouting"),
+    ]
+
+    def __init__(self, order_dirs, system_conf):
+        for order_dir in order_dirs:
+            if not os.path.isdir(order_dir):
+                Logger.fatal(f"Invalid order directory given: {order_dir}")
+
+        self._index = utils.index_orders(order_dirs)
+        self._conf = system_conf.parse()
+        self._cache = {}
+        self._sources = {}
+        self._lowered = {}
+        self._inlined = {}
+
+    def conf(self):
+        return self._conf
+
+    def hired_orders(self):
+        """Every order named in system.conf, with the path it is read from"""
+        hired = {}
+        for (key, _, _) in Compiler.PARENTS:
+            for name in self._conf[key]:
+                path = self._index.get(name)
+                if not path:
+                    Logger.fatal(f"Compile failed invalid order: {name}")
+                hired[name] = path
+        return hired
+
+    def budgets(self):
+        """{hire key: most rules a packet may walk in its parent chain}"""
+        budgets = {}
+        for key in SystemConfParser.BUDGET_KEYS:
+            values = self._conf[key]
+            if not values:
+                continue
+            if len(values) != 1 or not values[0].isdigit():
+                Logger.fatal(f"Invalid {key} budget: {' '.join(values)}")
+            budgets[key.replace("MAX_RULES_", "", 1)] = int(values[0])
+        return budgets
+
+    def costs(self, opts):
+        """The ChainCost of every parent chain system.conf fills"""
+        costs = TraversalCost(self.compile(opts)).parents(Compiler.PARENTS)
+        inlined = self.inlined(opts)
+        for (key, table, o_chain) in Compiler.PARENTS:
+            parent = f"{o_chain}_orders"
+            if key in costs:
+                costs[key].inlined = [
+                    f"order_{name}" for name in self._conf[key]
+                    if (table, parent, f"order_{name}") in inlined]
+        return costs
+
+    def inline_limit(self):
+        """Most rules an order may hold to be inlined, or None"""
+        values = self._conf["INLINE_MAX_RULES"]
+        if not values:
+            return None
+        if len(values) != 1 or not values[0].isdigit():
+            Logger.fatal(f"Invalid INLINE_MAX_RULES: {' '.join(values)}")
+        return int(values[0])
+
+    @staticmethod
+    def _inlinable(rules):
+        """Whether rules behave the same in the parent as in their chain
+
+        A RETURN, or a goto, would leave the parent instead of the order"""
+        for args in rules:
+            for (index, arg) in enumerate(args):
+                if arg in ["-g", "--goto"]:
+                    return False
+                if arg in ["-j", "--jump"] and \
+                        args[index + 1:index + 2] == ["RETURN"]:
+                    return False
+        return bool(rules)
+
+    def inlined(self, opts):
+        """{(table, parent, order chain)} of orders placed straight into
+        the parent they are hired into
+
+        An order is inlined when it holds at most INLINE_MAX_RULES rules,
+        and a packet walks at most as many through it in the cost report.
+        Orders behind dispatch chains, or jumped into from anywhere but
+        their parent, keep their chain. The decision only holds for that
+        parent, the order keeps its chain anywhere else."""
+        limit = self.inline_limit()
+        if limit is None:
+            return set()
+
+        src = opts.get("src") if opts else None
+        dst = opts.get("dst") if opts else None
+        binding = (src, dst)
+        if binding in self._inlined:
+            return self._inlined[binding]
+
+        ruleset = self._compile(opts, set())
+        costs = TraversalCost(ruleset).parents(Compiler.PARENTS)
+        dispatch = self._chains_from_conf("DISPATCH")
+        jumps = collections.Counter(
+            args[index + 1] for chains in ruleset.values()
+            for rules in chains.values() for args in rules
+            for (index, arg) in enumerate(args[:-1])
+            if arg in ["-j", "--jump", "-g", "--goto"])
+
+        inlined = set()
+        for (key, table, o_chain) in Compiler.PARENTS:
+            if key not in costs or (table == "filter" and o_chain in dispatch):
+                continue
+
+            for (chain, worst, _) in costs[key].orders:
+                rules = ruleset[table][chain]
+                if len(rules) <= limit and worst <= limit and \
+                        jumps[chain] == 1 and Compiler._inlinable(rules):
+                    inlined.add((table, f"{o_chain}_orders", chain))
+
+        self._inlined[binding] = inlined
+        return inlined
+
+    def _chains_from_conf(self, key):
+        chains = [chain.lower() for chain in self._conf[key]]
+        for chain in chains:
+            if chain not in Preconditions.FILTER_CHAINS:
+                Logger.fatal(f"Invalid {key} chain: {chain}")
+        return chains
+
+    def order_plan(self, name, table, opts):
+        """The chain an order places into a table, compiled once"""
+        path = self._index.get(name)
+        if not path:
+            Logger.fatal(f"Compile failed invalid order: {name}")
+
+        return self.path_plan(path, table, opts)
+
+    def path_plan(self, path, table, opts):
+        """The chain the order file at path places into a table"""
+        order = self.order(path, opts)
+        rules = order.table_rules(table)
+        if order.name in self._conf["BPF_ORDERS"]:
+            rules = self._lower(order, table, rules)
+        return ChainPlan(table, order.chain, rules)
+
+    def _lower(self, order, table, rules):
+        """Lower the rules of an order into bpf matches, once per table"""
+        key = (order, table)
+        if key not in self._lowered:
+            lowering = BpfLowering(order.name)
+            self._lowered[key] = (lowering.lower(rules), lowering.stats)
+        return self._lowered[key][0]
+
+    def bpf_stats(self):
+        """{(order name, table): stats} of every order lowered so far"""
+        return {(order.name, table): stats
+                for ((order, table), (_, stats)) in self._lowered.items()}
+
+    def order(self, path, opts):
+        """The order file at path, read and tagged once per binding"""
+        src = opts.get("src") if opts else None
+        dst = opts.get("dst") if opts else None
+        key = (path, src, dst)
+        if key not in self._cache:
+            self._cache[key] = self._read_tagged(path, opts)
+        return self._cache[key]
+
+    def _read_tagged(self, path, opts):
+        """Read an order, tagging every rule with the order and its hash"""
+        order = OrderReader(path, opts).as_order()
+        seen = collections.Counter()
+        rules = []
+        for rule in order.rules:
+            occurrence = seen[rule]
+            seen[rule] += 1
+
+            rule_hash = Tags.rule_hash(order.name, rule.args, occurrence)
+            self._sources[rule_hash] = (path, rule.line)
+            rules.append(rule.prefixed(Tags.matches(order.name, rule_hash)))
+        return Order(order.name, path, rules, order.feed)
+
+    def source(self, rule_hash):
+        """The (order path, line number) a tagged rule was read from"""
+        return self._sources.get(rule_hash)
+
+    def compile(self, opts):
+        """Compile system.conf into {table: {chain: [rule args]}}
+
+        The layout matches what hire_waiter places: the parent chains
+        with their prelude, one chain per order, and the links or
+        dispatch chains joining them. Inlined orders sit in their parent
+        instead of a chain of their own."""
+        return self._compile(opts, self.inlined(opts))
+
+    def _compile(self, opts, inlined):
+        prelude = self._chains_from_conf("CONNTRACK_PRELUDE")
+        dispatch = self._chains_from_conf("DISPATCH")
+
+        ruleset = {"filter": {}, "raw": {}}
+        for chain in Preconditions.FILTER_CHAINS:
+            rules = []
+            if chain in prelude:
+                rules += [list(rule) for rule in Preconditions.PRELUDE_RULES]
+            ruleset["filter"][f"{chain}_orders"] = rules
+        for chain in Preconditions.RAW_CHAINS:
+            ruleset["raw"][f"{chain}_orders"] = []
+
+        for (key, table, o_chain) in Compiler.PARENTS:
+            parent = f"{o_chain}_orders"
+            chains = ruleset[table]
+
+            placed = []
+            for name in self._conf[key]:
+                chain_plan = self.order_plan(name, table, opts)
+                if (table, parent, chain_plan.chain) not in inlined:
+                    chains.setdefault(chain_plan.chain, chain_plan.args())
+                if chain_plan not in placed:
+                    placed.append(chain_plan)
+
+            if table == "filter" and o_chain in dispatch:
+                footprints = [(chain_plan.chain,
+                               Dispatcher.footprint(chain_plan.args()))
+                              for chain_plan in placed]
+                plan = Dispatcher(parent).plan(footprints)
+                for dispatch_chain in plan.chains:
+                    chains[dispatch_chain] = []
+                for (chain, args) in plan.links:
+                    chains[chain].append(args)
+            else:
+                for chain_plan in placed:
+                    if (table, parent, chain_plan.chain) in inlined:
+                        chains[parent] += chain_plan.args()
+                    else:
+                        chains[parent].append(Tags.link(chain_plan.chain))
+
+        return ruleset
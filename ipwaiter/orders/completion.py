@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+
+import ipwaiter.utils as utils
+
+from ..constants import PathConstants
+
+
+class CompletionIndex:
+    """Bumped whenever the layout of the index changes"""
+    VERSION = 1
+
+    """Tables an order file may place rules into"""
+    TABLES = ["filter", "raw"]
+
+    def __init__(self, order_dirs, path=None):
+        """Serve order names from a small index, which is rebuilt only
+        when an order directory was changed since it was written"""
+        if not path:
+            path = CompletionIndex.default_path()
+        self._order_dirs = order_dirs
+        self._path = path
+
+    @staticmethod
+    def default_path():
+        cache_dir = os.environ.get(PathConstants.ENV_XDG_CACHE)
+        if not cache_dir:
+            cache_dir = os.path.expanduser(PathConstants.HOME_CACHE_DIR)
+        return f"{cache_dir}/{PathConstants.COMPLETION_INDEX}"
+
+    def _stamps(self):
+        """Adding, removing or renaming an order changes its directory"""
+        return [[order_dir, os.stat(order_dir).st_mtime_ns]
+                for order_dir in self._order_dirs]
+
+    @staticmethod
+    def _tables(path):
+        """Tables named by the rules of an order, without parsing them"""
+        tables = set()
+        try:
+            with open(path, "r") as order:
+                for line in order:
+                    words = line.split(None, 1)
+                    if words and words[0].lower() in CompletionIndex.TABLES:
+                        tables.add(words[0].lower())
+        except OSError:
+            pass
+        return sorted(tables)
+
+    def _scan(self):
+        return {name: CompletionIndex._tables(path) for (name, path)
+                in utils.index_orders(self._order_dirs).items()}
+
+    def _read(self, stamps):
+        try:
+            with open(self._path, "r") as src:
+                index = json.load(src)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(index, dict) \
+                or index.get("version") != CompletionIndex.VERSION \
+                or index.get("dirs") != stamps:
+            return None
+        return index.get("orders")
+
+    def _write(self, stamps, orders):
+        """Write the index atomically, a missing cache only costs a scan"""
+        index = {"version": CompletionIndex.VERSION, "dirs": stamps,
+                 "orders": orders}
+        staging = f"{self._path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(staging, "w") as dst:
+                json.dump(index, dst, separators=(",", ":"))
+            os.replace(staging, self._path)
+        except OSError:
+            try:
+                os.unlink(staging)
+            except OSError:
+                pass
+
+    def names(self, table):
+        """Sorted names of every order with rules for the table"""
+        stamps = self._stamps()
+        orders = self._read(stamps)
+        if orders is None:
+            orders = self._scan()
+            self._write(stamps, orders)
+        return sorted(name for (name, tables) in orders.items()
+                      if table in tables)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from ..logger.logger import Logger
+from ..simulator.rules import RuleCompiler
+
+
+class ChainCost:
+
+    def __init__(self, label, worst, expected, orders, inlined=()):
+        """Rule evaluations a packet pays walking a parent chain
+
+        Orders are (chain, worst, expected) of every order it reaches,
+        and inlined the order chains whose rules sit in the parent"""
+        self.label = label
+        self.worst = worst
+        self.expected = expected
+        self.orders = orders
+        self.inlined = list(inlined)
+
+
+class TraversalCost:
+    """Protocols packets are costed for, a rule matching another protocol
+    is still evaluated but never jumps"""
+    PROTOCOLS = [("tcp", 6), ("udp", 17), ("icmp", 1), ("other", 255)]
+
+    """Targets which decide the fate of a packet"""
+    TERMINAL_TARGETS = ["ACCEPT", "DROP", "REJECT"]
+
+    def __init__(self, ruleset):
+        """Cost a compiled {table: {chain: [rule args]}} ruleset"""
+        self._ruleset = ruleset
+        self._walked = {}
+
+    @staticmethod
+    def _target(args):
+        for (index, arg) in enumerate(args[:-1]):
+            if arg in ["-j", "--jump", "-g", "--goto"]:
+                return args[index + 1], arg in ["-g", "--goto"]
+        return None, False
+
+    @staticmethod
+    def _reaches(args, protocol):
+        """Whether a packet of the protocol may match the rule"""
+        for (index, arg) in enumerate(args[:-1]):
+            if arg in ["-p", "--protocol"]:
+                negate = index > 0 and args[index - 1] == "!"
+                try:
+                    number = RuleCompiler.protocol(args[index + 1])
+                except ValueError:
+                    return True
+                if number == 0:
+                    return not negate
+                return (number == protocol) != negate
+        return True
+
+    def _walk(self, table, chain, protocol, stack=()):
+        """Walk every rule of a chain for a packet of the protocol
+
+        Returns the evaluations paid to fall through the chain, and those
+        paid at every rule which may decide or return the packet"""
+        key = (table, chain, protocol)
+        if key in self._walked:
+            return self._walked[key]
+
+        chains = self._ruleset[table]
+        paid = 0
+        exits = []
+        for args in chains.get(chain, []):
+            paid += 1
+            if not self._reaches(args, protocol):
+                continue
+
+            target, goto = self._target(args)
+            if target in TraversalCost.TERMINAL_TARGETS or target == "RETURN":
+                exits.append(paid)
+            elif target in chains and target not in stack:
+                through, inner = self._walk(table, target, protocol,
+                                            (*stack, chain))
+                exits += [paid + cost for cost in inner]
+                if goto:
+                    exits.append(paid + through)
+                    break
+                paid += through
+
+        self._walked[key] = (paid, exits)
+        return self._walked[key]
+
+    def chain(self, table, chain):
+        """The worst and expected evaluations walking a chain
+
+        The expected cost assumes every protocol is as likely, and every
+        rule deciding a packet, or falling through, as likely as well"""
+        worst = 0
+        expected = 0.0
+        for (_, protocol) in TraversalCost.PROTOCOLS:
+            through, exits = self._walk(table, chain, protocol)
+            outcomes = [*exits, through]
+            worst = max(worst, through, *outcomes)
+            expected += sum(outcomes) / len(outcomes)
+        return worst, expected / len(TraversalCost.PROTOCOLS)
+
+    def _orders(self, table, chain, seen):
+        for args in self._ruleset[table].get(chain, []):
+            target, _ = self._target(args)
+            if target in self._ruleset[table] and target not in seen:
+                seen.append(target)
+                self._orders(table, target, seen)
+        return seen
+
+    def parents(self, parents):
+        """The ChainCost of every (key, table, chain) parent, in order"""
+        costs = {}
+        for (key, table, o_chain) in parents:
+            parent = f"{o_chain}_orders"
+            if parent not in self._ruleset.get(table, {}):
+                continue
+
+            orders = []
+            for chain in self._orders(table, parent, []):
+                if chain.startswith("order_"):
+                    orders.append((chain, *self.chain(table, chain)))
+            label = parent if table == "filter" else f"{table}/{parent}"
+            costs[key] = ChainCost(label, *self.chain(table, parent), orders)
+        return costs
+
+    @staticmethod
+    def log(costs, budgets):
+        """Log parent and order costs, with any budget they answer to"""
+        for (key, cost) in costs.items():
+            budget = budgets.get(key)
+            limit = f", budget {budget}" if budget is not None else ""
+            Logger.log(f"{cost.label}: worst {cost.worst} rules, "
+                       f"expected {cost.expected:.2f}{limit}")
+            if cost.inlined:
+                Logger.log(f"  inlined, saving {len(cost.inlined)} jumps: "
+                           f"{' '.join(cost.inlined)}")
+            if not cost.orders:
+                continue
+
+            Logger.log(f"  {'ORDER':<32}{'WORST':>8}{'EXPECTED':>10}")
+            for (chain, worst, expected) in cost.orders:
+                Logger.log(f"  {chain:<32}{worst:>8}{expected:>10.2f}")
+
+    @staticmethod
+    def over_budget(costs, budgets):
+        """Every (label, worst, budget) a parent chain exceeds"""
+        return [(cost.label, cost.worst, budgets[key])
+                for (key, cost) in costs.items()
+                if key in budgets and cost.worst > budgets[key]]
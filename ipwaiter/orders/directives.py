@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import os
+import re
+
+from ..logger.logger import Logger
+
+
+class Directives:
+    """Rate units, spelled the way iptables-save prints them"""
+    UNITS = {
+        "s": "sec", "sec": "sec", "second": "sec",
+        "m": "min", "min": "min", "minute": "min",
+        "h": "hour", "hour": "hour",
+        "d": "day", "day": "day",
+    }
+
+    """Every generated hashlimit name, and the directive it belongs to"""
+    _names = {}
+
+    def __init__(self, path):
+        """Directives of the order at path, in effect for the rules after"""
+        self._path = path
+        self._order = os.path.basename(path)[:-len(".order")]
+        self._ratelimit = []
+        self._connlimit = []
+        self.blocklist = None
+
+    def _fail(self, number, message):
+        Logger.fatal(f"Invalid directive at {self._path}:{number}: {message}")
+
+    def _name(self, number):
+        """A hashlimit name, at most 15 characters and unique per directive"""
+        key = f"{self._order}:{number}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        name = f"ipw_{digest[:11]}"
+
+        owner = Directives._names.setdefault(name, key)
+        if owner != key:
+            self._fail(number, f"hashlimit name {name} collides with {owner}")
+        return name
+
+    def _count(self, value, number):
+        if not value.isdigit() or int(value) < 1:
+            self._fail(number, f"expected a positive number: {value}")
+        return value
+
+    def _scope(self, token, number):
+        """Parse per-src, per-dst, per-/MASK, per-src/MASK or global"""
+        if token == "global":
+            return None, None
+
+        match = re.match(r"^per-(src|dst)?(?:/(\d+))?$", token)
+        if not match or not (match.group(1) or match.group(2)):
+            self._fail(number, f"unknown scope: {token}")
+
+        direction = match.group(1) or "src"
+        mask = match.group(2)
+        if mask is not None and int(mask) > 32:
+            self._fail(number, f"invalid mask: {mask}")
+        return direction, mask
+
+    def _parse_ratelimit(self, tokens, number):
+        """@ratelimit RATE [burst N] [SCOPE], counting new connections only"""
+        if not tokens:
+            self._fail(number, "@ratelimit needs a rate")
+
+        match = re.match(r"^(\d+)/([a-z]+)$", tokens[0])
+        if not match or match.group(2) not in Directives.UNITS:
+            self._fail(number, f"invalid rate: {tokens[0]}")
+        rate = f"{self._count(match.group(1), number)}/" \
+               f"{Directives.UNITS[match.group(2)]}"
+        args = ["-m", "conntrack", "--ctstate", "NEW",
+                "-m", "hashlimit", "--hashlimit-above", rate]
+
+        rest = tokens[1:]
+        if len(rest) >= 2 and rest[0] == "burst":
+            args += ["--hashlimit-burst", self._count(rest[1], number)]
+            rest = rest[2:]
+
+        if len(rest) > 1:
+            self._fail(number, f"unexpected arguments: {' '.join(rest)}")
+
+        direction, mask = self._scope(rest[0], number) if rest \
+            else (None, None)
+        if direction:
+            args += ["--hashlimit-mode", f"{direction}ip"]
+        if mask is not None:
+            args += [f"--hashlimit-{direction}mask", mask]
+
+        return args + ["--hashlimit-name", self._name(number)]
+
+    def _parse_connlimit(self, tokens, number):
+        """@connlimit N [SCOPE], counting new connections only"""
+        if not tokens or len(tokens) > 2:
+            self._fail(number, "@connlimit needs a count and a scope")
+
+        count = self._count(tokens[0], number)
+        direction, mask = self._scope(tokens[1], number) \
+            if len(tokens) > 1 else ("src", None)
+        if not direction:
+            direction, mask = "src", "0"
+
+        return ["-m", "conntrack", "--ctstate", "NEW",
+                "-m", "connlimit", "--connlimit-above", count,
+                "--connlimit-mask", mask if mask is not None else "32",
+                f"--connlimit-{direction[0]}addr"]
+
+    def _parse_blocklist(self, tokens, number):
+        """@blocklist PATH, relative to the order file"""
+        if len(tokens) != 1:
+            self._fail(number, "@blocklist needs exactly one feed path")
+        if self.blocklist:
+            self._fail(number, "an order can only have one @blocklist")
+
+        directory = os.path.dirname(os.path.abspath(self._path))
+        return os.path.join(directory, os.path.expanduser(tokens[0]))
+
+    def parse(self, line, number):
+        """Parse a directive line, it replaces the previous one of its kind"""
+        tokens = line.split()
+        kind = tokens[0][1:]
+        args = tokens[1:]
+        off = args == ["off"]
+
+        if kind == "ratelimit":
+            self._ratelimit = [] if off \
+                else self._parse_ratelimit(args, number)
+        elif kind == "connlimit":
+            self._connlimit = [] if off \
+                else self._parse_connlimit(args, number)
+        elif kind == "blocklist":
+            self.blocklist = self._parse_blocklist(args, number)
+        else:
+            self._fail(number, f"unknown directive: {tokens[0]}")
+
+    @staticmethod
+    def _target(args):
+        for (index, arg) in enumerate(args[:-1]):
+            if arg in ["-j", "--jump"]:
+                return index, args[index + 1]
+        return len(args), None
+
+    def guards(self, table, args):
+        """Rules shedding load ahead of an ACCEPT rule
+
+        Each guard carries the matches of the rule it protects, so only
+        the traffic the rule would accept is limited. The connection limit
+        runs first, so dropped connections never take up a rate token."""
+        if table != "filter":
+            return []
+
+        index, target = Directives._target(args)
+        if target != "ACCEPT":
+            return []
+
+        matches = args[:index]
+        guards = []
+        for limit in [self._connlimit, self._ratelimit]:
+            if limit:
+                guards.append([*matches, *limit, "-j", "DROP"])
+        return guards
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import re
+
+from ..iptables.tags import Tags
+
+
+class DispatchPlan:
+
+    def __init__(self):
+        """Dispatch chains to create, and the jumps to append in order"""
+        self.chains = []
+        self.links = []
+
+
+class Dispatcher:
+    """Protocols which can carry a multiport match"""
+    PORT_PROTOCOLS = ["tcp", "udp", "udplite", "sctp", "dccp"]
+
+    """A multiport match holds at most 15 ports, a range counts as two"""
+    MAX_PORTS = 15
+
+    """Owner tagged on the jumps from a parent into its dispatch chains"""
+    OWNER = "dispatch"
+
+    """The jump target of a rule, as iptables-save prints it"""
+    TARGET = re.compile(r"(?:^|\s)-[jg] (\S+)")
+
+    def __init__(self, parent):
+        if not parent:
+            raise RuntimeError("Cannot dispatch without a parent chain")
+        self._parent = parent
+
+    @staticmethod
+    def is_dispatch_chain(parent, chain):
+        return re.match(f"^{re.escape(parent)}_[a-z0-9]+$", chain) is not None
+
+    @staticmethod
+    def owned(parent, rules):
+        """Dispatch chains the rules of parent jump into
+
+        Only jumps tagged by the dispatcher count, so a chain of someone
+        else which is merely named like a dispatch chain is left alone"""
+        chains = []
+        for rule in rules or []:
+            tag = Tags.parse(rule)
+            target = Dispatcher.TARGET.search(rule)
+            if not tag or tag[0] != Dispatcher.OWNER or not target:
+                continue
+            if Dispatcher.is_dispatch_chain(parent, target.group(1)):
+                chains.append(target.group(1))
+        return chains
+
+    @staticmethod
+    def _option_value(rule, names):
+        """Return the value of the first option in names, unless negated"""
+        for index, item in enumerate(rule[:-1]):
+            if item in names:
+                if index > 0 and rule[index - 1] == "!":
+                    return None
+                return rule[index + 1]
+        return None
+
+    @staticmethod
+    def footprint(rules):
+        """The single protocol and destination ports an order can match
+
+        Either value is None when the order is not restricted by it"""
+        protocol = None
+        ports = []
+        for index, rule in enumerate(rules):
+            rule_protocol = Dispatcher._option_value(rule,
+                                                     ["-p", "--protocol"])
+            if not rule_protocol or not rule_protocol.isalnum():
+                return None, None
+
+            rule_protocol = rule_protocol.lower()
+            if rule_protocol == "all":
+                return None, None
+            if index > 0 and rule_protocol != protocol:
+                return None, None
+            protocol = rule_protocol
+
+            if ports is not None:
+                port = Dispatcher._option_value(
+                    rule, ["--dport", "--destination-port"])
+                multi = Dispatcher._option_value(
+                    rule, ["--dports", "--destination-ports"])
+                if port:
+                    ports.append(port)
+                elif multi:
+                    ports += multi.split(",")
+                else:
+                    ports = None
+
+        if protocol is None:
+            return None, None
+
+        if ports is not None:
+            ports = list(dict.fromkeys(ports))
+        return protocol, ports
+
+    @staticmethod
+    def _port_match(protocol, members):
+        """Multiport match covering every order of the group, if any"""
+        if protocol not in Dispatcher.PORT_PROTOCOLS:
+            return []
+
+        ports = []
+        for (_, order_ports) in members:
+            if order_ports is None:
+                return []
+            ports += order_ports
+
+        ports = list(dict.fromkeys(ports))
+        size = sum(2 if ":" in port else 1 for port in ports)
+        if not ports or size > Dispatcher.MAX_PORTS:
+            return []
+
+        return ["-m", "multiport", "--dports", ",".join(ports)]
+
+    def plan(self, orders):
+        """Plan the dispatch layer for a list of (chain, footprint)
+
+        Orders restricted to a single protocol are grouped into one
+        dispatch chain per protocol. An order which can match any protocol
+        ends the group, so every packet still sees the orders which can
+        match it in the same relative order as a linear list."""
+        plan = DispatchPlan()
+        segments = {}
+        group = {}
+
+        def flush_group():
+            for protocol, members in group.items():
+                segments[protocol] = segments.get(protocol, 0) + 1
+                count = segments[protocol]
+                suffix = protocol if count == 1 else f"{protocol}{count}"
+                dispatch = f"{self._parent}_{suffix}"
+
+                plan.chains.append(dispatch)
+                match = Dispatcher._port_match(protocol, members)
+                jump = ["-p", protocol, *match, "-j", dispatch]
+                plan.links.append((self._parent,
+                                   Tags.tag(Dispatcher.OWNER, jump)))
+                for (chain, _) in members:
+                    plan.links.append((dispatch, Tags.link(chain)))
+            group.clear()
+
+        for (chain, (protocol, ports)) in orders:
+            if protocol is None:
+                flush_group()
+                plan.links.append((self._parent, Tags.link(chain)))
+            else:
+                group.setdefault(protocol, []).append((chain, ports))
+
+        flush_group()
+        return plan
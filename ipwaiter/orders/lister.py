@@ -41,17 +41,13 @@ class ListOrders:
             for order in os.listdir(order_dir):
                 abspath = utils.to_absolute_path(order_dir, order)
                 if os.path.isfile(abspath) and abspath.endswith(".order"):
-                    reader = OrderReader(abspath, None)
+                    order = OrderReader(abspath, None).as_order()
 
                     counter += 1
                     Logger.log(f"From order: {abspath}")
                     Logger.log("============================")
-                    for (table, line) in reader.as_lines():
-                        args = ""
-                        for item in line:
-                            args += f"{item} "
-                        args += "\n"
-                        Logger.log(f"{table.upper()}: {args}", end="")
+                    for rule in order.rules:
+                        Logger.log(f"{rule.table.upper()}: {rule.text()}")
                     Logger.log("")
 
         Logger.log(f"Total order count: {counter}")
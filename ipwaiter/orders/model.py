@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import sys
+
+from ..iptables.restore import Restore
+
+
+class Rule:
+    """One rule of an order, with the line it was read from
+
+    Tokens are interned, so equal rules share their strings, and the hash
+    is computed once. Two rules are equal when their table and arguments
+    are, wherever they were read from."""
+    __slots__ = ("table", "args", "line", "_hash")
+
+    def __init__(self, table, args, line=0):
+        self.table = sys.intern(table)
+        self.args = tuple(sys.intern(arg) for arg in args)
+        self.line = line
+        self._hash = hash((self.table, self.args))
+
+    def __eq__(self, other):
+        if not isinstance(other, Rule):
+            return NotImplemented
+        return (self._hash == other._hash and self.table == other.table
+                and self.args == other.args)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"Rule({self.table!r}, {list(self.args)!r}, {self.line})"
+
+    def prefixed(self, args):
+        """The same rule, from the same line, with args in front"""
+        return Rule(self.table, [*args, *self.args], self.line)
+
+    def text(self):
+        """The arguments, quoted the way iptables-restore reads them"""
+        return " ".join(Restore.quote(arg) for arg in self.args)
+
+
+class Order:
+    """The rules read from an order file, and the feed of its blocklist"""
+    __slots__ = ("name", "path", "rules", "feed")
+
+    def __init__(self, name, path, rules, feed=None):
+        self.name = sys.intern(name)
+        self.path = path
+        self.rules = tuple(rules)
+        self.feed = feed
+
+    @property
+    def chain(self):
+        return f"order_{self.name}"
+
+    def table_rules(self, table):
+        return [rule for rule in self.rules if rule.table == table]
+
+    def __repr__(self):
+        return f"Order({self.name!r}, {len(self.rules)} rules)"
+
+
+class ChainPlan:
+    """The rules one chain should hold, in order and without duplicates"""
+    __slots__ = ("table", "chain", "rules", "_hash")
+
+    def __init__(self, table, chain, rules):
+        self.table = sys.intern(table)
+        self.chain = sys.intern(chain)
+        self.rules = tuple(dict.fromkeys(rules))
+        self._hash = hash((self.table, self.chain, self.rules))
+
+    def __eq__(self, other):
+        if not isinstance(other, ChainPlan):
+            return NotImplemented
+        return (self._hash == other._hash and self.table == other.table
+                and self.chain == other.chain and self.rules == other.rules)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return (f"ChainPlan({self.table!r}, {self.chain!r}, "
+                f"{len(self.rules)} rules)")
+
+    def args(self):
+        """The rules as argument lists, as the ruleset holds them"""
+        return [list(rule.args) for rule in self.rules]
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import re
+
+from ..constants import PathConstants
+from ..iptables.restore import Restore
+from ..iptables.snapshot import Snapshot
+from ..iptables.tags import Tags
+from ..ipset.blocklist import Blocklist
+from ..logger.logger import Logger
+from .compiler import Compiler
+from .systemconf import SystemConfParser
+
+
+class Profiles:
+    """Profile chains start with this, then the profile and parent"""
+    PREFIX = "p_"
+
+    """Profile names are short, so every chain stays within the limit"""
+    NAME = re.compile(r"^[a-z0-9]{1,8}$")
+
+    """The profile of system.conf itself"""
+    DEFAULT = "default"
+
+    """Longest chain name the kernel accepts"""
+    MAX_CHAIN_LENGTH = 28
+
+    """Every (table, chain) whose parent a profile stages"""
+    PARENTS = [
+        ("filter", "input"),
+        ("filter", "forward"),
+        ("filter", "output"),
+        ("raw", "output"),
+        ("raw", "prerouting"),
+    ]
+
+    """The jump target of a rule, as iptables-save prints it"""
+    TARGET = re.compile(r"(?:^|\s)-[jg] (\S+)")
+
+    def __init__(self, order_dirs, system_conf=PathConstants.SYSTEM_CONF,
+                 profile_dir=PathConstants.PROFILE_DIR, switching=False):
+        """Profiles are system confs in profile_dir, named after their
+        file, staged next to system.conf which is the default profile.
+        switching stages them even with nothing but the default one"""
+        self._order_dirs = order_dirs
+        self._system_conf = system_conf
+        self._profile_dir = profile_dir
+        self._switching = switching
+
+    def paths(self):
+        """{profile name: system conf path}, the default one included"""
+        paths = {Profiles.DEFAULT: self._system_conf}
+        if not os.path.isdir(self._profile_dir):
+            return paths
+
+        for file in sorted(os.listdir(self._profile_dir)):
+            path = os.path.join(self._profile_dir, file)
+            if not file.endswith(".conf") or not os.path.isfile(path):
+                continue
+
+            name = file[:-len(".conf")]
+            if not Profiles.NAME.match(name) or name == Profiles.DEFAULT:
+                Logger.fatal(f"Invalid profile name: {name}, expected up "
+                             f"to 8 lowercase letters or digits")
+            paths[name] = path
+        return paths
+
+    def in_use(self):
+        """Whether hiring stages the profiles, which costs a save and a
+        restore, so only once there is another profile to switch to or
+        the parents still point into one"""
+        return (self._switching or len(self.paths()) > 1
+                or Profiles.active() is not None)
+
+    @staticmethod
+    def chain(name, o_chain):
+        return f"{Profiles.PREFIX}{name}_{o_chain}"
+
+    @staticmethod
+    def is_profile_chain(chain):
+        return chain.startswith(Profiles.PREFIX)
+
+    @staticmethod
+    def _retarget(args, names):
+        """A rule jumping into a renamed chain, tagged again if it was"""
+        for (index, arg) in enumerate(args[:-1]):
+            if arg in ["-j", "-g"] and args[index + 1] in names:
+                args = [*args[:index + 1], names[args[index + 1]],
+                        *args[index + 2:]]
+                if args[:3] == ["-m", "comment", "--comment"]:
+                    owner = args[3].split(":")[1]
+                    args = Tags.tag(owner, args[4:])
+                break
+        return args
+
+    @staticmethod
+    def _rename(name, ruleset):
+        """Move the parents and dispatch chains of a compiled ruleset into
+        the chains of a profile, order chains are shared by every one"""
+        renamed = {}
+        for (table, chains) in ruleset.items():
+            names = {}
+            for (parent_table, o_chain) in Profiles.PARENTS:
+                parent = f"{o_chain}_orders"
+                if parent_table != table:
+                    continue
+                for chain in chains:
+                    if chain == parent or chain.startswith(f"{parent}_"):
+                        names[chain] = Profiles.chain(name, o_chain) \
+                            + chain[len(parent):]
+
+            staged = {}
+            for (chain, rules) in chains.items():
+                chain = names.get(chain, chain)
+                if len(chain) > Profiles.MAX_CHAIN_LENGTH:
+                    Logger.fatal(f"Profile {name} needs chain {chain}, "
+                                 f"which is too long for the kernel")
+                staged[chain] = [Profiles._retarget(list(args), names)
+                                 for args in rules]
+            renamed[table] = staged
+        return renamed
+
+    def _staged(self, opts, ipset):
+        """The chains of every profile, checked to share order chains"""
+        merged = {}
+        owners = {}
+        for (name, path) in self.paths().items():
+            compiler = Compiler(self._order_dirs, SystemConfParser(path))
+            if ipset and name != Profiles.DEFAULT:
+                for blocklist in Blocklist.hired(compiler, opts):
+                    blocklist.load(ipset)
+
+            ruleset = Profiles._rename(name, compiler.compile(opts))
+            for (table, chains) in ruleset.items():
+                staged = merged.setdefault(table, {})
+                for (chain, rules) in chains.items():
+                    if chain in staged and staged[chain] != rules:
+                        Logger.fatal(f"Profiles {owners[(table, chain)]} and "
+                                     f"{name} place {chain} differently")
+                    staged[chain] = rules
+                    owners.setdefault((table, chain), name)
+        return merged
+
+    @staticmethod
+    def _jumps(chains):
+        """{chain: [rules jumping into a profile chain]} outside profiles"""
+        jumps = {}
+        for (chain, rules) in chains.items():
+            if Profiles.is_profile_chain(chain):
+                continue
+            for rule in rules:
+                target = Profiles.TARGET.search(rule)
+                if target and Profiles.is_profile_chain(target.group(1)):
+                    jumps.setdefault(chain, []).append(rule)
+        return jumps
+
+    def _snapshot(self, iptables):
+        saved = iptables.save()
+        if saved is None:
+            Logger.fatal("Unable to snapshot the current tables")
+        return Snapshot.parse(saved)
+
+    @staticmethod
+    def _commit(iptables, tables, failure):
+        lines = []
+        for (table, table_lines) in tables.items():
+            if table_lines:
+                lines += [f"*{table}", *table_lines, "COMMIT"]
+        if lines and not iptables.restore("\n".join(lines) + "\n"):
+            Logger.fatal(failure)
+
+    def stage(self, iptables, opts, ipset=None):
+        """Stage the chains of every profile in one restore, removing
+        those of profiles which no longer exist"""
+        merged = self._staged(opts, ipset)
+        snapshot = self._snapshot(iptables)
+
+        tables = {}
+        for (table, chains) in merged.items():
+            lines = tables.setdefault(table, [])
+            lines += [f":{chain} - [0:0]" for chain in chains]
+            for (chain, rules) in chains.items():
+                lines += [Restore.rule(chain, args) for args in rules]
+
+        for (table, chains) in snapshot.tables.items():
+            stale = [chain for chain in chains
+                     if Profiles.is_profile_chain(chain)
+                     and chain not in merged.get(table, {})]
+            lines = tables.setdefault(table, [])
+            lines += [f"-F {chain}" for chain in stale]
+            lines += [f"-X {chain}" for chain in stale]
+
+        Profiles._commit(iptables, tables, "Failed to stage profiles")
+        Logger.log(f"Staged profiles: {' '.join(self.paths())}")
+
+    def unpoint(self, iptables):
+        """Remove every jump into a profile, so the parents are free for
+        the orders of system.conf"""
+        snapshot = self._snapshot(iptables)
+        tables = {}
+        for (table, chains) in snapshot.tables.items():
+            tables[table] = [f"-D {chain} {rule}" for (chain, rules)
+                             in Profiles._jumps(chains).items()
+                             for rule in rules]
+        Profiles._commit(iptables, tables, "Failed to leave the profile")
+
+    def unstage(self, iptables):
+        """Remove every profile chain, and the order chains only profiles
+        jump into"""
+        snapshot = self._snapshot(iptables)
+        tables = {}
+        for (table, chains) in snapshot.tables.items():
+            staged = [chain for chain in chains
+                      if Profiles.is_profile_chain(chain)]
+            if not staged:
+                continue
+
+            used = set()
+            only_staged = set()
+            for (chain, rules) in chains.items():
+                for rule in rules:
+                    target = Profiles.TARGET.search(rule)
+                    if not target or not target.group(1).startswith("order_"):
+                        continue
+                    if Profiles.is_profile_chain(chain):
+                        only_staged.add(target.group(1))
+                    else:
+                        used.add(target.group(1))
+            removed = staged + sorted(only_staged - used)
+
+            lines = [f"-D {chain} {rule}" for (chain, rules)
+                     in Profiles._jumps(chains).items() for rule in rules]
+            lines += [f"-F {chain}" for chain in removed]
+            lines += [f"-X {chain}" for chain in removed]
+            tables[table] = lines
+        Profiles._commit(iptables, tables, "Failed to remove profiles")
+
+    def switch(self, iptables, name):
+        """Point every parent at the staged chains of a profile, with one
+        restore which replaces nothing but the parents"""
+        if name not in self.paths():
+            Logger.fatal(f"Unknown profile: {name}")
+
+        snapshot = self._snapshot(iptables)
+        tables = {}
+        for (table, o_chain) in Profiles.PARENTS:
+            chain = Profiles.chain(name, o_chain)
+            if snapshot.rules(table, chain) is None:
+                Logger.fatal(f"Profile {name} is not staged, hire first")
+
+            parent = f"{o_chain}_orders"
+            tables.setdefault(table, []).insert(0, f":{parent} - [0:0]")
+            tables[table].append(Restore.rule(parent, Tags.link(chain)))
+        Profiles._commit(iptables, tables, f"Failed to switch to: {name}")
+        Logger.log(f"Switched to profile: {name}")
+
+    @staticmethod
+    def active():
+        """Name of the profile last switched to, if any"""
+        try:
+            with open(PathConstants.ACTIVE_PROFILE, "r") as active:
+                return active.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def remember_active(name):
+        try:
+            os.makedirs(PathConstants.RUNTIME_DIR, exist_ok=True)
+            with open(PathConstants.ACTIVE_PROFILE, "w") as active:
+                active.write(f"{name}\n")
+        except OSError as e:
+            Logger.e(f"Unable to remember active profile: {e}")
+
+    @staticmethod
+    def forget_active():
+        """The parents hold the orders of system.conf again"""
+        try:
+            os.remove(PathConstants.ACTIVE_PROFILE)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            Logger.e(f"Unable to forget active profile: {e}")
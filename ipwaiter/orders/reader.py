@@ -20,34 +20,53 @@
 
 
 import os
+import shlex
 
+from ..ipset.blocklist import Blocklist
 from ..logger.logger import Logger
+from .bindings import Bindings
+from .directives import Directives
+from .model import Order, Rule
 
 
 class OrderReader:
+    """Address blocks bound to __ipwaiter_src and __ipwaiter_dst by default"""
+    DEFAULT_SRC = "192.168.1.0/24"
+    DEFAULT_DST = "192.168.1.0/24"
 
     def __init__(self, path, opts):
         if not os.path.isfile(path):
             Logger.fatal(f"Invalid order given: {path}")
         self._path = path
         self._opts = opts
+        self._feed = None
 
-    def _get_order(self):
+    def _read(self):
+        """Rules in the order they are read, guards first"""
         try:
             order = open(self._path, "r")
         except OSError as e:
             Logger.e("Unable to read order file")
             Logger.e(e)
-            yield ("", "")
+            return
         else:
             with order:
+                directives = Directives(self._path)
+                number = 0
                 line = order.readline()
                 while line:
+                    number += 1
+
                     # Remove all whitespace
                     line = line.strip()
 
+                    # Directives shape the rules which follow them
+                    if line.startswith("@"):
+                        line = line.split("#", 1)[0]
+                        directives.parse(line, number)
+
                     # Make sure this line is not a comment
-                    if line and not line.startswith("#"):
+                    elif line and not line.startswith("#"):
                         line = line.split("#", 1)[0]
                         line = line.rstrip()
 
@@ -56,13 +75,13 @@ class OrderReader:
                         line = line.strip()
 
                         # Assume a default
-                        src = "192.168.1.0/24"
-                        dst = "192.168.1.0/24"
+                        src = OrderReader.DEFAULT_SRC
+                        dst = OrderReader.DEFAULT_DST
 
                         # Unless we read from reader opts
                         if self._opts:
-                            opt_src = self._opts["src"]
-                            opt_dst = self._opts["dst"]
+                            opt_src = self._opts.get("src")
+                            opt_dst = self._opts.get("dst")
 
                             if opt_src:
                                 src = opt_src
@@ -70,14 +89,47 @@ class OrderReader:
                             if opt_dst:
                                 dst = opt_dst
 
+                        # An interface without an address matches nothing
+                        if (Bindings.is_bound(src) and
+                                "__ipwaiter_src" in line) or \
+                                (Bindings.is_bound(dst) and
+                                 "__ipwaiter_dst" in line):
+                            Logger.d(f"Leaving out {self._path}:{number}, "
+                                     f"its interface has no address")
+                            line = order.readline()
+                            continue
+
                         # Replace placeholder values with real
                         line = line.replace("__ipwaiter_src", src)
                         line = line.replace("__ipwaiter_dst", dst)
 
-                        # We format this so weirdly to make it easier
-                        # for waiter.py to consume
-                        yield (table, line.split())
+                        # The set of a blocklist, declared ahead of use
+                        if "__ipwaiter_blocklist" in line:
+                            if not directives.blocklist:
+                                Logger.fatal(f"Blocklist used before any "
+                                             f"@blocklist at {self._path}:"
+                                             f"{number}")
+                            line = line.replace("__ipwaiter_blocklist",
+                                                self._set_name())
+
+                        # Quoted arguments stay together
+                        args = shlex.split(line)
+                        for guard in directives.guards(table, args):
+                            yield Rule(table, guard, number)
+                        yield Rule(table, args, number)
                     line = order.readline()
+                self._feed = directives.blocklist
+
+    def _name(self):
+        name = os.path.basename(self._path)
+        if name.endswith(".order"):
+            name = name[:-len(".order")]
+        return name
+
+    def _set_name(self):
+        return Blocklist.set_name(self._name())
 
-    def as_lines(self):
-        return self._get_order()
+    def as_order(self):
+        """Read the whole order file"""
+        rules = list(self._read())
+        return Order(self._name(), self._path, rules, self._feed)
@@ -25,6 +25,10 @@ from ..logger.logger import Logger
 
 
 class SystemConfParser:
+    """Rule budgets of the parent chains, one per hire key"""
+    BUDGET_KEYS = ["MAX_RULES_FILTER_INPUT", "MAX_RULES_FILTER_FORWARD",
+                   "MAX_RULES_FILTER_OUTPUT", "MAX_RULES_RAW_OUTPUT",
+                   "MAX_RULES_RAW_PREROUTING"]
 
     def __init__(self, path):
         if not os.path.isfile(path):
@@ -71,6 +75,13 @@ class SystemConfParser:
         filter_forward = []
         filter_output = []
         raw_output = []
+        raw_prerouting = []
+        conntrack_prelude = []
+        dispatch = []
+        forward_offload = []
+        bpf_orders = []
+        inline_max_rules = []
+        budgets = {key: [] for key in SystemConfParser.BUDGET_KEYS}
 
         populate_list = SystemConfParser._attempt_populate_list
         for line in self._read_conf():
@@ -90,14 +101,53 @@ class SystemConfParser:
             if not raw_output:
                 raw_output = populate_list("RAW_OUTPUT=", line)
 
+            # If we are not filled yet, try this line
+            if not raw_prerouting:
+                raw_prerouting = populate_list("RAW_PREROUTING=", line)
+
+            # If we are not filled yet, try this line
+            if not conntrack_prelude:
+                conntrack_prelude = populate_list("CONNTRACK_PRELUDE=", line)
+
+            # If we are not filled yet, try this line
+            if not dispatch:
+                dispatch = populate_list("DISPATCH=", line)
+
+            # If we are not filled yet, try this line
+            if not forward_offload:
+                forward_offload = populate_list("FORWARD_OFFLOAD=", line)
+
+            # If we are not filled yet, try this line
+            if not bpf_orders:
+                bpf_orders = populate_list("BPF_ORDERS=", line)
+
+            # If we are not filled yet, try this line
+            if not inline_max_rules:
+                inline_max_rules = populate_list("INLINE_MAX_RULES=", line)
+
+            # Budgets are single numbers, so each is a one item list
+            for (key, budget) in budgets.items():
+                if not budget:
+                    budgets[key] = populate_list(f"{key}=", line)
+
             # If everything is filled, we can stop
             if (filter_input and filter_forward
-                    and filter_output and raw_output):
+                    and filter_output and raw_output and raw_prerouting
+                    and conntrack_prelude and dispatch and forward_offload
+                    and bpf_orders and inline_max_rules
+                    and all(budgets.values())):
                 break
 
         return {
             "FILTER_INPUT": filter_input,
             "FILTER_FORWARD": filter_forward,
             "FILTER_OUTPUT": filter_output,
-            "RAW_OUTPUT": raw_output
+            "RAW_OUTPUT": raw_output,
+            "RAW_PREROUTING": raw_prerouting,
+            "CONNTRACK_PRELUDE": conntrack_prelude,
+            "DISPATCH": dispatch,
+            "FORWARD_OFFLOAD": forward_offload,
+            "BPF_ORDERS": bpf_orders,
+            "INLINE_MAX_RULES": inline_max_rules,
+            **budgets
         }
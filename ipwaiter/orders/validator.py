@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import re
+
+import ipwaiter.utils as utils
+
+from ..ipset.blocklist import Blocklist
+from ..logger.logger import FatalError, Logger
+from .model import Rule
+from .reader import OrderReader
+
+
+class Validator:
+    """Prefix of the throwaway chains orders are validated in, and of
+    the empty sets standing in for blocklist sets"""
+    CHAIN_PREFIX = "ipwv_"
+
+    """Tables orders can place rules into"""
+    TABLES = ["filter", "raw"]
+
+    """Where iptables-restore says it stopped"""
+    ERROR_LINE = re.compile(r"line:?\s+(\d+)")
+
+    def __init__(self, iptables, order_dirs, ipset=None):
+        """Blocklist sets are stood in for through ipset, since
+        iptables-restore --test looks up every set it matches"""
+        for order_dir in order_dirs:
+            if not os.path.isdir(order_dir):
+                Logger.fatal(f"Invalid order directory given: {order_dir}")
+
+        if not iptables:
+            Logger.fatal(f"Invalid iptables handler given: {iptables}")
+
+        self._iptables = iptables
+        self._order_dirs = order_dirs
+        self._ipset = ipset
+
+    def _library(self):
+        """Every order file in every directory, shadowed ones included"""
+        for order_dir in self._order_dirs:
+            for file in sorted(os.listdir(order_dir)):
+                path = utils.to_absolute_path(order_dir, file)
+                if os.path.isfile(path) and path.endswith(".order"):
+                    yield path
+
+    @staticmethod
+    def _read(path, opts):
+        """The order at path, or the reason it cannot be read"""
+        try:
+            order = OrderReader(path, opts).as_order()
+        except ValueError as e:
+            return None, (0, str(e))
+        except FatalError as e:
+            return None, (0, str(e))
+
+        for rule in order.rules:
+            if rule.table not in Validator.TABLES:
+                return None, (rule.line, f"Unknown table: {rule.table}")
+        return order, None
+
+    @staticmethod
+    def _blocklist_sets(orders):
+        """Every blocklist set the orders match, in order of use"""
+        sets = []
+        for order in orders:
+            for rule in order.rules:
+                for (index, arg) in enumerate(rule.args[:-1]):
+                    name = rule.args[index + 1]
+                    if arg == "--match-set" and name not in sets and \
+                            name.startswith(Blocklist.PREFIX):
+                        sets.append(name)
+        return sets
+
+    def _stand_in(self, sets):
+        """{blocklist set: empty set created in its place}
+
+        The blocklists may not be loaded yet, as on a fresh boot, and
+        loaded ones are left alone"""
+        if not self._ipset or not sets:
+            return {}
+
+        stand_ins = {name: f"{Validator.CHAIN_PREFIX}{index}"
+                     for (index, name) in enumerate(sets)}
+        lines = []
+        for stand_in in stand_ins.values():
+            if self._ipset.exists(stand_in):
+                self._ipset.destroy(stand_in)
+            lines.append(f"create {stand_in} {Blocklist.TYPE}")
+        if not self._ipset.restore(lines):
+            Logger.log("Unable to create the sets standing in for "
+                       "blocklists, orders matching them may fail")
+            return {}
+        return stand_ins
+
+    @staticmethod
+    def _payload(orders, stand_ins):
+        """Build one payload, and the source of every rule line in it
+
+        Each order gets its own throwaway chain, which is never
+        committed since the payload is only tested. Blocklist sets are
+        matched through their stand ins"""
+        tables = {}
+        for (index, order) in enumerate(orders):
+            chain = f"{Validator.CHAIN_PREFIX}{index}"
+            for rule in order.rules:
+                tables.setdefault(rule.table, {}).setdefault(
+                    chain, []).append((rule, order.path))
+
+        lines = []
+        sources = {}
+        for (table, chains) in tables.items():
+            lines.append(f"*{table}")
+            for chain in chains:
+                lines.append(f":{chain} - [0:0]")
+            for (chain, rules) in chains.items():
+                for (rule, path) in rules:
+                    rule = Validator._retarget(rule, stand_ins)
+                    lines.append(f"-A {chain} {rule.text()}")
+                    sources[len(lines)] = (path, rule.line)
+            lines.append("COMMIT")
+
+        return "\n".join(lines) + "\n" if lines else "", sources
+
+    @staticmethod
+    def _retarget(rule, stand_ins):
+        """The rule, matching the stand in of each blocklist set"""
+        if not stand_ins:
+            return rule
+
+        args = list(rule.args)
+        for (index, arg) in enumerate(args[:-1]):
+            if arg == "--match-set" and args[index + 1] in stand_ins:
+                args[index + 1] = stand_ins[args[index + 1]]
+        return Rule(rule.table, args, rule.line)
+
+    def _test(self, orders, errors, stand_ins):
+        """Test orders until the rest pass, adding each failure to errors,
+        returns how many iptables-restore runs it took"""
+        runs = 0
+        while orders:
+            payload, sources = Validator._payload(orders, stand_ins)
+            if not payload:
+                break
+
+            runs += 1
+            output = self._iptables.validate(payload)
+            if output is None:
+                break
+
+            match = Validator.ERROR_LINE.search(output)
+            source = sources.get(int(match.group(1))) if match else None
+            message = output.strip().splitlines()[0] if output.strip() \
+                else "rejected by iptables-restore"
+            if not source:
+                # Nothing to blame, so nothing can be excluded either
+                errors += [(order.path, 0, message) for order in orders]
+                break
+
+            path, number = source
+            errors.append((path, number, message))
+            orders = [order for order in orders if order.path != path]
+        return runs
+
+    def run(self, opts):
+        """Validate the whole library, returns True if every order passed
+
+        The library is tested with a single iptables-restore --test, and
+        only tested again without an order which failed"""
+        orders = []
+        errors = []
+        for path in self._library():
+            order, error = Validator._read(path, opts)
+            if error:
+                errors.append((path, *error))
+            else:
+                orders.append(order)
+
+        checked = len(orders) + len(errors)
+        stand_ins = self._stand_in(Validator._blocklist_sets(orders))
+        try:
+            runs = self._test(orders, errors, stand_ins)
+        finally:
+            for stand_in in stand_ins.values():
+                self._ipset.destroy(stand_in)
+
+        for (path, number, message) in errors:
+            location = f"{path}:{number}" if number else path
+            Logger.log(f"{location}: {message}")
+
+        failed = len({path for (path, _, _) in errors})
+        Logger.log(f"Validated {checked} orders with {runs} "
+                   f"iptables-restore runs, {failed} failed")
+        return not errors
@@ -26,13 +26,22 @@ import shlex
 import ipwaiter.utils as utils
 
 from ..iptables.preconditions import Preconditions
+from ..ipset.blocklist import Blocklist
+from ..iptables.snapshot import Snapshot
+from ..iptables.tags import Tags
 from ..logger.logger import Logger
-from .reader import OrderReader
+from .compiler import Compiler
+from .cost import TraversalCost
+from .dispatch import Dispatcher
 
 
 class Waiter:
 
-    def __init__(self, iptables, order_dirs, system_conf):
+    def __init__(self, iptables, order_dirs, system_conf, compiler=None,
+                 ipset=None, nftables=None, profiles=None):
+        """Blocklists are loaded through ipset, forwarded flows are
+        offloaded through nftables and profiles are staged through
+        profiles, each skipped without its handler"""
         for order_dir in order_dirs:
             if not os.path.isdir(order_dir):
                 Logger.fatal(f"Invalid order directory given: {order_dir}")
@@ -40,15 +49,39 @@ class Waiter:
         if not iptables:
             Logger.fatal(f"Invalid iptables handler given: {iptables}")
 
+        # A compiler can be shared, so orders are only read once
+        if not compiler:
+            compiler = Compiler(order_dirs, system_conf)
+
         self._system_conf = system_conf
         self._order_dirs = order_dirs
         self._iptables = iptables
+        self._compiler = compiler
+        self._ipset = ipset
+        self._nftables = nftables
+        self._profiles = profiles
+        self._prepared = {}
+        self._loaded = set()
+
+    def _parsed_conf(self):
+        """The system conf, parsed once per run"""
+        return self._compiler.conf()
+
+    def _new_preconditions(self, raw):
+        prelude = self._parsed_conf()["CONNTRACK_PRELUDE"]
+        return Preconditions(self._iptables, self._order_dirs, raw, prelude)
+
+    def _preconditions(self, raw):
+        """Create the required chains once per run instead of per order"""
+        preconditions = self._prepared.get(raw)
+        if not preconditions:
+            preconditions = self._new_preconditions(raw)
+            preconditions.create_chains_if_needed()
+            self._prepared[raw] = preconditions
+        return preconditions
 
     def _verify(self, name, raw, chain):
-        preconditions = Preconditions(self._iptables, self._order_dirs, raw)
-
-        # Create the required chains
-        preconditions.create_chains_if_needed()
+        preconditions = self._preconditions(raw)
 
         order = preconditions.valid_order(name)
         if not order:
@@ -65,6 +98,7 @@ class Waiter:
 
     def add_order(self, order, raw, opts):
         self._add_order(order, raw, opts, report=True)
+        self._reoffload(order, raw)
 
     def _add_order(self, order, raw, opts, report):
         if not order:
@@ -85,40 +119,20 @@ class Waiter:
         if report:
             Logger.log(f"ipwaiter is placing order: {name}")
 
-        # Create the chain first
-        if not self._iptables.exists(table, chain):
-            if not self._iptables.create(table, chain):
-                if report:
-                    Logger.fatal(f"Failed to create chain: {chain} for "
-                                 f"table: {table}")
+        if (table, parent, chain) in self._compiler.inlined(opts):
+            self._inline_order(name, table, parent, path, opts, report)
+            return
 
-        # Add all of the rules for the
-        reader = OrderReader(path, opts)
-        for (read_table, read_line) in reader.as_lines():
-
-            # Read line is a simple split string, but cannot
-            # handle embedded quotes inside of strings.
-            # Join it into a string again, and re-split
-            # it with shlex for better handling
-            read_line = " ".join(read_line)
-            read_line = shlex.split(read_line)
-
-            if ((raw and read_table == "raw") or
-                    (not raw and read_table == "filter")):
-                # Add rule if needed
-                if not self._iptables.check_add(read_table, chain, read_line):
-                    if not self._iptables.add(read_table, chain, read_line):
-                        if report:
-                            Logger.fatal(f"Failed add. table {read_line}, "
-                                         f"chain {chain}, rule {read_line}")
+        self._fill_order(table, chain, path, opts, report)
 
         # Link the new chain to the parent chain
-        if self._iptables.check_link(table, parent, chain):
+        tag = Tags.link_matches(chain)
+        if self._iptables.check_link(table, parent, chain, tag):
             if report:
                 Logger.log(f"ipwaiter has already placed order: {name}")
             return
         else:
-            if not self._iptables.link(table, parent, chain):
+            if not self._iptables.link(table, parent, chain, tag):
                 if report:
                     Logger.fatal(f"Failed to link chain: {chain} "
                                  f"table: {table} to: {parent}")
@@ -126,8 +140,121 @@ class Waiter:
         if report:
             Logger.log(f"ipwaiter has placed order: {name}")
 
+    def _inline_order(self, name, table, parent, path, opts, report):
+        """Add the rules of a small order straight into its parent
+
+        They keep their tags, so the order is still removed on its own"""
+        self._load_blocklist(path, opts)
+
+        plan = self._compiler.path_plan(path, table, opts)
+        missing = [rule for rule in plan.rules
+                   if not self._iptables.check_add(table, parent, rule.args)]
+        if not missing:
+            if report:
+                Logger.log(f"ipwaiter has already placed order: {name}")
+            return
+
+        for rule in missing:
+            if not self._iptables.add(table, parent, rule.args):
+                if report:
+                    Logger.fatal(f"Failed add. table {table}, "
+                                 f"chain {parent}, rule {rule.text()}")
+
+        if report:
+            Logger.log(f"ipwaiter has inlined order: {name}")
+
+    def _fill_order(self, table, chain, path, opts, report):
+        """Create the order chain and add its rules, returning its plan"""
+        # Create the chain first
+        if not self._iptables.exists(table, chain):
+            if not self._iptables.create(table, chain):
+                if report:
+                    Logger.fatal(f"Failed to create chain: {chain} for "
+                                 f"table: {table}")
+
+        self._load_blocklist(path, opts)
+
+        # Add all of the rules for the
+        plan = self._compiler.path_plan(path, table, opts)
+        for rule in plan.rules:
+            # Add rule if needed
+            if not self._iptables.check_add(table, chain, rule.args):
+                if not self._iptables.add(table, chain, rule.args):
+                    if report:
+                        Logger.fatal(f"Failed add. table {table}, "
+                                     f"chain {chain}, rule {rule.text()}")
+
+        return plan
+
+    def _load_blocklist(self, path, opts):
+        """Load the set of a blocklist order before any rule uses it"""
+        order = self._compiler.order(path, opts)
+        if not order.feed or order.name in self._loaded:
+            return
+
+        if not self._ipset:
+            Logger.d(f"No ipset, blocklist of {order.name} is not loaded")
+            return
+
+        Blocklist(order.name, order.feed).load(self._ipset)
+        self._loaded.add(order.name)
+
+    def _dispatch_orders(self, o_chain, o_names, opts, report):
+        """Place filter orders behind a per protocol dispatch layer"""
+        placed = []
+        parent = None
+        for o_name in o_names:
+            o_name = o_name.strip()
+            verified = self._verify(o_name, False, o_chain)
+            name, table, chain, parent, path = verified
+            if report:
+                Logger.log(f"ipwaiter is placing order: {name}")
+
+            plan = self._fill_order(table, chain, path, opts, report)
+            placed.append((chain, Dispatcher.footprint(plan.args())))
+
+        if not parent:
+            return
+
+        plan = Dispatcher(parent).plan(placed)
+        for dispatch in plan.chains:
+            if not self._iptables.exists("filter", dispatch):
+                if not self._iptables.create("filter", dispatch):
+                    Logger.fatal(f"Failed to create dispatch chain: "
+                                 f"{dispatch}")
+
+        for (chain, args) in plan.links:
+            if not self._iptables.check_add("filter", chain, args):
+                if not self._iptables.add("filter", chain, args):
+                    Logger.fatal(f"Failed to link dispatch chain: {chain} "
+                                 f"rule: {args}")
+
+        if report:
+            Logger.log(f"ipwaiter has dispatched {len(placed)} orders "
+                       f"through {len(plan.chains)} chains in: {parent}")
+
+    @staticmethod
+    def _dispatch_chains(snapshot, table, parent):
+        if table != "filter":
+            return []
+
+        return Dispatcher.owned(parent, snapshot.rules(table, parent))
+
+    def _find_link(self, snapshot, table, parent, chain):
+        """Find the chain holding the link to an order, and its tag
+
+        Links placed before rules were tagged carry no tag at all"""
+        holders = [parent, *Waiter._dispatch_chains(snapshot, table, parent)]
+        for tag in [Tags.link_matches(chain), []]:
+            for holder in holders:
+                if self._iptables.check_link(table, holder, chain, tag):
+                    return holder, tag
+
+        return "", []
+
     def delete_order(self, order, raw):
         self._delete_order(order, raw, report=True, destroy=False)
+        self._reoffload(order, raw)
 
     def _delete_order(self, order, raw, report, destroy):
         if not order:
@@ -136,13 +263,51 @@ class Waiter:
         o_chain = order[0]
         o_names = order[1:]
 
+        snapshot = None
         for o_name in o_names:
             o_name = o_name.strip()
             verified = self._verify(o_name, raw, o_chain)
             name, table, chain, parent, path = verified
-            self._remove_order(name, table, chain, parent, report, destroy)
 
-    def _remove_order(self, name, table, chain, parent, report, destroy):
+            # An inlined order sits in the parent, even when a chain of it
+            # is left from a hire before it was inlined
+            snapshot = snapshot or self._snapshot()
+            if self._remove_inlined(snapshot, name, table, parent, report):
+                continue
+
+            self._remove_order(snapshot, name, table, chain, parent, report,
+                               destroy)
+
+    def _snapshot(self):
+        saved = self._iptables.save()
+        if saved is None:
+            Logger.fatal("Unable to snapshot the current tables")
+        return Snapshot.parse(saved)
+
+    def _remove_inlined(self, snapshot, name, table, parent, report):
+        """Remove the rules an order inlined into its parent, True once
+        there were some and they are gone"""
+        rules = [rule for rule in snapshot.rules(table, parent) or []
+                 if (Tags.parse(rule) or (None,))[0] == name]
+        if not rules:
+            return False
+
+        if report:
+            Logger.log(f"ipwaiter is removing inlined order: {name}")
+
+        for rule in rules:
+            if not self._iptables.remove(table, parent, shlex.split(rule)):
+                if report:
+                    Logger.fatal(f"Failed to remove rule: {rule} table: "
+                                 f"{table} from: {parent}")
+                return False
+
+        if report:
+            Logger.log(f"ipwaiter has removed order: {name}")
+        return True
+
+    def _remove_order(self, snapshot, name, table, chain, parent, report,
+                      destroy):
         # Stop if the chain does not exist
         if not self._iptables.exists(table, chain):
             if report:
@@ -153,13 +318,14 @@ class Waiter:
             Logger.log(f"ipwaiter is removing order: {name}")
 
         # Make sure we can work
-        if not self._iptables.check_link(table, parent, chain):
+        holder, tag = self._find_link(snapshot, table, parent, chain)
+        if not holder:
             if report:
                 Logger.log(f"ipwaiter has never placed order: {name}")
             return
 
         # Unlink the chain first
-        if not self._iptables.unlink(table, parent, chain):
+        if not self._iptables.unlink(table, holder, chain, tag):
             if report:
                 Logger.fatal(f"Failed to unlink chain: {chain} table: "
                              f"{table} from: {parent}")
@@ -182,35 +348,107 @@ class Waiter:
         if report:
             Logger.log(f"ipwaiter has removed order: {name}")
 
+    def _check_budgets(self, opts):
+        """Refuse a system.conf whose parent chains exceed their budget"""
+        budgets = self._compiler.budgets()
+        if not budgets:
+            return
+
+        costs = self._compiler.costs(opts)
+        exceeded = TraversalCost.over_budget(costs, budgets)
+        if exceeded:
+            Logger.fatal("Refusing to hire over rule budgets: " + ", ".join(
+                f"{label} walks up to {worst} rules of {budget}"
+                for (label, worst, budget) in exceeded))
+
     def hire_waiter(self, opts, report):
+        self._check_budgets(opts)
         Logger.log("Hiring new ipwaiter")
-        order_dict = self._system_conf.parse()
+        order_dict = self._parsed_conf()
+
+        # Hiring puts the orders of system.conf back into the parents
+        staging = self._profiles and self._profiles.in_use()
+        if staging:
+            self._profiles.unpoint(self._iptables)
 
         orders = order_dict["FILTER_INPUT"]
         if orders:
-            self._add_order(("input", *orders),
-                            raw=False, opts=opts, report=report)
+            self._hire_orders("input", orders, opts=opts, report=report)
 
         orders = order_dict["FILTER_FORWARD"]
         if orders:
-            self._add_order(("forward", *orders),
-                            raw=False, opts=opts, report=report)
+            self._hire_orders("forward", orders, opts=opts, report=report)
+
+        interfaces = order_dict["FORWARD_OFFLOAD"]
+        if interfaces:
+            self._offload_forward(interfaces, report)
 
         orders = order_dict["FILTER_OUTPUT"]
         if orders:
-            self._add_order(("output", *orders),
-                            raw=False, opts=opts, report=report)
+            self._hire_orders("output", orders, opts=opts, report=report)
 
         orders = order_dict["RAW_OUTPUT"]
         if orders:
             self._add_order(("output", *orders),
                             raw=True, opts=opts, report=report)
 
+        orders = order_dict["RAW_PREROUTING"]
+        if orders:
+            self._add_order(("prerouting", *orders),
+                            raw=True, opts=opts, report=report)
+
+        if staging:
+            self._profiles.stage(self._iptables, opts, self._ipset)
+
         Logger.log("Hired ipwaiter")
 
+    def _hire_orders(self, o_chain, orders, opts, report):
+        dispatch = [chain.lower() for chain in self._parsed_conf()["DISPATCH"]]
+        for chain in dispatch:
+            if chain not in Preconditions.FILTER_CHAINS:
+                Logger.fatal(f"Invalid dispatch chain: {chain}")
+
+        if o_chain in dispatch:
+            self._dispatch_orders(o_chain, orders, opts=opts, report=report)
+        else:
+            self._add_order((o_chain, *orders),
+                            raw=False, opts=opts, report=report)
+
+    def _offload_forward(self, interfaces, report):
+        if not self._nftables:
+            Logger.d("No nftables, forwarded flows are not offloaded")
+            return
+
+        if not self._nftables.offload(interfaces):
+            Logger.fatal(f"Failed to offload forwarded flows over: "
+                         f"{' '.join(interfaces)}")
+
+        if report:
+            Logger.log(f"ipwaiter offloads forwarded flows over: "
+                       f"{' '.join(interfaces)}")
+
+    def _reoffload(self, order, raw):
+        """Offloaded flows skip forward_orders, so once it changes they
+        are dropped from the flowtable by replacing it, and walk the
+        orders again"""
+        interfaces = self._parsed_conf()["FORWARD_OFFLOAD"]
+        if raw or not order or not interfaces or not self._nftables:
+            return
+
+        if order[0].lower() == "forward" and self._nftables.exists():
+            self._offload_forward(interfaces, report=False)
+
     def fire_waiter(self, destroy, report):
         Logger.log("Firing old ipwaiter")
 
+        # Offloaded flows skip the forward chain, so they go first
+        if self._nftables and not self._nftables.remove_offload():
+            Logger.log("Failed to remove the forward offload flowtable")
+
+        # Staged profiles jump into order chains, which they would pin
+        if self._profiles:
+            self._profiles.unstage(self._iptables)
+
         orders = []
         if destroy:
             for order_dir in self._order_dirs:
@@ -233,21 +471,50 @@ class Waiter:
             # Delete all raw
             self._delete_order(("output", *orders),
                                raw=True, report=report, destroy=True)
+            self._delete_order(("prerouting", *orders),
+                               raw=True, report=report, destroy=True)
+
+        # Dispatch chains are only known by the jumps the parents hold
+        snapshot = self._snapshot()
+        parents = ["input_orders", "forward_orders", "output_orders"]
+        dispatch = [chain for parent in parents for chain
+                    in Waiter._dispatch_chains(snapshot, "filter", parent)]
 
         # Delete the order chains
         self._iptables.flush("filter", "input_orders")
         self._iptables.flush("filter", "forward_orders")
         self._iptables.flush("filter", "output_orders")
         self._iptables.flush("raw", "output_orders")
+        self._iptables.flush("raw", "prerouting_orders")
+
+        # Dispatch chains are rebuilt on every hire
+        for chain in dispatch:
+            self._iptables.flush("filter", chain)
+            self._iptables.delete("filter", chain)
 
         if destroy:
             self._iptables.delete("filter", "input_orders")
             self._iptables.delete("filter", "forward_orders")
             self._iptables.delete("filter", "output_orders")
             self._iptables.delete("raw", "output_orders")
+            self._iptables.delete("raw", "prerouting_orders")
+
+            # Sets can only go once no rule matches them anymore
+            if self._ipset:
+                Blocklist.destroy_all(self._ipset)
+        else:
+            # Flushing dropped the prelude, pin it again so it stays
+            # above whatever orders are hired next
+            self._new_preconditions(raw=False).pin_prelude()
+
+        # Chains may have been removed, so verify them again next time
+        self._prepared = {}
+        self._loaded = set()
 
         Logger.log("Fired ipwaiter")
 
     def rehire_waiter(self, opts, report):
+        # Checked before firing, so a refused hire leaves the old waiter
+        self._check_budgets(opts)
         self.fire_waiter(destroy=False, report=report)
         self.hire_waiter(opts=opts, report=report)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import os
+import select
+import time
+
+from ..iptables.canonical import Canonical
+from ..iptables.restore import Restore
+from ..iptables.snapshot import Snapshot
+from ..iptables.tags import Tags
+from ..logger.logger import FatalError, Logger
+
+
+class Watchdog:
+
+    def __init__(self, iptables, ruleset, metrics, compiler=None,
+                 bindings=None):
+        """Keep the chains of a compiled ruleset from drifting
+
+        Counters are written in the Prometheus text format to metrics. When
+        bindings follow interfaces, the compiler patches the rules using
+        them as their addresses change"""
+        if not iptables:
+            Logger.fatal(f"Invalid iptables handler given: {iptables}")
+
+        self._iptables = iptables
+        self._ruleset = ruleset
+        self._metrics = metrics
+        self._compiler = compiler
+        self._bindings = bindings
+        self._expected = {}
+        self._learned = set()
+        self._checks = 0
+        self._repairs = 0
+        self._failures = 0
+        self._rebinds = 0
+        self._unpatched = False
+        self._drifts = collections.Counter()
+
+    def _compiled_chains(self):
+        return [(table, chain) for (table, chains) in self._ruleset.items()
+                for chain in chains]
+
+    def _snapshot(self):
+        text = self._iptables.save()
+        if text is None:
+            Logger.log("Watchdog failed to snapshot iptables")
+            return None
+        return Snapshot.parse(text)
+
+    def _compiled_digest(self, table, chain):
+        """Digest of the compiled rules of a chain, known before applying"""
+        return Canonical.digest(Canonical.rule(args)
+                                for args in self._ruleset[table][chain])
+
+    def _learn(self, snapshot, chains):
+        """Remember the digests of chains as iptables-save prints them"""
+        for (table, chain) in chains:
+            self._expected[(table, chain)] = snapshot.canonical_digest(table,
+                                                                       chain)
+            self._learned.add((table, chain))
+
+    def start(self):
+        """Apply the whole ruleset, and check that it reads back as compiled
+
+        Chains which iptables prints in a form the canonicalizer does not
+        know fall back to the digest learned from the first snapshot"""
+        for (table, chain) in self._compiled_chains():
+            self._expected[(table, chain)] = self._compiled_digest(table,
+                                                                   chain)
+
+        if not self._iptables.restore(Restore.payload(self._ruleset)):
+            Logger.fatal("Watchdog failed to apply the compiled orders")
+
+        snapshot = self._snapshot()
+        if not snapshot:
+            Logger.fatal("Watchdog cannot start without a snapshot")
+
+        unknown = [(table, chain)
+                   for ((table, chain), digest) in self._expected.items()
+                   if snapshot.canonical_digest(table, chain) != digest]
+        for (table, chain) in unknown:
+            Logger.log(f"Watchdog cannot match {table}/{chain} to its "
+                       f"compiled rules, learning it as applied")
+        self._learn(snapshot, unknown)
+        self._write_metrics()
+        Logger.log(f"Watchdog is guarding {len(self._expected)} chains")
+
+    def check(self):
+        """Compare every chain with its digest, and repair drifted chains
+
+        A failure, such as an exhausted xtables lock, is counted and the
+        next check tries again"""
+        self._checks += 1
+        try:
+            snapshot = self._snapshot()
+            if not snapshot:
+                self._failures += 1
+            else:
+                drifted = [(table, chain) for ((table, chain), digest)
+                           in self._expected.items()
+                           if snapshot.canonical_digest(table, chain)
+                           != digest]
+                if drifted:
+                    self._repair(drifted, snapshot)
+        except FatalError as e:
+            self._failures += 1
+            Logger.log(f"Watchdog check failed: {e}")
+
+        self._write_metrics()
+
+    def _missing_owners(self, snapshot, table, chain):
+        """Owners of the compiled rules of a chain which are gone"""
+        index = snapshot.index()
+        owners = []
+        for args in self._ruleset[table][chain]:
+            tag = Tags.parse(" ".join(args))
+            if tag and tag[1] not in index and tag[0] not in owners:
+                owners.append(tag[0])
+        return owners
+
+    def _repair(self, drifted, snapshot):
+        only = {}
+        for (table, chain) in drifted:
+            self._drifts[(table, chain)] += 1
+            only.setdefault(table, []).append(chain)
+            owners = self._missing_owners(snapshot, table, chain)
+            if owners:
+                Logger.log(f"Watchdog found drift in {table}/{chain}, "
+                           f"rules missing from: {' '.join(owners)}")
+            else:
+                Logger.log(f"Watchdog found drift in {table}/{chain}")
+
+        # Redeclaring a chain flushes it, so only drifted chains change
+        payload = Restore.payload(self._ruleset, only=only)
+        if not self._iptables.restore(payload):
+            self._failures += 1
+            Logger.log(f"Watchdog failed to repair {len(drifted)} chains")
+            return
+
+        self._repairs += 1
+        learned = [key for key in drifted if key in self._learned]
+        snapshot = self._snapshot() if learned else None
+        if snapshot:
+            self._learn(snapshot, learned)
+        Logger.log(f"Watchdog repaired {len(drifted)} chains")
+
+    def _following(self):
+        return bool(self._bindings and self._bindings.interfaces())
+
+    def rebind(self, interfaces):
+        """Patch the chains using an interface whose addresses changed
+
+        Only chains whose compiled rules differ are restored, so orders
+        which do not use the interface are left alone. A failed patch is
+        counted, and tried again at the next check"""
+        bound = set(self._bindings.interfaces().values())
+        if None not in interfaces and not bound & set(interfaces):
+            return
+
+        try:
+            self._rebind(bound)
+        except FatalError as e:
+            self._failures += 1
+            self._unpatched = True
+            Logger.log(f"Watchdog failed to patch chains: {e}")
+            self._write_metrics()
+
+    def _rebind(self, bound):
+        self._unpatched = False
+        ruleset = self._compiler.compile(self._bindings.resolve())
+        patched = {}
+        for (table, chains) in ruleset.items():
+            for (chain, rules) in chains.items():
+                if rules != self._ruleset.get(table, {}).get(chain):
+                    patched.setdefault(table, []).append(chain)
+        if not patched:
+            return
+
+        count = sum(len(chains) for chains in patched.values())
+        if not self._iptables.restore(Restore.payload(ruleset,
+                                                      only=patched)):
+            self._failures += 1
+            self._unpatched = True
+            Logger.log(f"Watchdog failed to patch {count} chains")
+            self._write_metrics()
+            return
+
+        self._ruleset = ruleset
+        for (table, chains) in patched.items():
+            for chain in chains:
+                self._expected[(table, chain)] = self._compiled_digest(table,
+                                                                       chain)
+                self._learned.discard((table, chain))
+        self._rebinds += 1
+        Logger.log(f"Watchdog patched {count} chains using "
+                   f"{' '.join(sorted(bound))}")
+        self._write_metrics()
+
+    def _wait(self, seconds):
+        """Sleep until the next check, patching as addresses change"""
+        if not self._following():
+            time.sleep(seconds)
+            return
+
+        addresses = self._bindings.addresses()
+        deadline = time.monotonic() + seconds
+        remaining = seconds
+        while remaining > 0:
+            ready, _, _ = select.select([addresses], [], [], remaining)
+            if ready:
+                self.rebind(addresses.changed())
+            remaining = deadline - time.monotonic()
+
+    def _write_metrics(self):
+        if not self._metrics:
+            return
+
+        lines = [
+            "# TYPE ipwaiter_watchdog_checks_total counter",
+            f"ipwaiter_watchdog_checks_total {self._checks}",
+            "# TYPE ipwaiter_watchdog_repairs_total counter",
+            f"ipwaiter_watchdog_repairs_total {self._repairs}",
+            "# TYPE ipwaiter_watchdog_failures_total counter",
+            f"ipwaiter_watchdog_failures_total {self._failures}",
+            "# TYPE ipwaiter_watchdog_rebinds_total counter",
+            f"ipwaiter_watchdog_rebinds_total {self._rebinds}",
+            "# TYPE ipwaiter_watchdog_drift_events_total counter",
+        ]
+        for ((table, chain), count) in sorted(self._drifts.items()):
+            lines.append(f"ipwaiter_watchdog_drift_events_total"
+                         f"{{table=\"{table}\",chain=\"{chain}\"}} {count}")
+
+        lock = self._iptables.lock
+        lines += [
+            "# TYPE ipwaiter_watchdog_lock_contended_total counter",
+            f"ipwaiter_watchdog_lock_contended_total {lock.contended}",
+            "# TYPE ipwaiter_watchdog_lock_retries_total counter",
+            f"ipwaiter_watchdog_lock_retries_total {lock.retries}",
+            "# TYPE ipwaiter_watchdog_lock_wait_seconds_total counter",
+            f"ipwaiter_watchdog_lock_wait_seconds_total {lock.waited:.3f}",
+        ]
+        lines.append("# TYPE ipwaiter_watchdog_last_check_seconds gauge")
+        lines.append(f"ipwaiter_watchdog_last_check_seconds {time.time():.0f}")
+
+        # Write aside and move into place, collectors never see half
+        staging = f"{self._metrics}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self._metrics) or ".", exist_ok=True)
+            with open(staging, "w") as metrics:
+                metrics.write("\n".join(lines) + "\n")
+            os.replace(staging, self._metrics)
+        except OSError as e:
+            Logger.e(f"Unable to write watchdog metrics: {e}")
+
+    def run(self, interval):
+        """Guard the ruleset until interrupted"""
+        if interval <= 0:
+            Logger.fatal(f"Invalid watchdog interval: {interval}")
+
+        # Follow before applying, so no address change goes unseen
+        if self._following():
+            self._bindings.addresses().subscribe()
+
+        self.start()
+        try:
+            if self._following():
+                self.rebind({None})
+            while True:
+                self._wait(interval)
+                if self._unpatched:
+                    self.rebind({None})
+                self.check()
+        except KeyboardInterrupt:
+            Logger.log("Watchdog stopped")
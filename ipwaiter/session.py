@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import os
+import sys
+
+from .constants import PathConstants
+from .iptables.iptables import Iptables
+from .iptables.lock import XtablesLock
+from .iptables.memory import MemoryIptables
+from .iptables.restore import Restore
+from .iptables.rollback import Rollback
+from .iptables.snapshot import Snapshot
+from .ipset.ipset import Ipset
+from .logger.logger import FatalError, Logger
+from .nftables.nftables import Nftables
+from .orders.bindings import Bindings
+from .orders.compiler import Compiler
+from .orders.systemconf import SystemConfParser
+from .orders.waiter import Waiter
+
+
+class Session:
+
+    def __init__(self, order_dirs=None, system_conf=PathConstants.SYSTEM_CONF,
+                 netns=None, iptables=None, ipset=None, nftables=None,
+                 lock=None):
+        """Drive ipwaiter from Python, keeping state between calls
+
+        The order index and compiled orders are read once, and the tables
+        are only read again after refresh(). Failures raise FatalError
+        instead of exiting. Without order_dirs, the system and admin
+        order directories are searched, admin orders first."""
+        if order_dirs is None:
+            order_dirs = [order_dir for order_dir in
+                          [PathConstants.ADMIN_CONFIG_DIR,
+                           PathConstants.SYSTEM_CONFIG_DIR]
+                          if os.path.isdir(order_dir)]
+
+        if not iptables:
+            iptables = Iptables(netns=netns, lock=lock or XtablesLock())
+            ipset = ipset or Ipset(netns=netns)
+            nftables = nftables or Nftables(netns=netns)
+
+        self._order_dirs = order_dirs
+        self._system_conf = SystemConfParser(system_conf)
+        self._iptables = iptables
+        self._ipset = ipset
+        self._nftables = nftables
+        self._compiler = Compiler(order_dirs, self._system_conf)
+        self._live = None
+        self._memory = None
+        self._before = None
+        self._waiter = None
+
+    def refresh(self):
+        """Forget the tables, they are read again on the next change"""
+        self._live = None
+
+    def _current(self):
+        if self._live is None:
+            saved = self._iptables.save()
+            if saved is None:
+                Logger.fatal("Unable to snapshot the current tables")
+            self._live = saved
+        return self._live
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Queue every change made inside the block, and commit them as
+        one restore when it exits
+
+        Changes run against an in memory copy of the tables, so nothing
+        reaches the kernel if the block raises. Blocklists and the
+        forward offload still change as their operations run."""
+        if self._waiter:
+            raise FatalError("Transactions cannot be nested")
+
+        self._memory = MemoryIptables()
+        self._memory.load(self._current())
+        self._before = Snapshot.parse(self._memory.save())
+        self._waiter = Waiter(self._memory, self._order_dirs,
+                              self._system_conf, self._compiler,
+                              ipset=self._ipset, nftables=self._nftables)
+        try:
+            yield self
+            self._commit()
+        finally:
+            self._memory = None
+            self._before = None
+            self._waiter = None
+
+    def _commit(self):
+        after = self._memory.save()
+        payload = Restore.diff(self._before, Snapshot.parse(after))
+        if not payload:
+            return
+
+        # A table which fails to commit undoes those committed before it
+        with Rollback(self._iptables):
+            if not self._iptables.restore(payload):
+                self._live = None
+                Logger.fatal("Failed to commit the transaction")
+        self._live = after
+
+    @contextlib.contextmanager
+    def _operation(self):
+        """Run one change in the open transaction, or in its own
+
+        Progress goes to stderr, stdout belongs to the caller"""
+        with Logger.redirected(sys.stderr):
+            if self._waiter:
+                yield self._waiter
+            else:
+                with self.transaction():
+                    yield self._waiter
+
+    @staticmethod
+    def _bind(opts):
+        """Options with @IFACE resolved to the network of the interface"""
+        return Bindings(opts).resolve() if Bindings.any_bound(opts) else opts
+
+    def add(self, chain, *orders, raw=False, opts=None):
+        """Add orders to a chain of the filter, or raw, table"""
+        with self._operation() as waiter:
+            waiter.add_order([chain, *orders], raw, Session._bind(opts))
+
+    def delete(self, chain, *orders, raw=False):
+        """Delete orders from a chain of the filter, or raw, table"""
+        with self._operation() as waiter:
+            waiter.delete_order([chain, *orders], raw)
+
+    def hire(self, opts=None):
+        """Hire every order listed in the system conf"""
+        with self._operation() as waiter:
+            waiter.hire_waiter(opts=Session._bind(opts), report=False)
+
+    def fire(self, destroy=False):
+        """Fire every order, destroying the parent chains with destroy"""
+        with self._operation() as waiter:
+            waiter.fire_waiter(destroy=destroy, report=False)
+
+    def plan(self, opts=None):
+        """The restore hire would commit, without committing it
+
+        Inside a transaction, the changes queued so far are planned on"""
+        memory = MemoryIptables()
+        memory.load(self._memory.save() if self._memory
+                    else self._current())
+        before = Snapshot.parse(memory.save())
+
+        waiter = Waiter(memory, self._order_dirs, self._system_conf,
+                        self._compiler)
+        with Logger.redirected(sys.stderr):
+            waiter.hire_waiter(opts=Session._bind(opts), report=False)
+        return Restore.diff(before, Snapshot.parse(memory.save()))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import bisect
+import csv
+import socket
+import struct
+
+from .rules import RuleCompiler
+
+
+class PacketBatch:
+    """Columns every packet carries"""
+    COLUMNS = ["proto", "src", "dst", "sport", "dport", "state"]
+
+    def __init__(self, rows):
+        """Rows are tuples holding the COLUMNS of one packet"""
+        self.size = len(rows)
+        self.everything = frozenset(range(self.size))
+        self._columns = {}
+        for (position, column) in enumerate(PacketBatch.COLUMNS):
+            self._columns[column] = [row[position] for row in rows]
+        self._sorted = {}
+        self._cache = {}
+
+    def column(self, name):
+        return self._columns[name]
+
+    def _sorted_column(self, column):
+        if column not in self._sorted:
+            values = self._columns[column]
+            order = sorted(range(self.size), key=values.__getitem__)
+            self._sorted[column] = ([values[i] for i in order], order)
+        return self._sorted[column]
+
+    def _range(self, column, low, high):
+        """Every packet whose column lies within [low, high]"""
+        values, order = self._sorted_column(column)
+        start = bisect.bisect_left(values, low)
+        end = bisect.bisect_right(values, high)
+        return frozenset(order[start:end])
+
+    def _flags(self, flags):
+        """Every packet whose state is one of the flags"""
+        values = self._columns["state"]
+        return frozenset(i for i in range(self.size) if values[i] & flags)
+
+    def select(self, column, ranges, negate):
+        """The set of packets matching a predicate, computed once per batch"""
+        key = (column, tuple(ranges), negate)
+        if key not in self._cache:
+            if column == "state":
+                selected = self._flags(ranges[0][0])
+            else:
+                selected = frozenset()
+                for (low, high) in ranges:
+                    selected = selected.union(self._range(column, low, high))
+            if negate:
+                selected = self.everything - selected
+            self._cache[key] = selected
+        return self._cache[key]
+
+
+class TraceReader:
+    """Chains a packet in a trace may traverse"""
+    CHAINS = ["input", "forward", "output", "raw-output", "raw-prerouting"]
+
+    def __init__(self, path, batch_size):
+        self._path = path
+        self._batch_size = batch_size
+
+    @staticmethod
+    def _address(value):
+        if not value:
+            return 0
+        return struct.unpack("!I", socket.inet_aton(value.split("/")[0]))[0]
+
+    @staticmethod
+    def _number(value):
+        return int(value) if value else 0
+
+    @staticmethod
+    def _state(value):
+        flags = 0
+        for state in (value or "NEW").upper().split(","):
+            flags |= RuleCompiler.STATES[state]
+        return flags
+
+    @staticmethod
+    def _protocol(value):
+        return RuleCompiler.protocol(value or "0")
+
+    @staticmethod
+    def _converter(convert):
+        """Memoize a field conversion, traces repeat most of their values"""
+        memo = {}
+
+        def converted(value):
+            result = memo.get(value)
+            if result is None:
+                result = convert(value)
+                memo[value] = result
+            return result
+        return converted
+
+    def batches(self):
+        """Yield (chain, PacketBatch) from the trace, in bounded batches"""
+        converters = {
+            "proto": TraceReader._converter(TraceReader._protocol),
+            "src": TraceReader._converter(TraceReader._address),
+            "dst": TraceReader._converter(TraceReader._address),
+            "sport": TraceReader._number,
+            "dport": TraceReader._number,
+            "state": TraceReader._converter(TraceReader._state),
+        }
+
+        pending = {}
+        with open(self._path, "r", newline="") as trace:
+            lines = (line for line in trace if not line.startswith("#"))
+            records = csv.reader(lines)
+            header = [name.strip().lower() for name in next(records, [])]
+
+            fields = []
+            for column in PacketBatch.COLUMNS:
+                position = header.index(column) if column in header else None
+                fields.append((position, converters[column]))
+            chain_position = header.index("chain") \
+                if "chain" in header else None
+
+            for (number, record) in enumerate(records, 1):
+                if chain_position is None:
+                    chain = "input"
+                else:
+                    chain = record[chain_position].lower() or "input"
+                if chain not in TraceReader.CHAINS:
+                    raise ValueError(f"Unknown chain in record {number}: "
+                                     f"{chain}")
+
+                try:
+                    row = tuple(
+                        convert(record[position] if position is not None
+                                else "")
+                        for (position, convert) in fields)
+                except (IndexError, KeyError, ValueError, OSError) as e:
+                    raise ValueError(f"Invalid packet in record "
+                                     f"{number}: {e}")
+
+                rows = pending.setdefault(chain, [])
+                rows.append(row)
+                if len(rows) >= self._batch_size:
+                    yield chain, PacketBatch(rows)
+                    pending[chain] = []
+
+        for (chain, rows) in pending.items():
+            if rows:
+                yield chain, PacketBatch(rows)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import ipaddress
+import socket
+
+
+class MatchRule:
+
+    def __init__(self, predicates, target, goto, approximate):
+        """Predicates are (column, values, negate) tuples, values being
+        a list of inclusive (low, high) ranges over the column"""
+        self.predicates = predicates
+        self.target = target
+        self.goto = goto
+        self.approximate = approximate
+
+
+class RuleCompiler:
+    """Protocol numbers for the names iptables accepts"""
+    PROTOCOLS = {
+        "all": 0, "icmp": 1, "igmp": 2, "tcp": 6, "udp": 17, "gre": 47,
+        "esp": 50, "ah": 51, "sctp": 132, "udplite": 136,
+    }
+
+    """Connection tracking states, as bit flags"""
+    STATES = {
+        "INVALID": 1, "ESTABLISHED": 2, "NEW": 4, "RELATED": 8,
+        "UNTRACKED": 16, "SNAT": 32, "DNAT": 64,
+    }
+
+    """ICMP type names, matched against the destination port column"""
+    ICMP_TYPES = {
+        "any": (0, 255), "echo-reply": (0, 0), "pong": (0, 0),
+        "destination-unreachable": (3, 3), "source-quench": (4, 4),
+        "redirect": (5, 5), "echo-request": (8, 8), "ping": (8, 8),
+        "router-advertisement": (9, 9), "router-solicitation": (10, 10),
+        "time-exceeded": (11, 11), "ttl-exceeded": (11, 11),
+        "parameter-problem": (12, 12), "timestamp-request": (13, 13),
+        "timestamp-reply": (14, 14),
+    }
+
+    """Match modules whose options are fully understood"""
+    EXACT_MODULES = ["tcp", "udp", "icmp", "multiport", "conntrack",
+                     "state", "comment"]
+
+    """Options matching only once a limit is exceeded, which the
+    simulation assumes it never is"""
+    ABOVE_OPTIONS = ["--hashlimit-above", "--connlimit-above"]
+
+    """Options which carry no meaning for the simulation"""
+    IGNORED_OPTIONS = {"--comment": 1}
+
+    """Targets which never end the traversal of a packet"""
+    CONTINUE_TARGETS = ["LOG", "NFLOG", "CT", "NOTRACK", "MARK", "CONNMARK",
+                        "TRACE", "AUDIT"]
+
+    def __init__(self, chains):
+        """Chains are the names a jump target may refer to"""
+        self._chains = chains
+
+    @staticmethod
+    def protocol(value):
+        value = value.lower()
+        if value.isdigit():
+            return int(value)
+        if value not in RuleCompiler.PROTOCOLS:
+            raise ValueError(f"Unknown protocol: {value}")
+        return RuleCompiler.PROTOCOLS[value]
+
+    @staticmethod
+    def _port(value, protocol):
+        if value.isdigit():
+            return int(value)
+        return socket.getservbyname(value, protocol or "tcp")
+
+    @staticmethod
+    def _ports(value, protocol):
+        ranges = []
+        for item in value.split(","):
+            if ":" in item:
+                low, high = item.split(":", 1)
+                low = RuleCompiler._port(low, protocol) if low else 0
+                high = RuleCompiler._port(high, protocol) if high else 65535
+            else:
+                low = high = RuleCompiler._port(item, protocol)
+            ranges.append((low, high))
+        return ranges
+
+    @staticmethod
+    def _network(value):
+        network = ipaddress.ip_network(value, strict=False)
+        if network.version != 4:
+            raise ValueError(f"Only IPv4 networks are simulated: {value}")
+        return [(int(network.network_address),
+                 int(network.broadcast_address))]
+
+    @staticmethod
+    def _states(value):
+        flags = 0
+        for state in value.upper().split(","):
+            flags |= RuleCompiler.STATES[state]
+        return [(flags, flags)]
+
+    @staticmethod
+    def _icmp_type(value):
+        value = value.lower()
+        if value in RuleCompiler.ICMP_TYPES:
+            return [RuleCompiler.ICMP_TYPES[value]]
+        icmp_type = int(value.split("/", 1)[0])
+        return [(icmp_type, icmp_type)]
+
+    def compile(self, args):
+        """Compile rule arguments into a MatchRule"""
+        predicates = []
+        target = None
+        goto = False
+        approximate = False
+        protocol = None
+        negate = False
+
+        index = 0
+        while index < len(args):
+            option = args[index]
+            value = args[index + 1] if index + 1 < len(args) else ""
+            index += 2
+
+            if option == "!":
+                negate = True
+                index -= 1
+                continue
+
+            if option in ["-p", "--protocol"]:
+                protocol = value.lower()
+                number = RuleCompiler.protocol(value)
+                if number != 0:
+                    predicates.append(("proto", [(number, number)], negate))
+                elif negate:
+                    predicates.append(("proto", [(0, 255)], True))
+            elif option in ["-s", "--source"]:
+                predicates.append(("src", self._network(value), negate))
+            elif option in ["-d", "--destination"]:
+                predicates.append(("dst", self._network(value), negate))
+            elif option in ["--sport", "--source-port",
+                            "--sports", "--source-ports"]:
+                predicates.append(
+                    ("sport", self._ports(value, protocol), negate))
+            elif option in ["--dport", "--destination-port",
+                            "--dports", "--destination-ports"]:
+                predicates.append(
+                    ("dport", self._ports(value, protocol), negate))
+            elif option in ["--ctstate", "--state"]:
+                predicates.append(("state", self._states(value), negate))
+            elif option == "--icmp-type":
+                predicates.append(("dport", self._icmp_type(value), negate))
+            elif option in ["-j", "--jump", "-g", "--goto"]:
+                target = value
+                goto = option in ["-g", "--goto"]
+                # Target options carry no match semantics
+                break
+            elif option in ["-m", "--match"]:
+                if value not in RuleCompiler.EXACT_MODULES:
+                    approximate = True
+            elif option in RuleCompiler.ABOVE_OPTIONS:
+                # A predicate without ranges never matches
+                predicates.append(("proto", [], False))
+                approximate = True
+            elif option in RuleCompiler.IGNORED_OPTIONS:
+                pass
+            else:
+                # Unknown options are assumed to match, but the
+                # rule is flagged so the report can say so
+                approximate = True
+                if not value or value == "!" or value.startswith("-"):
+                    index -= 1
+
+            negate = False
+
+        if (target and target not in self._chains
+                and target not in ["ACCEPT", "DROP", "REJECT", "RETURN"]
+                and target not in RuleCompiler.CONTINUE_TARGETS):
+            approximate = True
+
+        return MatchRule(predicates, target, goto, approximate)
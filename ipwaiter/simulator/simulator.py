@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import time
+
+from ..logger.logger import Logger
+from .packets import TraceReader
+from .rules import RuleCompiler
+
+
+class SimulationReport:
+
+    def __init__(self):
+        self.packets = 0
+        self.seconds = 0.0
+        self.approximate = 0
+        self.verdicts = {}
+        self.depths = {}
+
+    def record(self, chain, deciders, verdicts, depths):
+        """Count the outcome of a whole batch of packets"""
+        chain_verdicts = self.verdicts.setdefault(chain, {})
+        counted = collections.Counter(zip(deciders, verdicts))
+        for ((decider, verdict), count) in counted.items():
+            counter = chain_verdicts.setdefault(decider, collections.Counter())
+            counter[verdict] += count
+
+        chain_depths = self.depths.setdefault(chain, {})
+        counted = collections.Counter(zip(deciders, depths))
+        for ((decider, depth), count) in counted.items():
+            counter = chain_depths.setdefault(decider, collections.Counter())
+            counter[depth] += count
+
+    @staticmethod
+    def _percentile(histogram, fraction):
+        total = sum(histogram.values())
+        wanted = max(1, int(total * fraction + 0.5))
+        seen = 0
+        for depth in sorted(histogram):
+            seen += histogram[depth]
+            if seen >= wanted:
+                return depth
+        return 0
+
+    @staticmethod
+    def _mean(histogram):
+        total = sum(histogram.values())
+        if not total:
+            return 0.0
+        return sum(depth * count for (depth, count) in histogram.items()) \
+            / total
+
+    def log(self):
+        rate = self.packets / self.seconds if self.seconds else 0
+        Logger.log(f"Simulated {self.packets} packets in "
+                   f"{self.seconds:.2f}s ({rate:.0f} packets/s)")
+        if self.approximate:
+            Logger.log(f"Approximated {self.approximate} rules with matches "
+                       f"the simulator does not model, treated as matching")
+
+        for (chain, deciders) in self.depths.items():
+            combined = collections.Counter()
+            for histogram in deciders.values():
+                combined.update(histogram)
+
+            Logger.log("")
+            Logger.log(f"{chain}: {sum(combined.values())} packets, "
+                       f"mean depth {self._mean(combined):.2f}, "
+                       f"max depth {max(combined)}")
+            Logger.log(f"  {'ORDER':<24}{'PACKETS':>10}{'ACCEPT':>10}"
+                       f"{'DROP':>10}{'REJECT':>10}{'MEAN':>8}{'P50':>6}"
+                       f"{'P99':>6}{'MAX':>6}")
+            ranked = sorted(deciders.items(),
+                            key=lambda item: -sum(item[1].values()))
+            for (decider, histogram) in ranked:
+                verdicts = self.verdicts[chain][decider]
+                Logger.log(f"  {decider:<24}{sum(histogram.values()):>10}"
+                           f"{verdicts['ACCEPT']:>10}{verdicts['DROP']:>10}"
+                           f"{verdicts['REJECT']:>10}"
+                           f"{self._mean(histogram):>8.2f}"
+                           f"{self._percentile(histogram, 0.5):>6}"
+                           f"{self._percentile(histogram, 0.99):>6}"
+                           f"{max(histogram):>6}")
+
+
+class Simulator:
+    """Trace chains and the table and parent chain they enter"""
+    ENTRIES = {
+        "input": ("filter", "input_orders"),
+        "forward": ("filter", "forward_orders"),
+        "output": ("filter", "output_orders"),
+        "raw-output": ("raw", "output_orders"),
+        "raw-prerouting": ("raw", "prerouting_orders"),
+    }
+
+    """Targets which decide the fate of a packet"""
+    TERMINAL_TARGETS = ["ACCEPT", "DROP", "REJECT"]
+
+    """Batches bound the memory used, regardless of the trace size"""
+    BATCH_SIZE = 65536
+
+    def __init__(self, ruleset):
+        """Compile a {table: {chain: [rule args]}} ruleset for matching"""
+        self._approximate = 0
+        self._tables = {}
+        for (table, chains) in ruleset.items():
+            compiler = RuleCompiler(list(chains))
+            compiled = {}
+            for (chain, rules) in chains.items():
+                compiled[chain] = [compiler.compile(args) for args in rules]
+                self._approximate += sum(1 for rule in compiled[chain]
+                                         if rule.approximate)
+            self._tables[table] = compiled
+
+    @staticmethod
+    def _label(chain):
+        if chain.startswith("order_"):
+            return chain[len("order_"):]
+        return f"({chain})"
+
+    def _traverse(self, table, chain, live, batch, outcome, stack):
+        """Walk a set of packets through a chain, returning those which
+        come back to the caller
+
+        The depth of a packet grows by the position it leaves each chain
+        at, which counts every rule it was evaluated against."""
+        depth, verdict, decider = outcome
+        rules = self._tables[table][chain]
+        returned = set()
+
+        for (position, rule) in enumerate(rules, start=1):
+            if not live:
+                break
+
+            matched = live
+            for (column, ranges, negate) in rule.predicates:
+                matched = matched & batch.select(column, ranges, negate)
+                if not matched:
+                    break
+            if not matched:
+                continue
+
+            target = rule.target
+            if target in Simulator.TERMINAL_TARGETS:
+                label = Simulator._label(chain)
+                for packet in matched:
+                    depth[packet] += position
+                    verdict[packet] = target
+                    decider[packet] = label
+                live = live - matched
+            elif target == "RETURN":
+                for packet in matched:
+                    depth[packet] += position
+                returned.update(matched)
+                live = live - matched
+            elif target in self._tables[table] and target not in stack:
+                back = self._traverse(table, target, matched, batch,
+                                      outcome, stack + [target])
+                decided = matched - back
+                for packet in decided:
+                    depth[packet] += position
+                live = live - decided
+                if rule.goto:
+                    for packet in back:
+                        depth[packet] += position
+                    returned.update(back)
+                    live = live - back
+
+        for packet in live:
+            depth[packet] += len(rules)
+        returned.update(live)
+        return returned
+
+    def run(self, path):
+        """Simulate every packet of a CSV trace"""
+        report = SimulationReport()
+        report.approximate = self._approximate
+
+        started = time.monotonic()
+        reader = TraceReader(path, Simulator.BATCH_SIZE)
+        for (entry, batch) in reader.batches():
+            table, chain = Simulator.ENTRIES[entry]
+            outcome = ([0] * batch.size, [None] * batch.size,
+                       [None] * batch.size)
+            self._traverse(table, chain, set(batch.everything), batch,
+                           outcome, [chain])
+
+            depth, verdict, decider = outcome
+            decider = [label or "(unmatched)" for label in decider]
+            report.record(chain if table == "filter" else f"raw/{chain}",
+                          decider, verdict, depth)
+            report.packets += batch.size
+
+        report.seconds = time.monotonic() - started
+        return report
@@ -18,6 +18,19 @@
 #    with this program; if not, write to the Free Software Foundation, Inc.,
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import os
+
 
 def to_absolute_path(directory, file):
     return f"{directory}/{file}"
+
+
+def index_orders(order_dirs):
+    """Map every order name to its path, earlier directories win"""
+    index = {}
+    for order_dir in order_dirs:
+        for file in os.listdir(order_dir):
+            abspath = to_absolute_path(order_dir, file)
+            if os.path.isfile(abspath) and abspath.endswith(".order"):
+                index.setdefault(file[:-len(".order")], abspath)
+    return index
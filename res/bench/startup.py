@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""Fail when starting ipwaiter gets slower
+
+Every command path should only import what it uses, so importing
+ipwaiter must not pull in the modules listed in HEAVY, and starting the
+fast commands must stay within BUDGET seconds of a bare interpreter."""
+
+import os
+import statistics
+import subprocess
+import sys
+
+"""Modules only the command paths which use them may import"""
+HEAVY = [
+    "ipwaiter.iptables.iptables",
+    "ipwaiter.orders.compiler",
+    "ipwaiter.orders.waiter",
+    "ipwaiter.netns.netns",
+    "ipwaiter.simulator.simulator",
+    "ipwaiter.session",
+    "concurrent.futures",
+]
+
+"""Commands timed, as arguments to python"""
+COMMANDS = [
+    ["-m", "ipwaiter", "--version"],
+    ["-m", "ipwaiter", "--complete"],
+]
+
+"""Seconds a command may take over a bare interpreter"""
+BUDGET = float(os.environ.get("IPWAITER_STARTUP_BUDGET", "0.05"))
+
+RUNS = 15
+
+
+def _median(args):
+    times = []
+    for _ in range(RUNS):
+        started = subprocess.run(
+            [sys.executable, "-c",
+             "import subprocess, sys, time; s = time.monotonic(); "
+             "subprocess.run(sys.argv[1:], stdout=subprocess.DEVNULL); "
+             "print(time.monotonic() - s)",
+             sys.executable, *args],
+            check=True, stdout=subprocess.PIPE, text=True)
+        times.append(float(started.stdout))
+    return statistics.median(times)
+
+
+def main():
+    imported = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, ipwaiter; print(' '.join(sys.modules))"],
+        check=True, stdout=subprocess.PIPE, text=True).stdout.split()
+    heavy = [module for module in HEAVY if module in imported]
+
+    bare = _median(["-c", "pass"])
+    slow = []
+    for args in COMMANDS:
+        overhead = _median(args) - bare
+        print(f"{' '.join(args[1:]):<32}{overhead * 1000:>8.1f} ms")
+        if overhead > BUDGET:
+            slow.append(" ".join(args[1:]))
+
+    for module in heavy:
+        print(f"import ipwaiter pulls in {module}")
+    for command in slow:
+        print(f"{command} is over its budget of {BUDGET * 1000:.0f} ms")
+    return 1 if heavy or slow else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
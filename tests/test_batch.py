@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.orders.batch import Batch
+from ipwaiter.orders.systemconf import SystemConfParser
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.orders = os.path.join(directory.name, "orders")
+        shutil.copytree(ORDERS, self.orders)
+        with open(os.path.join(self.orders, "broken.order"), "w") as order:
+            order.write("@ratelimit\n")
+
+        self.conf = os.path.join(directory.name, "system.conf")
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_INPUT="sshd"\n')
+        self.feed = os.path.join(directory.name, "batch")
+
+    def _run(self, lines):
+        with open(self.feed, "w") as feed:
+            feed.write("\n".join(lines) + "\n")
+
+        self.iptables = MemoryIptables()
+        batch = Batch(self.iptables, [self.orders],
+                      SystemConfParser(self.conf))
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            with contextlib.redirect_stderr(io.StringIO()):
+                applied = batch.run(self.feed, {}, report=False)
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        return applied, results
+
+    def test_batch_reports_every_operation(self):
+        applied, results = self._run(["hire", "add input icmp-block"])
+        self.assertTrue(applied)
+        self.assertEqual([result["status"] for result in results],
+                         ["ok", "ok"])
+
+    def test_failed_operation_is_reported_and_the_rest_skipped(self):
+        applied, results = self._run(["hire", "add input broken",
+                                      "add input icmp-block"])
+        self.assertFalse(applied)
+        self.assertEqual([result["status"] for result in results],
+                         ["skipped", "failed", "skipped"])
+        self.assertIn("broken", results[1]["error"])
+        self.assertNotIn("error", results[0])
+        self.assertEqual(self.iptables.operations["restore"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
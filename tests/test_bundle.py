@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ipwaiter.constants import PathConstants
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.orders.bundle import Bundle
+from ipwaiter.orders.compiler import Compiler
+from ipwaiter.orders.systemconf import SystemConfParser
+
+
+class RecordedIpset:
+    """Keeps every ipset restore, and has no sets of its own"""
+
+    def __init__(self):
+        self.restored = []
+
+    def exists(self, name):
+        return False
+
+    def restore(self, lines):
+        self.restored.append(list(lines))
+        return True
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.orders = os.path.join(directory.name, "orders")
+        os.mkdir(self.orders)
+        with open(os.path.join(self.orders, "drop.order"), "w") as order:
+            order.write("@blocklist drop.txt\n"
+                        "filter  -m set --match-set __ipwaiter_blocklist "
+                        "src -j DROP\n")
+        with open(os.path.join(self.orders, "drop.txt"), "w") as feed:
+            feed.write("192.0.2.0/25 ; first half\n"
+                       "192.0.2.128/25\n"
+                       "198.51.100.7\n")
+
+        self.conf = os.path.join(directory.name, "system.conf")
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_INPUT="drop"\n')
+
+        active = mock.patch.object(PathConstants, "ACTIVE_BUNDLE",
+                                   os.path.join(directory.name, "bundle"))
+        active.start()
+        self.addCleanup(active.stop)
+        runtime = mock.patch.object(PathConstants, "RUNTIME_DIR",
+                                    directory.name)
+        runtime.start()
+        self.addCleanup(runtime.stop)
+
+    def _bundle(self):
+        compiler = Compiler([self.orders], SystemConfParser(self.conf))
+        return Bundle.compile(compiler, {})
+
+    def test_bundle_embeds_collapsed_blocklists(self):
+        self.assertEqual(self._bundle().content["blocklists"],
+                         {"ipwb_drop": ["192.0.2.0/24", "198.51.100.7/32"]})
+
+    def test_import_loads_blocklists_before_the_rules(self):
+        iptables = MemoryIptables()
+        ipset = RecordedIpset()
+        with contextlib.redirect_stderr(io.StringIO()):
+            self._bundle().apply(iptables, ipset)
+
+        self.assertEqual(len(ipset.restored), 1)
+        self.assertIn("add ipwb_drop_new 192.0.2.0/24", ipset.restored[0])
+        self.assertIn("swap ipwb_drop_new ipwb_drop", ipset.restored[0])
+        self.assertIn("order_drop", iptables.chains("filter"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shlex
+import tempfile
+import unittest
+
+from ipwaiter.iptables.canonical import Canonical
+from ipwaiter.iptables.snapshot import Snapshot
+from ipwaiter.orders.reader import OrderReader
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), "canonical.corpus")
+
+
+def corpus():
+    """Every (compiled, saved) pair of the corpus"""
+    with open(CORPUS, "r") as pairs:
+        lines = [line.rstrip("\n") for line in pairs
+                 if not line.startswith("#")]
+
+    blocks = "\n".join(lines).strip().split("\n\n")
+    return [tuple(block.strip().split("\n")) for block in blocks]
+
+
+class CanonicalTest(unittest.TestCase):
+
+    def test_corpus_is_pairs(self):
+        for pair in corpus():
+            self.assertEqual(len(pair), 2, pair)
+
+    def test_compiled_reads_back_as_saved(self):
+        for (compiled, saved) in corpus():
+            with self.subTest(compiled=compiled):
+                self.assertEqual(Canonical.saved(compiled),
+                                 tuple(shlex.split(saved)))
+
+    def test_saved_is_canonical(self):
+        for (_, saved) in corpus():
+            with self.subTest(saved=saved):
+                self.assertEqual(Canonical.saved(saved),
+                                 tuple(shlex.split(saved)))
+
+    def test_chain_digest_matches_snapshot(self):
+        pairs = corpus()
+        text = "\n".join(["*filter", ":order_test - [0:0]",
+                          *[f"-A order_test {saved}"
+                            for (_, saved) in pairs], "COMMIT"])
+        compiled = Canonical.digest(Canonical.saved(rule)
+                                    for (rule, _) in pairs)
+        self.assertEqual(Snapshot.parse(text).canonical_digest(
+            "filter", "order_test"), compiled)
+
+    def test_directive_guards_read_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sshd.order")
+            with open(path, "w") as order:
+                order.write("@connlimit 32 per-/24\n"
+                            "@ratelimit 10/s burst 20 per-src/24\n"
+                            "filter  -p tcp -m tcp --dport 22 -j ACCEPT\n")
+            rules = OrderReader(path, {}).as_order().rules
+
+        connlimit, ratelimit, _ = [rule.args for rule in rules]
+        name = ratelimit[ratelimit.index("--hashlimit-name") + 1]
+        self.assertEqual(Canonical.rule(connlimit), tuple(shlex.split(
+            "-p tcp -m tcp --dport 22 -m conntrack --ctstate NEW "
+            "-m connlimit --connlimit-above 32 --connlimit-mask 24 "
+            "--connlimit-saddr -j DROP")))
+        self.assertEqual(Canonical.rule(ratelimit), tuple(shlex.split(
+            "-p tcp -m tcp --dport 22 -m conntrack --ctstate NEW "
+            "-m hashlimit --hashlimit-above 10/sec --hashlimit-burst 20 "
+            f"--hashlimit-mode srcip --hashlimit-name {name} "
+            "--hashlimit-srcmask 24 -j DROP")))
+
+
+if __name__ == "__main__":
+    unittest.main()
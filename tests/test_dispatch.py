@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.iptables.tags import Tags
+from ipwaiter.orders.systemconf import SystemConfParser
+from ipwaiter.orders.waiter import Waiter
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        conf = os.path.join(directory.name, "system.conf")
+        with open(conf, "w") as system_conf:
+            system_conf.write('FILTER_INPUT="sshd syncthing icmp-block"\n'
+                              'DISPATCH="input"\n')
+        self.iptables = MemoryIptables()
+        self.waiter = Waiter(self.iptables, [ORDERS],
+                             SystemConfParser(conf))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.waiter.hire_waiter(opts={}, report=False)
+
+        # A chain of someone else, named like a dispatch chain
+        self.iptables.create("filter", "input_orders_custom")
+        self.iptables.add("filter", "input_orders_custom", ["-j", "ACCEPT"])
+
+    def _dispatch_chains(self):
+        return [chain for chain in self.iptables.chains("filter")
+                if chain.startswith("input_orders_")]
+
+    def test_hire_dispatches_through_tagged_jumps(self):
+        self.assertIn("input_orders_tcp", self._dispatch_chains())
+
+    def test_fire_leaves_chains_it_does_not_own(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.waiter.fire_waiter(destroy=False, report=False)
+        self.assertEqual(self._dispatch_chains(), ["input_orders_custom"])
+
+    def test_delete_finds_links_in_dispatch_chains(self):
+        tag = Tags.link_matches("order_sshd")
+        self.assertTrue(self.iptables.check_link(
+            "filter", "input_orders_tcp", "order_sshd", tag))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.waiter.delete_order(["input", "sshd"], False)
+        self.assertFalse(self.iptables.check_link(
+            "filter", "input_orders_tcp", "order_sshd", tag))
+        self.assertIn("order_sshd", self.iptables.chains("filter"))
+
+
+if __name__ == "__main__":
+    unittest.main()
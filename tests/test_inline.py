@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.orders.systemconf import SystemConfParser
+from ipwaiter.orders.waiter import Waiter
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class InlineTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.conf = os.path.join(directory.name, "system.conf")
+        self.iptables = MemoryIptables()
+
+    def _waiter(self, inline):
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_INPUT="sshd"\n'
+                       f'INLINE_MAX_RULES="{inline}"\n')
+        return Waiter(self.iptables, [ORDERS], SystemConfParser(self.conf))
+
+    def _rules(self, chain):
+        return [line for line in self.iptables.save().splitlines()
+                if line.startswith(f"-A {chain} ")]
+
+    @contextlib.contextmanager
+    def _quiet(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+    def test_inlining_holds_only_for_the_hired_parent(self):
+        waiter = self._waiter(2)
+        with self._quiet():
+            waiter.hire_waiter(opts={}, report=False)
+            waiter.add_order(["output", "sshd"], False, {})
+
+        self.assertEqual(len(self._rules("input_orders")), 1)
+        self.assertNotIn("-j order_sshd", self._rules("input_orders")[0])
+        self.assertEqual(len(self._rules("output_orders")), 1)
+        self.assertIn("-j order_sshd", self._rules("output_orders")[0])
+
+    def test_delete_removes_inlined_rules_beside_a_stale_chain(self):
+        with self._quiet():
+            self._waiter("").hire_waiter(opts={}, report=False)
+            waiter = self._waiter(2)
+            waiter.rehire_waiter(opts={}, report=False)
+            self.assertIn("order_sshd", self.iptables.chains("filter"))
+            self.assertEqual(len(self._rules("input_orders")), 1)
+
+            waiter.delete_order(["input", "sshd"], False)
+        self.assertEqual(self._rules("input_orders"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from ipwaiter.iptables.iptables import Iptables
+from ipwaiter.iptables.lock import XtablesLock
+from ipwaiter.logger.logger import FatalError
+
+"""Fails with status and message until it ran fails times, then succeeds
+printing the saved tables"""
+SCRIPT = """#!/bin/sh
+count=$(cat "{counter}" 2>/dev/null || echo 0)
+echo $((count + 1)) > "{counter}"
+if [ "$count" -lt {fails} ]; then
+    echo "{message}" >&2
+    exit {status}
+fi
+echo "*filter"
+"""
+
+
+class XtablesLockTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.lock = XtablesLock(retries=2, backoff=0)
+
+    def _binary(self, name, fails, status, message):
+        path = os.path.join(self.directory, name)
+        counter = os.path.join(self.directory, f"{name}.count")
+        with open(path, "w") as script:
+            script.write(SCRIPT.format(counter=counter, fails=fails,
+                                       status=status, message=message))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def test_lock_contention_is_retried(self):
+        binary = self._binary(
+            "iptables", 1, 4, "Another app is currently holding the "
+            "xtables lock. Perhaps you want to use the -w option?")
+        result = self.lock.run([binary])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual((self.lock.commands, self.lock.contended,
+                          self.lock.retries), (2, 1, 1))
+
+    def test_other_resource_problems_are_not_retried(self):
+        binary = self._binary("iptables", 1, 4,
+                              "iptables: Memory allocation problem.")
+        result = self.lock.run([binary])
+        self.assertEqual(result.returncode, 4)
+        self.assertEqual((self.lock.commands, self.lock.contended,
+                          self.lock.retries), (1, 0, 0))
+
+    def test_held_lock_is_fatal_after_retries(self):
+        binary = self._binary("iptables", 5, 4, "xtables lock is held")
+        with self.assertRaises(FatalError):
+            self.lock.run([binary])
+        self.assertEqual(self.lock.failures, 1)
+
+    def test_save_goes_through_the_lock(self):
+        self._binary("iptables-save", 1, 4, "Another app is currently "
+                     "holding the xtables lock.")
+        path = f"{self.directory}{os.pathsep}{os.environ.get('PATH', '')}"
+        with mock.patch.dict(os.environ, {"PATH": path}):
+            saved = Iptables(lock=self.lock).save()
+        self.assertEqual(saved, "*filter\n")
+        self.assertEqual(self.lock.retries, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
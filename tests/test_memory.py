@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import random
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+
+
+class MemoryIptablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.iptables = MemoryIptables()
+        self.assertTrue(self.iptables.restore(
+            "*filter\n"
+            ":input_orders - [0:0]\n"
+            ":order_sshd - [0:0]\n"
+            "-A INPUT -j input_orders\n"
+            "-A input_orders -j order_sshd\n"
+            "-A order_sshd -p tcp -m tcp --dport 22 -j ACCEPT\n"
+            "COMMIT\n"))
+        self.before = self.iptables.save()
+
+    def _filter(self):
+        """The filter table of the saved tables"""
+        saved = self.iptables.save()
+        return saved[saved.index("*filter"):saved.index("COMMIT")]
+
+    def test_failing_table_is_left_as_it_was(self):
+        self.assertFalse(self.iptables.restore(
+            "*raw\n"
+            ":prerouting_orders - [0:0]\n"
+            "COMMIT\n"
+            "*filter\n"
+            ":INPUT DROP [0:0]\n"
+            "-F order_sshd\n"
+            "-A missing -j ACCEPT\n"
+            "COMMIT\n"))
+        self.assertIn(":INPUT ACCEPT [0:0]", self._filter())
+        self.assertIn("--dport 22", self._filter())
+        # Tables commit on their own, so raw was committed before
+        self.assertIn("prerouting_orders", self.iptables.chains("raw"))
+
+    def test_table_without_commit_is_left_as_it_was(self):
+        self.assertFalse(self.iptables.restore(
+            "*filter\n"
+            ":FORWARD DROP [0:0]\n"
+            "-F order_sshd\n"))
+        self.assertEqual(self.iptables.save(), self.before)
+
+    def test_validate_changes_nothing(self):
+        self.assertIsNone(self.iptables.validate(
+            "*filter\n"
+            ":INPUT DROP [0:0]\n"
+            ":order_extra - [0:0]\n"
+            "-F order_sshd\n"
+            "COMMIT\n"))
+        self.assertEqual(self.iptables.save(), self.before)
+
+    def test_policy_is_committed_with_its_table(self):
+        self.assertTrue(self.iptables.restore(
+            "*filter\n:INPUT DROP [0:0]\n:OUTPUT - [0:0]\nCOMMIT\n"))
+        saved = self._filter()
+        self.assertIn(":INPUT DROP [0:0]", saved)
+        self.assertIn(":OUTPUT ACCEPT [0:0]", saved)
+        self.assertIn("-A INPUT -j input_orders", saved)
+        self.assertFalse(self.iptables.restore(
+            "*filter\n:INPUT REJECT [0:0]\nCOMMIT\n"))
+
+    def test_declaring_a_chain_flushes_only_that_chain(self):
+        self.assertTrue(self.iptables.restore(
+            "*filter\n:order_sshd - [0:0]\nCOMMIT\n"))
+        saved = self.iptables.save()
+        self.assertNotIn("--dport 22", saved)
+        self.assertIn("-A input_orders -j order_sshd", saved)
+
+    def test_save_restores_onto_fresh_tables(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            iptables = MemoryIptables()
+            chains = [f"chain_{index}" for index in range(rng.randint(1, 5))]
+            lines = ["*filter", ":FORWARD DROP [0:0]"]
+            lines += [f":{chain} - [0:0]" for chain in chains]
+            for _ in range(rng.randint(0, 20)):
+                chain = rng.choice(chains + ["INPUT", "OUTPUT"])
+                target = rng.choice(chains + ["ACCEPT", "DROP", "RETURN"])
+                port = rng.randint(1, 65535)
+                lines.append(f"-A {chain} -p tcp -m tcp --dport {port} "
+                             f"-m comment --comment \"rule {port}\" "
+                             f"-j {target}")
+            lines.append("COMMIT")
+            self.assertTrue(iptables.restore("\n".join(lines) + "\n"))
+
+            saved = iptables.save()
+            loaded = MemoryIptables()
+            loaded.load(saved)
+            self.assertEqual(loaded.save(), saved)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import stat
+import tempfile
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.logger.logger import FatalError
+from ipwaiter.nftables.nftables import Nftables
+from ipwaiter.orders.systemconf import SystemConfParser
+from ipwaiter.orders.waiter import Waiter
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+"""Stands in for nft, logging its arguments and any script it reads"""
+NFT = """#!/bin/sh
+echo "nft $*" >> "{log}"
+if [ "$1" = "-f" ]; then
+    cat >> "{log}"
+fi
+"""
+
+
+class NftablesTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, "log")
+        binary = os.path.join(directory.name, "nft")
+        with open(binary, "w") as nft:
+            nft.write(NFT.format(log=self.log))
+        os.chmod(binary, os.stat(binary).st_mode | stat.S_IXUSR)
+        self.nftables = Nftables(binary=binary)
+
+        self.conf = os.path.join(directory.name, "system.conf")
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_FORWARD="sshd"\n'
+                       'FORWARD_OFFLOAD="eth0 eth1"\n')
+
+    def _calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log, "r") as log:
+            return [line.strip() for line in log
+                    if line.startswith("nft ")]
+
+    def _waiter(self):
+        return Waiter(MemoryIptables(), [ORDERS],
+                      SystemConfParser(self.conf), nftables=self.nftables)
+
+    def test_offload_replaces_the_table_in_one_script(self):
+        self.assertTrue(self.nftables.offload(["eth0", "eth1"]))
+        with open(self.log, "r") as log:
+            script = log.read()
+        self.assertEqual(self._calls(), ["nft -f -"])
+        self.assertIn("delete table inet ipwaiter", script)
+        self.assertIn("devices = { eth0, eth1 }", script)
+        self.assertIn("ct state established flow add @offload", script)
+
+    def test_invalid_interface_is_refused(self):
+        with self.assertRaises(FatalError):
+            Nftables.offload_script(["eth0; drop"])
+        self.assertEqual(self._calls(), [])
+
+    def test_forward_changes_replace_the_flowtable(self):
+        waiter = self._waiter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.hire_waiter(opts={}, report=False)
+            waiter.delete_order(["forward", "sshd"], False)
+            waiter.add_order(["input", "sshd"], False, {})
+        self.assertEqual(self._calls(), [
+            "nft -f -",
+            "nft list table inet ipwaiter",
+            "nft -f -",
+        ])
+
+    def test_fire_removes_the_table_first(self):
+        waiter = self._waiter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.fire_waiter(destroy=False, report=False)
+        self.assertEqual(self._calls()[:2], [
+            "nft list table inet ipwaiter",
+            "nft delete table inet ipwaiter",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
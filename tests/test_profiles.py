@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ipwaiter.constants import PathConstants
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.orders.profiles import Profiles
+from ipwaiter.orders.waiter import Waiter
+from ipwaiter.orders.systemconf import SystemConfParser
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class ProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.conf = os.path.join(directory.name, "system.conf")
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_INPUT="sshd icmp-block"\n')
+        self.profile_dir = os.path.join(directory.name, "system.d")
+        os.mkdir(self.profile_dir)
+
+        active = mock.patch.object(PathConstants, "ACTIVE_PROFILE",
+                                   os.path.join(directory.name, "profile"))
+        active.start()
+        self.addCleanup(active.stop)
+
+    def _hire(self, switching=False):
+        iptables = MemoryIptables()
+        profiles = Profiles([ORDERS], system_conf=self.conf,
+                            profile_dir=self.profile_dir,
+                            switching=switching)
+        waiter = Waiter(iptables, [ORDERS], SystemConfParser(self.conf),
+                        profiles=profiles)
+        with contextlib.redirect_stderr(io.StringIO()):
+            waiter.hire_waiter(opts={}, report=False)
+        return iptables
+
+    def test_hire_without_profiles_stages_nothing(self):
+        iptables = self._hire()
+        self.assertNotIn("save", iptables.operations)
+        self.assertNotIn("restore", iptables.operations)
+        self.assertNotIn("p_default_input", iptables.chains("filter"))
+
+    def test_hire_with_a_profile_stages_every_profile(self):
+        with open(os.path.join(self.profile_dir, "home.conf"), "w") as conf:
+            conf.write('FILTER_INPUT="sshd"\n')
+        iptables = self._hire()
+        self.assertIn("p_default_input", iptables.chains("filter"))
+        self.assertIn("p_home_input", iptables.chains("filter"))
+
+    def test_hire_for_a_switch_stages_the_default_profile(self):
+        iptables = self._hire(switching=True)
+        self.assertIn("p_default_input", iptables.chains("filter"))
+
+
+if __name__ == "__main__":
+    unittest.main()
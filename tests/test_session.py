@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from ipwaiter.iptables.canonical import Canonical
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.iptables.restore import Restore
+from ipwaiter.session import Session
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class SavedIptables(MemoryIptables):
+    """Prints rules back as iptables-save does, not as they were added"""
+
+    def save(self):
+        lines = []
+        for line in super().save().splitlines():
+            if line.startswith("-A "):
+                _, chain, rule = line.split(" ", 2)
+                line = Restore.rule(chain, list(Canonical.saved(rule)))
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.conf = os.path.join(directory.name, "system.conf")
+        with open(self.conf, "w") as conf:
+            conf.write('FILTER_INPUT="sshd icmp-block"\n'
+                       'CONNTRACK_PRELUDE="input"\n')
+
+        self.iptables = SavedIptables()
+        self.session = Session(order_dirs=[ORDERS], system_conf=self.conf,
+                               iptables=self.iptables)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.session.hire()
+        self.session.refresh()
+
+    def test_plan_on_hired_tables_is_empty(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(self.session.plan(), "")
+
+    def test_transaction_on_hired_tables_commits_nothing(self):
+        before = self.iptables.save()
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.session.transaction():
+                self.session.add("input", "sshd")
+                self.session.hire()
+        self.assertEqual(self.iptables.save(), before)
+        self.assertEqual(self.iptables.operations["restore"], 1)
+
+    def test_transaction_leaves_stdout_to_the_caller(self):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            with contextlib.redirect_stderr(stderr):
+                with self.session.transaction():
+                    print("caller")
+                    self.session.delete("input", "sshd")
+        self.assertEqual(stdout.getvalue(), "caller\n")
+        self.assertIn("sshd", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+#  The GPLv2 License
+#
+#    Copyright (C) 2019  Peter Kenji Yamanaka
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import io
+import os
+import unittest
+
+from ipwaiter.iptables.memory import MemoryIptables
+from ipwaiter.orders.validator import Validator
+
+
+ORDERS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "conf", "orders")
+
+
+class SetIptables(MemoryIptables):
+    """Rejects a match of any set ipset does not hold, as libxt_set does
+    when it resolves the set while parsing"""
+
+    def __init__(self, ipset):
+        super().__init__()
+        self._ipset = ipset
+
+    def validate(self, payload):
+        for (number, line) in enumerate(payload.splitlines(), start=1):
+            words = line.split()
+            for (index, word) in enumerate(words[:-1]):
+                if word == "--match-set" and \
+                        not self._ipset.exists(words[index + 1]):
+                    return f"Set {words[index + 1]} doesn't exist.\n" \
+                           f"Error occurred at line: {number}"
+        return super().validate(payload)
+
+
+class MemoryIpset:
+    """Holds the names of the sets it was asked to create"""
+
+    def __init__(self):
+        self.sets = set()
+
+    def exists(self, name):
+        return name in self.sets
+
+    def destroy(self, name):
+        self.sets.discard(name)
+        return True
+
+    def restore(self, lines):
+        for line in lines:
+            words = line.split()
+            if words[0] == "create":
+                self.sets.add(words[1])
+        return True
+
+
+class ValidatorTest(unittest.TestCase):
+
+    def test_blocklist_orders_validate_without_their_sets(self):
+        ipset = MemoryIpset()
+        validator = Validator(SetIptables(ipset), [ORDERS], ipset)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertTrue(validator.run({}), stdout.getvalue())
+        self.assertEqual(ipset.sets, set())
+
+    def test_blocklist_orders_fail_without_stand_ins(self):
+        validator = Validator(SetIptables(MemoryIpset()), [ORDERS])
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertFalse(validator.run({}))
+        self.assertIn("blocklist-drop.order", stdout.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()